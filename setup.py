@@ -25,6 +25,9 @@ setup(
     package_dir={"": "src"},
     packages=find_packages(where="src"),
     install_requires=_REQUIRES,
+    extras_require={
+        "numpy": ["numpy==1.13.1"],
+    },
     include_package_data=True,
     python_requires=">=3.5",
     zip_safe=False,
@@ -32,5 +35,8 @@ setup(
         "paste.app_factory": [
             "main = ensign.api:main",
         ],
+        "console_scripts": [
+            "ensign = ensign.cli:main",
+        ],
     },
 )
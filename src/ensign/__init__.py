@@ -3,15 +3,44 @@ This module provides a very simple implementation of feature flags, persisted
 to a SQL database by default. The flags can be used by value or as decorators.
 """
 
+from ensign._async import AsyncBinaryFlag, AsyncSQLStorage
+from ensign._cache import CachedStorage
+from ensign._filestorage import FileStorage, export_snapshot
 from ensign._flags import (
     BinaryFlag,
+    EvalPolicy,
     FlagDoesNotExist,
+    FlagExpr,
+    PercentageFlag,
+    RuleFlag,
 )
-from ensign._storage import DefaultStorage
+from ensign._pipeline import evaluate_subjects
+from ensign._rules import RuleError
+from ensign._resilience import ResilientStorage, StorageUnavailable
+from ensign._snapshot import FlagSnapshot
+from ensign._storage import DefaultStorage, FlagRecord
+from ensign._transfer import export_flags, import_flags
 
 
 __all__ = (
+    "AsyncBinaryFlag",
+    "AsyncSQLStorage",
     "BinaryFlag",
+    "CachedStorage",
+    "EvalPolicy",
     "FlagDoesNotExist",
+    "FlagExpr",
+    "FlagRecord",
+    "FileStorage",
+    "FlagSnapshot",
+    "PercentageFlag",
+    "ResilientStorage",
+    "RuleError",
+    "RuleFlag",
+    "StorageUnavailable",
+    "evaluate_subjects",
+    "export_flags",
+    "export_snapshot",
+    "import_flags",
     "DefaultStorage",
 )
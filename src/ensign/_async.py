@@ -0,0 +1,312 @@
+"""
+Asyncio support. Provides an asynchronous storage, running any flag storage in
+a thread pool, and flags to be evaluated from coroutines.
+"""
+
+import abc
+import asyncio
+import functools
+
+from functools import wraps
+from zope.interface import implementer
+
+from ensign._flags import FlagDoesNotExist
+from ensign._interfaces import IAsyncStorage
+from ensign._storage import DefaultStorage, FlagTypes
+
+
+@implementer(IAsyncStorage)
+class AsyncSQLStorage:
+    """
+    Asynchronous flag storage, running the operations of a SQLStorage (or any
+    other storage) in an executor, so they don't block the event loop.
+
+    Loads requested concurrently from the same event loop are coalesced into
+    a single load_many() call to the wrapped storage.
+    """
+
+    def __init__(self, backend=DefaultStorage, executor=None):
+        self.backend = backend
+        self.executor = executor
+        self.pending = {}
+
+    def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+            self.executor,
+            functools.partial(method, *args, **kwargs),
+        )
+
+    async def create(self, name, flagtype, **kwargs):
+        """
+        Create a new flag of the given type.
+        """
+
+        return await self._run(self.backend.create, name, flagtype, **kwargs)
+
+    async def create_many(self, flags, flagtype):
+        """
+        Create several new flags of the given type.
+        """
+
+        return await self._run(self.backend.create_many, flags, flagtype)
+
+    async def exists(self, name, flagtype=None):
+        """
+        Check if a flag exists in the store (with the given type).
+        """
+
+        return await self._run(self.backend.exists, name, flagtype)
+
+    async def load(self, name, flagtype):
+        """
+        Load a flag's value, batched with any other concurrent loads.
+        Raises KeyError if the flag doesn't exist.
+        """
+
+        loop = asyncio.get_event_loop()
+        key = (loop, flagtype)
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = {}
+            asyncio.ensure_future(self._load_batch(key))
+
+        future = loop.create_future()
+        batch.setdefault(name, []).append(future)
+        return await future
+
+    async def _load_batch(self, key):
+        batch = self.pending.pop(key)
+        try:
+            values = await self.load_many(list(batch), key[1])
+        except Exception as exc:  # pylint: disable=broad-except
+            values = {}
+            error = exc
+        else:
+            error = None
+
+        for name, futures in batch.items():
+            for future in futures:
+                if future.done():
+                    continue
+                if name in values:
+                    future.set_result(values[name])
+                else:
+                    future.set_exception(error or KeyError(name))
+
+    async def load_many(self, names, flagtype):
+        """
+        Load several flags' values, in a single call to the wrapped storage.
+        """
+
+        return await self._run(self.backend.load_many, names, flagtype)
+
+    async def store(self, name, value, flagtype):
+        """
+        Store a new value for a flag.
+        """
+
+        return await self._run(self.backend.store, name, value, flagtype)
+
+    async def store_many(self, values, flagtype):
+        """
+        Store new values for several flags.
+        """
+
+        return await self._run(self.backend.store_many, values, flagtype)
+
+    async def used(self, name):
+        """
+        Return a flag's last used date.
+        """
+
+        return await self._run(self.backend.used, name)
+
+    async def activity(self, name, days):
+        """
+        Return a flag's activity indicator.
+        """
+
+        return await self._run(self.backend.activity, name, days)
+
+    async def activity_all(self, days):
+        """
+        Return all flags' activity indicators.
+        """
+
+        return await self._run(self.backend.activity_all, days)
+
+    async def info(self, name):
+        """
+        Return a flag's full information.
+        """
+
+        return await self._run(self.backend.info, name)
+
+    async def all(self):
+        """
+        Return all flags.
+        """
+
+        return await self._run(self.backend.all)
+
+    async def info_all(self, names=None):
+        """
+        Return all (or the given) flags' full information.
+        """
+
+        return await self._run(self.backend.info_all, names)
+
+    async def touch(self, names):
+        """
+        Update several flags' last used date.
+        """
+
+        return await self._run(self.backend.touch, names)
+
+
+AsyncDefaultStorage = AsyncSQLStorage()
+
+
+class AsyncFlag(metaclass=abc.ABCMeta):
+    """
+    Asynchronous flag base class. Flags are obtained through `await get()` or
+    `await create()`, evaluated through `await check()`, and can decorate
+    coroutine functions.
+    """
+
+    __slots__ = ("name", "store")
+
+    TYPE = None
+
+    def __init__(self, name, store=AsyncDefaultStorage):
+        self.name = name
+        self.store = store
+
+    @classmethod
+    async def get(cls, name, store=AsyncDefaultStorage):
+        """
+        Return an existing flag of this type, given its name.
+        """
+
+        if not await store.exists(name, cls.TYPE):
+            raise FlagDoesNotExist()
+        return cls(name, store=store)
+
+    @classmethod
+    async def create(cls, name, store=AsyncDefaultStorage, **kwargs):
+        """
+        Create a new flag, given its name and extra arguments, in the provided
+        store.
+        """
+
+        await store.create(name, cls.TYPE, **kwargs)
+        return cls(name, store=store)
+
+    @classmethod
+    async def all(cls, store=AsyncDefaultStorage):
+        """
+        Return all flags of this type in the store.
+        """
+
+        return [
+            cls(info["name"], store=store)
+            for info in await store.info_all()
+            if cls.TYPE in (None, info["type"])
+        ]
+
+    @classmethod
+    async def load_many(cls, names, store=AsyncDefaultStorage):
+        """
+        Evaluate several flags at once, with a single storage call. Returns a
+        mapping of flag names to their evaluation results.
+        """
+
+        values = await store.load_many(names, cls.TYPE)
+        missing = set(names) - set(values)
+        if missing:
+            raise FlagDoesNotExist(", ".join(sorted(missing)))
+
+        return {
+            name: cls._evaluate(value)
+            for name, value in values.items()
+        }
+
+    def __str__(self):
+        return f"<AsyncFlag({self.name})>"
+
+    def __bool__(self):
+        raise TypeError("Asynchronous flags must be evaluated with check()")
+
+    def __call__(self, target):
+        @wraps(target)
+        async def wrapper(*args, **kwargs):
+            """
+            If the flag evaluates to True, go through with the target
+            coroutine function. Otherwise, skip it.
+            """
+
+            if await self.check():
+                return await target(*args, **kwargs)
+
+        return wrapper
+
+    async def check(self):
+        """
+        Returns the result of evaluating the flag.
+        """
+
+        return self._evaluate(await self.load())
+
+    async def load(self):
+        """
+        Get the flag's stored value.
+        """
+
+        try:
+            return await self.store.load(self.name, self.TYPE)
+        except KeyError:
+            raise FlagDoesNotExist()
+
+    async def store_value(self, value):
+        """
+        Set the flag's stored value.
+        """
+
+        try:
+            await self.store.store(self.name, value, self.TYPE)
+        except KeyError:
+            raise FlagDoesNotExist()
+
+    @staticmethod
+    def _evaluate(value):
+        """
+        Returns the result of evaluating a stored value. Must be a boolean
+        value.
+        """
+
+        return bool(value)
+
+
+class AsyncBinaryFlag(AsyncFlag):
+    """
+    Asynchronous implementation of a flag storing a boolean value.
+    """
+
+    __slots__ = ()
+
+    TYPE = FlagTypes.BINARY
+
+    async def set(self):
+        """
+        Shortcut method to set() (to True) the flag's value.
+        """
+
+        await self.store_value(True)
+
+    async def unset(self):
+        """
+        Shortcut method to unset() (to False) the flag's value.
+        """
+
+        await self.store_value(False)
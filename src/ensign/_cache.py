@@ -0,0 +1,255 @@
+"""
+Caching-related classes. Provides an in-process caching layer that can wrap
+any flag storage.
+"""
+
+import collections
+import threading
+import time
+
+from zope.interface import implementer
+
+from ensign._interfaces import IStorage
+
+
+_EXISTS = "exists"
+_INFO = "info"
+
+
+@implementer(IStorage)
+class CachedStorage:
+    """
+    In-memory, per-process cache in front of another storage.
+
+    Flag existence, values and descriptive information are served from memory
+    for `ttl` seconds (which can be overridden per flag name through `ttls`).
+    At most `maxsize` flags are kept, evicting the least recently used ones.
+    Writes made through the cache invalidate the affected flag.
+
+    Since cached loads don't reach the wrapped storage, last used dates are
+    only updated when an entry is refreshed. Every invalidation bumps the
+    flag's generation (or the whole cache's), and values fetched across a
+    bump are returned but not cached, as they may predate the change.
+    """
+
+    def __init__(self, backend, ttl=5.0, maxsize=4096, ttls=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.generations = {}
+        self.epoch = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, name, key, fetch, *args):
+        now = time.monotonic()
+        with self.lock:
+            entries = self.entries.get(name)
+            if entries is not None:
+                entry = entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self.entries.move_to_end(name)
+                    self.hits += 1
+                    return entry[1]
+            self.misses += 1
+            generation = self._generation(name)
+
+        value = fetch(*args)
+        with self.lock:
+            if self._generation(name) == generation:
+                self._put(name, key, value, now)
+        return value
+
+    def _generation(self, name):
+        return self.epoch, self.generations.get(name, 0)
+
+    def _put(self, name, key, value, now):
+        entries = self.entries.get(name)
+        if entries is None:
+            entries = self.entries[name] = {}
+        entries[key] = (now + self.ttls.get(name, self.ttl), value)
+        self.entries.move_to_end(name)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, name=None):
+        """
+        Drop a flag's cached data, or the whole cache if no name is given.
+        """
+
+        with self.lock:
+            if name is None:
+                self.entries.clear()
+                self.generations.clear()
+                self.epoch += 1
+            else:
+                self.entries.pop(name, None)
+                self.generations[name] = self.generations.get(name, 0) + 1
+
+    def warm(self):
+        """
+        Fill the cache with all flags' existence and values, read at once.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            epoch, generations = self.epoch, dict(self.generations)
+        infos = self.backend.info_all()
+        with self.lock:
+            if self.epoch != epoch:
+                return
+            for info in infos:
+                if self.generations.get(info["name"], 0) != \
+                        generations.get(info["name"], 0):
+                    continue
+                flagtype = info["type"]
+                self._put(info["name"], (_EXISTS, None), True, now)
+                self._put(info["name"], (_EXISTS, flagtype), True, now)
+                self._put(
+                    info["name"],
+                    flagtype,
+                    info[f"value_{flagtype.value}"],
+                    now,
+                )
+
+    def create(self, name, flagtype, **kwargs):
+        """
+        Create a new flag in the wrapped storage.
+        """
+
+        self.backend.create(name, flagtype, **kwargs)
+        self.invalidate(name)
+
+    def create_many(self, flags, flagtype):
+        """
+        Create several new flags in the wrapped storage.
+        """
+
+        flags = list(flags)
+        self.backend.create_many(flags, flagtype)
+        for flag in flags:
+            self.invalidate(flag["name"])
+
+    def exists(self, name, flagtype=None):
+        """
+        Check if the flag exists (with the given type), from the cache if
+        possible.
+        """
+
+        return self._cached(
+            name,
+            (_EXISTS, flagtype),
+            self.backend.exists,
+            name,
+            flagtype,
+        )
+
+    def load(self, name, flagtype):
+        """
+        Load a flag's value, from the cache if possible.
+        """
+
+        return self._cached(name, flagtype, self.backend.load, name, flagtype)
+
+    def load_many(self, names, flagtype):
+        """
+        Load several flags' values, fetching only those not in the cache, in
+        a single call to the wrapped storage.
+        """
+
+        now = time.monotonic()
+        values = {}
+        missing = []
+        with self.lock:
+            for name in names:
+                entry = self.entries.get(name, {}).get(flagtype)
+                if entry is not None and entry[0] > now:
+                    self.entries.move_to_end(name)
+                    self.hits += 1
+                    values[name] = entry[1]
+                else:
+                    self.misses += 1
+                    missing.append(name)
+            generations = {name: self._generation(name) for name in missing}
+
+        if missing:
+            fetched = self.backend.load_many(missing, flagtype)
+            with self.lock:
+                for name, value in fetched.items():
+                    if self._generation(name) == generations[name]:
+                        self._put(name, flagtype, value, now)
+            values.update(fetched)
+
+        return values
+
+    def store(self, name, value, flagtype):
+        """
+        Store a flag's value in the wrapped storage.
+        """
+
+        self.backend.store(name, value, flagtype)
+        self.invalidate(name)
+
+    def store_many(self, values, flagtype):
+        """
+        Store several flags' values in the wrapped storage.
+        """
+
+        values = dict(values)
+        self.backend.store_many(values, flagtype)
+        for name in values:
+            self.invalidate(name)
+
+    def used(self, name):
+        """
+        Return a flag's last used date, straight from the wrapped storage.
+        """
+
+        return self.backend.used(name)
+
+    def activity(self, name, days):
+        """
+        Return a flag's activity indicator, straight from the wrapped storage.
+        """
+
+        return self.backend.activity(name, days)
+
+    def activity_all(self, days):
+        """
+        Return all flags' activity indicators, straight from the wrapped
+        storage.
+        """
+
+        return self.backend.activity_all(days)
+
+    def info(self, name):
+        """
+        Return a flag's information, from the cache if possible.
+        """
+
+        return self._cached(name, _INFO, self.backend.info, name)
+
+    def all(self):
+        """
+        Return all flags, straight from the wrapped storage.
+        """
+
+        return self.backend.all()
+
+    def info_all(self, names=None):
+        """
+        Return all (or the given) flags' information, straight from the
+        wrapped storage.
+        """
+
+        return self.backend.info_all(names)
+
+    def touch(self, names):
+        """
+        Update several flags' last used date in the wrapped storage.
+        """
+
+        self.backend.touch(names)
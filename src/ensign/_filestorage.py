@@ -0,0 +1,299 @@
+"""
+File-related classes. Provides a read-only storage backed by a compact,
+memory-mapped snapshot file of all flags, and the means to produce one.
+
+File layout (all integers are little-endian, unsigned 32-bit):
+ - Header: Magic string and number of flags.
+ - Index: Offset and name length of every record, sorted by flag name.
+ - Records: Flag name, followed by the length of its JSON-encoded
+   information and the information itself.
+"""
+
+import datetime
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from zope.interface import implementer
+
+from ensign._interfaces import IStorage
+from ensign._storage import (
+    FlagActive,
+    FlagRecord,
+    FlagTypes,
+    _days_by_type,
+)
+
+
+MAGIC = b"ENSIGN01"
+_HEADER = struct.Struct("<8sI")
+_ENTRY = struct.Struct("<II")
+_LENGTH = struct.Struct("<I")
+_DATETIME = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+class ReadOnlyStorage(Exception):
+    """
+    Exception raised when trying to modify a read-only storage.
+    """
+
+
+def _encode(info):
+    record = {}
+    for key in info.keys():
+        value = info[key]
+        if key in ("id", "name"):
+            continue
+        if isinstance(value, FlagTypes):
+            value = value.value
+        elif isinstance(value, datetime.datetime):
+            value = value.strftime(_DATETIME)
+        record[key] = value
+    return json.dumps(record, separators=(",", ":")).encode("utf-8")
+
+
+def _decode(name, payload):
+    record = json.loads(payload.decode("utf-8"))
+    record["name"] = name
+    record["type"] = FlagTypes(record["type"])
+    if record.get("used") is not None:
+        record["used"] = datetime.datetime.strptime(record["used"], _DATETIME)
+    return FlagRecord.from_mapping(record)
+
+
+def export_snapshot(store, path, names=None):
+    """
+    Write a snapshot file with all the flags in the store (or only the given
+    ones). The file is replaced atomically, so readers never see a partial
+    snapshot.
+    """
+
+    records = sorted(
+        (info["name"].encode("utf-8"), _encode(info))
+        for info in store.info_all(names)
+    )
+
+    offset = _HEADER.size + _ENTRY.size * len(records)
+    index = []
+    for name, payload in records:
+        index.append(_ENTRY.pack(offset, len(name)))
+        offset += len(name) + _LENGTH.size + len(payload)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as output:
+        try:
+            output.write(_HEADER.pack(MAGIC, len(records)))
+            output.writelines(index)
+            for name, payload in records:
+                output.write(name)
+                output.write(_LENGTH.pack(len(payload)))
+                output.write(payload)
+            output.flush()
+            os.fsync(output.fileno())
+        except BaseException:
+            os.unlink(output.name)
+            raise
+    os.chmod(output.name, 0o644)
+    os.replace(output.name, path)
+
+
+@implementer(IStorage)
+class FileStorage:
+    """
+    Read-only flag storage, backed by a snapshot file (see export_snapshot).
+
+    The file is memory-mapped, so opening it is immediate and its pages are
+    shared through the OS page cache by all processes reading it. Flags are
+    looked up with a binary search over the index, and decoded on first use.
+    Last used dates are not tracked.
+    """
+    # pylint: disable=unused-argument
+
+    def __init__(self, path):
+        self.path = path
+        self.stat = None
+        self.data = None
+        self.count = 0
+        self.records = {}
+        self.reload()
+
+    def reload(self):
+        """
+        Map the snapshot file again, if it has been replaced since it was last
+        mapped. Returns whether it was.
+        """
+
+        stat = os.stat(self.path)
+        if self.stat is not None and \
+                (stat.st_ino, stat.st_mtime) == \
+                (self.stat.st_ino, self.stat.st_mtime):
+            return False
+
+        with open(self.path, "rb") as snapshot:
+            data = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            data.close()
+            raise ValueError(f"{self.path} is not a flags snapshot")
+
+        self.stat = stat
+        self.data = data
+        self.count = count
+        self.records = {}
+        return True
+
+    def _name(self, position):
+        offset, length = _ENTRY.unpack_from(
+            self.data,
+            _HEADER.size + _ENTRY.size * position,
+        )
+        return offset, self.data[offset:offset + length]
+
+    def _find(self, name):
+        record = self.records.get(name)
+        if record is not None:
+            return record
+
+        key = name.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset, current = self._name(middle)
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                start = offset + len(key)
+                length, = _LENGTH.unpack_from(self.data, start)
+                start += _LENGTH.size
+                record = _decode(name, self.data[start:start + length])
+                self.records[name] = record
+                return record
+
+        raise KeyError(name)
+
+    def create(self, name, flagtype, **kwargs):
+        """
+        Not supported, read-only storage.
+        """
+
+        raise ReadOnlyStorage()
+
+    def create_many(self, flags, flagtype):
+        """
+        Not supported, read-only storage.
+        """
+
+        raise ReadOnlyStorage()
+
+    def exists(self, name, flagtype=None):
+        """
+        Check if the flag exists in the snapshot (with the given type).
+        """
+
+        try:
+            record = self._find(name)
+        except KeyError:
+            return False
+        return flagtype is None or record.type == flagtype
+
+    def load(self, name, flagtype):
+        """
+        Load a flag's value from the snapshot.
+        """
+
+        return self._find(name).get(f"value_{flagtype.value}")
+
+    def load_many(self, names, flagtype):
+        """
+        Load several flags' values from the snapshot, leaving out inexisting
+        flags.
+        """
+
+        values = {}
+        for name in names:
+            try:
+                values[name] = self.load(name, flagtype)
+            except KeyError:
+                pass
+        return values
+
+    def store(self, name, value, flagtype):
+        """
+        Not supported, read-only storage.
+        """
+
+        raise ReadOnlyStorage()
+
+    def store_many(self, values, flagtype):
+        """
+        Not supported, read-only storage.
+        """
+
+        raise ReadOnlyStorage()
+
+    def used(self, name):
+        """
+        Return a flag's last used date, as of the snapshot.
+        """
+
+        return self._find(name).get("used")
+
+    def activity(self, name, days):
+        """
+        Return a flag's activity indicator, as of the snapshot's usage data.
+        """
+
+        return FlagActive.from_used(self._find(name).get("used"), days)
+
+    def activity_all(self, days):
+        """
+        Return all flags' activity indicators, as of the snapshot's usage
+        data.
+        """
+
+        periods = _days_by_type(days)
+        return {
+            info.name: FlagActive.from_used(info.used, periods[info.type])
+            for info in self.info_all()
+        }
+
+    def info(self, name):
+        """
+        Return a flag's full information.
+        """
+
+        return self._find(name)
+
+    def all(self):
+        """
+        Return all flags.
+        """
+
+        return [
+            self._name(position)[1].decode("utf-8")
+            for position in range(self.count)
+        ]
+
+    def info_all(self, names=None):
+        """
+        Return all (or the given) flags' full information.
+        """
+
+        if names is None:
+            names = self.all()
+        infos = []
+        for name in sorted(names):
+            try:
+                infos.append(self._find(name))
+            except KeyError:
+                pass
+        return infos
+
+    def touch(self, names):
+        """
+        Last used dates are not tracked in snapshots.
+        """
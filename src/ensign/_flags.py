@@ -1,17 +1,31 @@
 """
-Feature flag-related classes. Provides an abstract flag implementation, and a
-concrete implementation of a binary flag.
+Feature flag-related classes. Provides an abstract flag implementation, a
+concrete implementation of a binary flag, and lazy flag expressions.
 """
 
 import abc
-import datetime
+import collections
 import enum
+import functools
+import numbers
+import time
+import types
 
-from functools import wraps
 from zope.interface import implementer
 
+from ensign import _hashing
 from ensign._interfaces import IFlag
-from ensign._storage import DefaultStorage, FlagTypes
+from ensign._rules import compile_rules, dump_rules
+from ensign._snapshot import current_snapshot
+from ensign._storage import (
+    DAYS_INACTIVE,
+    DefaultStorage,
+    FlagActive,
+    FlagTypes,
+)
+
+
+_NO_CONTEXT = types.MappingProxyType({})
 
 
 class FlagDoesNotExist(Exception):
@@ -20,54 +34,210 @@ class FlagDoesNotExist(Exception):
     """
 
 
-class FlagActive(enum.Enum):
+class EvalPolicy(enum.Enum):
+    """
+    Possible ways for a decorator to evaluate its flag:
+     - Call: On every call of the decorated function.
+     - Cached: At most once every `ttl` seconds.
+     - Snapshot: Once per FlagSnapshot (i.e., per request when using the
+       snapshot tween), or on every call outside snapshots.
+     - Import: Just once, when decorating the function.
+    """
+
+    CALL = "call"
+    CACHED = "cached"
+    SNAPSHOT = "snapshot"
+    IMPORT = "import"
+
+
+def _with_fallback(guard, fallback):
+    """
+    Return a function evaluating the guard (a flag or flag expression), which
+    returns `fallback` instead if the evaluation fails. Inexisting flags are
+    always reported.
+    """
+    # pylint: disable=protected-access
+
+    if fallback is None:
+        return guard._check
+
+    def check():
+        try:
+            return guard._check()
+        except FlagDoesNotExist:
+            raise
+        except Exception:  # pylint: disable=broad-except
+            return fallback
+
+    return check
+
+
+def _cached(guard, ttl, fallback):
+    state = [0.0, None]
+
+    def check():
+        now = time.monotonic()
+        if now < state[0]:
+            return state[1]
+
+        try:
+            value = guard._check()  # pylint: disable=protected-access
+        except FlagDoesNotExist:
+            raise
+        except Exception:  # pylint: disable=broad-except
+            if state[1] is not None:
+                value = state[1]
+            elif fallback is not None:
+                value = fallback
+            else:
+                raise
+
+        state[0] = now + ttl
+        state[1] = value
+        return value
+
+    return check
+
+
+def _per_snapshot(guard, fallback):
+    """
+    Return a function evaluating the guard once per set of active snapshots.
+    Results are kept by the snapshots themselves, so concurrent requests
+    (each with its own snapshots) never see each other's, and are dropped
+    along with them.
+    """
+
+    evaluate = _with_fallback(guard, fallback)
+    token = object()
+
+    def check():
+        snapshots = guard._snapshots()  # pylint: disable=protected-access
+        owner = next(
+            (snapshot for snapshot in snapshots if snapshot is not None),
+            None,
+        )
+        if owner is None:
+            return evaluate()
+
+        key = (token, snapshots)
+        try:
+            return owner.results[key]
+        except KeyError:
+            result = owner.results[key] = evaluate()
+            return result
+
+    return check
+
+
+def _guarded(guard, target, policy, ttl, fallback):
     """
-    Possible values for a flag activity indicator:
-     - Inactive: Flag has not been used in DAYS_INACTIVE (see Flag class).
-     - Active: Flag has been used recently.
-     - New: Flag has never been used.
+    Wrap the target function, so it's only run when the guard (a flag or flag
+    expression) evaluates to True, as per the evaluation policy.
     """
+    # pylint: disable=too-many-arguments
+
+    if target is None:
+        return functools.partial(
+            _guarded,
+            guard,
+            policy=policy,
+            ttl=ttl,
+            fallback=fallback,
+        )
 
-    INACTIVE = 0
-    ACTIVE = 1
-    NEW = 2
+    if policy == EvalPolicy.CACHED:
+        check = _cached(guard, ttl, fallback)
+    elif policy == EvalPolicy.SNAPSHOT:
+        check = _per_snapshot(guard, fallback)
+    elif policy == EvalPolicy.IMPORT:
+        value = _with_fallback(guard, fallback)()
+
+        def check():
+            return value
+    else:
+        check = _with_fallback(guard, fallback)
+
+    @functools.wraps(target)
+    def wrapper(*args, **kwargs):
+        """
+        If the flag evaluates to True, go through with the target function.
+        Otherwise, skip it.
+        """
+
+        if check():
+            return target(*args, **kwargs)
+
+    return wrapper
 
 
 class Flag(metaclass=abc.ABCMeta):
     """
     Flag base class, for all concrete flag implementations to inherit from.
+    Flags are slotted, to keep handles small; subclasses should declare their
+    own (possibly empty) `__slots__`.
     """
 
+    __slots__ = ("name", "store")
+
     TYPE = None
-    DAYS_INACTIVE = 7
+    DAYS_INACTIVE = DAYS_INACTIVE
+
+    def __init__(self, name, store=DefaultStorage, lazy=False):
+        """
+        Get a handle on an existing flag. Unless `lazy`, the flag's existence
+        (with this class' type) is checked right away; otherwise,
+        FlagDoesNotExist is raised the first time the flag is accessed.
+        """
 
-    def __init__(self, name, store=DefaultStorage):
         self.name = name
         self.store = store
-        if not self.store.exists(self.name):
+        if not lazy and not self._reader().exists(self.name, self.TYPE):
             raise FlagDoesNotExist()
 
     @classmethod
-    def create(cls, name, store=DefaultStorage, **kwargs):
+    def create(cls, name, store=DefaultStorage, default=None, **kwargs):
         """
         Create a new flag, given its name and extra arguments, in the provided
-        store.
+        store. The default value, if given, is used when the store is not
+        available (see ResilientStorage).
         """
 
+        if default is not None:
+            kwargs[f"default_{cls.TYPE.value}"] = default
         store.create(name, cls.TYPE, **kwargs)
-        return cls(name, store=store)
+        return cls(name, store=store, lazy=True)
 
     @classmethod
     def all(cls, store=DefaultStorage):
         """
-        Return all flags in the store.
+        Return all flags of this type in the store.
         """
 
         return [
-            cls(flag, store=store)
-            for flag in store.all()
+            cls(info["name"], store=store, lazy=True)
+            for info in store.info_all()
+            if cls.TYPE in (None, info["type"])
         ]
 
+    @classmethod
+    def load_many(cls, names, store=DefaultStorage):
+        """
+        Evaluate several flags at once, with a single storage call. Returns a
+        mapping of flag names to their evaluation results.
+        """
+
+        snapshot = current_snapshot(store)
+        reader = store if snapshot is None else snapshot
+        values = reader.load_many(names, cls.TYPE)
+        missing = set(names) - set(values)
+        if missing:
+            raise FlagDoesNotExist(", ".join(sorted(missing)))
+
+        return {
+            name: cls._evaluate(value)
+            for name, value in values.items()
+        }
+
     def __str__(self):
         return f"<Flag({self.name}={self.value})>"
 
@@ -75,32 +245,40 @@ class Flag(metaclass=abc.ABCMeta):
         return self._check()
 
     def __and__(self, other):
-        # pylint: disable=protected-access
-        return self._check() & other._check()
+        return FlagExpr(FlagExpr.AND, self, other)
 
     def __or__(self, other):
-        # pylint: disable=protected-access
-        return self._check() | other._check()
+        return FlagExpr(FlagExpr.OR, self, other)
 
     def __xor__(self, other):
-        # pylint: disable=protected-access
-        return self._check() ^ other._check()
+        return FlagExpr(FlagExpr.XOR, self, other)
 
     def __invert__(self):
-        return not self._check()
+        return FlagExpr(FlagExpr.NOT, self)
 
-    def __call__(self, target):
-        @wraps(target)
-        def wrapper(*args, **kwargs):
-            """
-            If the flag evaluates to True, go through with the target
-            function. Otherwise, skip it.
-            """
+    def __call__(self, target=None, *, policy=EvalPolicy.CALL, ttl=5.0,
+                 fallback=None):
+        """
+        Decorate the target function, to run it only when the flag evaluates
+        to True. Used without arguments (`@flag`), the flag is evaluated on
+        every call; otherwise (`@flag(policy=...)`), as per the evaluation
+        policy, with `ttl` seconds for cached evaluations. If given,
+        `fallback` is used when evaluating the flag fails.
+        """
 
-            if self._check():
-                return target(*args, **kwargs)
+        return _guarded(self, target, policy, ttl, fallback)
 
-        return wrapper
+    def _snapshots(self):
+        return (current_snapshot(self.store),)
+
+    def _reader(self):
+        """
+        Returns where to read the flag from: the active snapshot of its store,
+        if any, or the store itself.
+        """
+
+        snapshot = current_snapshot(self.store)
+        return self.store if snapshot is None else snapshot
 
     @abc.abstractmethod
     def _check(self):
@@ -108,13 +286,36 @@ class Flag(metaclass=abc.ABCMeta):
         Returns the result of evaluating the flag. Must be a boolean value.
         """
 
+    @staticmethod
+    def _evaluate(value):
+        """
+        Returns the result of evaluating a stored value. Must be a boolean
+        value.
+        """
+
+        return bool(value)
+
+    def evaluate_many(self, contexts):
+        """
+        Return the result of evaluating the flag for each of the given
+        contexts, with a single storage call. Returns a boolean array if NumPy
+        is available, or a list otherwise. Flags not depending on the context
+        give the same result for all of them.
+        """
+
+        result = self._check()
+        return _hashing.booleans(result for _ in contexts)
+
     @property
     def value(self):
         """
         Get the flag's stored value.
         """
 
-        return self.store.load(self.name, self.TYPE)
+        try:
+            return self._reader().load(self.name, self.TYPE)
+        except KeyError:
+            raise FlagDoesNotExist()
 
     @value.setter
     def value(self, val):
@@ -122,23 +323,30 @@ class Flag(metaclass=abc.ABCMeta):
         Set the flag's stored value.
         """
 
-        self.store.store(self.name, val, self.TYPE)
+        try:
+            self.store.store(self.name, val, self.TYPE)
+        except KeyError:
+            raise FlagDoesNotExist()
 
     @property
     def active(self):
         """
-        Return the flag's activity indicator. See the FlagActive's enum.
+        Return the flag's activity indicator, as classified by the store with
+        the flag type's DAYS_INACTIVE. See the FlagActive's enum.
         """
 
-        used = self.store.used(self.name)
-        if used is None:
-            return FlagActive.NEW
+        try:
+            return self.store.activity(self.name, self.DAYS_INACTIVE)
+        except KeyError:
+            raise FlagDoesNotExist()
 
-        diff = datetime.datetime.now() - used
-        if diff > datetime.timedelta(days=7):
-            return FlagActive.INACTIVE
+    @classmethod
+    def activity(cls, used):
+        """
+        Return the activity indicator matching a last used date.
+        """
 
-        return FlagActive.ACTIVE
+        return FlagActive.from_used(used, cls.DAYS_INACTIVE)
 
     @property
     def info(self):
@@ -147,7 +355,10 @@ class Flag(metaclass=abc.ABCMeta):
         interfaces.
         """
 
-        info = self.store.info(self.name)
+        try:
+            info = self.store.info(self.name)
+        except KeyError:
+            raise FlagDoesNotExist()
         return dict(
             name=info["name"],
             label=info["label"] or "",
@@ -162,10 +373,12 @@ class BinaryFlag(Flag):
     Implementation of a flag storing a boolean value.
     """
 
+    __slots__ = ()
+
     TYPE = FlagTypes.BINARY
 
     def _check(self):
-        return self.value
+        return self._evaluate(self.value)
 
     def set(self):
         """
@@ -180,3 +393,271 @@ class BinaryFlag(Flag):
         """
 
         self.value = False
+
+
+@implementer(IFlag)
+class PercentageFlag(Flag):
+    """
+    Implementation of a flag rolled out to a percentage of subjects (e.g.,
+    users), storing the percentage, from 0 to 100.
+
+    Subjects are hashed into buckets with a stable hash seeded with the flag
+    name, so a subject always gets the same result for the same percentage,
+    and raising the percentage only adds subjects. Evaluating the flag for a
+    subject costs no more storage calls than loading its value.
+    """
+
+    __slots__ = ("seed",)
+
+    TYPE = FlagTypes.PERCENTAGE
+
+    def __init__(self, name, store=DefaultStorage, lazy=False):
+        super().__init__(name, store=store, lazy=lazy)
+        self.seed = _hashing.seed(name)
+
+    def _check(self, context=None):
+        """
+        Returns whether the flag is active for the subject given as context
+        (an integer or string key, such as a user id). Without a subject,
+        the flag is only active when rolled out to everyone.
+        """
+
+        value = self.value
+        if context is None:
+            return self._evaluate(value)
+        if value is None:
+            return False
+        return _hashing.bucket(_hashing.subject_key(context), self.seed) < \
+            value * _hashing.BUCKETS / 100
+
+    @staticmethod
+    def _evaluate(value):
+        return value is not None and value >= 100
+
+    def check(self, subject):
+        """
+        Return whether the flag is active for the given subject.
+        """
+
+        return self._check(subject)
+
+    def evaluate_many(self, subjects):
+        """
+        Return whether the flag is active for each of the given subjects, with
+        a single storage call. Subjects are hashed and bucketed at once, so
+        pass them as an array (NumPy or array.array) of integer ids to evaluate
+        large batches fast. Returns a boolean array if NumPy is available, or
+        a list otherwise.
+        """
+
+        value = self.value
+        threshold = 0 if value is None else value * _hashing.BUCKETS / 100
+        keys = _hashing.subject_keys(subjects)
+        buckets = _hashing.bucket_many(keys, self.seed)
+        if _hashing.numpy is None:
+            return [bucket < threshold for bucket in buckets]
+        return buckets < threshold
+
+    def set(self, percentage):
+        """
+        Roll the flag out to the given percentage of subjects. Raises
+        ValueError if it's not a number from 0 to 100.
+        """
+
+        if not isinstance(percentage, numbers.Real) or \
+                isinstance(percentage, bool) or not 0 <= percentage <= 100:
+            raise ValueError(percentage)
+        self.value = percentage
+
+    def unset(self):
+        """
+        Shortcut method to roll the flag out to no subjects.
+        """
+
+        self.value = 0
+
+
+@implementer(IFlag)
+class RuleFlag(Flag):
+    """
+    Implementation of a flag targeting the contexts (e.g., request attributes)
+    matching its rules, storing them as JSON (see ensign._rules for their
+    format).
+
+    Rules are compiled into predicates once per version, so evaluating the
+    flag for a context costs no more storage calls than loading its value.
+    """
+
+    __slots__ = ()
+
+    TYPE = FlagTypes.RULES
+
+    def _check(self, context=None):
+        """
+        Returns whether the context, a mapping of attributes, matches the
+        flag's rules. Without a context, only rules without any conditions
+        match.
+        """
+
+        value = self.value
+        if context is None:
+            return self._evaluate(value)
+        return value is not None and compile_rules(value)(context)
+
+    @staticmethod
+    def _evaluate(value):
+        return value is not None and compile_rules(value)(_NO_CONTEXT)
+
+    def check(self, context):
+        """
+        Return whether the given context matches the flag's rules.
+        """
+
+        return self._check(context)
+
+    def evaluate_many(self, contexts):
+        """
+        Return whether each of the given contexts matches the flag's rules,
+        with a single storage call. Returns a boolean array if NumPy is
+        available, or a list otherwise.
+        """
+
+        value = self.value
+        if value is None:
+            return _hashing.booleans(False for _ in contexts)
+        return _hashing.booleans(map(compile_rules(value), contexts))
+
+    def set(self, rules):
+        """
+        Set the flag's rules, given as a list of rule mappings. Raises
+        RuleError if they are not valid.
+        """
+
+        self.value = dump_rules(rules)
+
+    def unset(self):
+        """
+        Shortcut method to remove all the flag's rules, so it matches nothing.
+        """
+
+        self.value = dump_rules([])
+
+
+# Flag class for every flag type, to handle flags whose type is only known
+# once they are read from the store.
+FLAG_CLASSES = {
+    FlagTypes.BINARY: BinaryFlag,
+    FlagTypes.PERCENTAGE: PercentageFlag,
+    FlagTypes.RULES: RuleFlag,
+}
+
+
+class FlagExpr:
+    """
+    Lazy boolean expression over flags, built by combining flags (or other
+    expressions) with the &, |, ^ and ~ operators.
+
+    Evaluating the expression short-circuits: `a & b` doesn't load `b` if `a`
+    is False. Alternatively, evaluate(batch=True) loads all the flags in the
+    expression upfront, with a single storage call per store and flag type.
+    Like flags, expressions can be used as decorators.
+    """
+
+    AND = "&"
+    OR = "|"
+    XOR = "^"
+    NOT = "~"
+
+    def __init__(self, operator, *operands):
+        self.operator = operator
+        self.operands = operands
+
+    def __str__(self):
+        if self.operator == self.NOT:
+            return f"~{self.operands[0]}"
+        return "(" + f" {self.operator} ".join(map(str, self.operands)) + ")"
+
+    def __bool__(self):
+        return self.evaluate()
+
+    def __and__(self, other):
+        return FlagExpr(self.AND, self, other)
+
+    def __or__(self, other):
+        return FlagExpr(self.OR, self, other)
+
+    def __xor__(self, other):
+        return FlagExpr(self.XOR, self, other)
+
+    def __invert__(self):
+        return FlagExpr(self.NOT, self)
+
+    def __call__(self, target=None, *, policy=EvalPolicy.CALL, ttl=5.0,
+                 fallback=None):
+        """
+        Decorate the target function, to run it only when the expression
+        evaluates to True. See Flag.__call__.
+        """
+
+        return _guarded(self, target, policy, ttl, fallback)
+
+    def _check(self):
+        return self.evaluate()
+
+    def _snapshots(self):
+        return tuple(current_snapshot(flag.store) for flag in self.flags())
+
+    def flags(self):
+        """
+        Return all the flags in the expression.
+        """
+
+        for operand in self.operands:
+            if isinstance(operand, FlagExpr):
+                yield from operand.flags()
+            else:
+                yield operand
+
+    def evaluate(self, batch=False):
+        """
+        Return the result of evaluating the expression. If `batch`, all the
+        flags are loaded upfront with as few storage calls as possible.
+        """
+
+        return self._evaluate(self._load_all() if batch else None)
+
+    def _load_all(self):
+        stores = {}
+        groups = collections.defaultdict(set)
+        for flag in self.flags():
+            stores[id(flag.store)] = flag.store
+            groups[(id(flag.store), type(flag))].add(flag.name)
+
+        values = {}
+        for (store, cls), names in groups.items():
+            loaded = cls.load_many(names, store=stores[store])
+            for name, value in loaded.items():
+                values[(store, cls, name)] = value
+        return values
+
+    def _evaluate(self, values):
+        operands = (
+            _evaluate_operand(operand, values)
+            for operand in self.operands
+        )
+        if self.operator == self.AND:
+            return all(operands)
+        if self.operator == self.OR:
+            return any(operands)
+        if self.operator == self.XOR:
+            return next(operands) ^ next(operands)
+        return not next(operands)
+
+
+def _evaluate_operand(operand, values):
+    # pylint: disable=protected-access
+    if isinstance(operand, FlagExpr):
+        return operand._evaluate(values)
+    if values is None:
+        return operand._check()
+    return values[(id(operand.store), type(operand), operand.name)]
@@ -0,0 +1,120 @@
+"""
+Hashing-related functions. Provides the deterministic bucketing of subjects
+(e.g., users) used by percentage rollouts.
+
+Subjects are hashed with a 64-bit mixing function (the splitmix64 finaliser)
+seeded with the flag name, so every flag splits subjects independently. The
+function only uses XOR, shifts and wrapping multiplications, so it can be
+computed over arrays of subjects at once: with NumPy, if available, as
+vectorised uint64 arithmetic; otherwise, in pure Python.
+"""
+
+import numbers
+import operator
+import zlib
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+BUCKETS = 10000
+MASK = 0xFFFFFFFFFFFFFFFF
+C1 = 0xBF58476D1CE4E5B9
+C2 = 0x94D049BB133111EB
+
+
+def seed(name):
+    """
+    Return the hashing seed for a flag, given its name.
+    """
+
+    return zlib.crc32(name.encode("utf-8"))
+
+
+def subject_key(subject):
+    """
+    Return the 64-bit integer key for a subject: integers (including NumPy
+    integer scalars) are used as they are, strings are reduced with CRC32.
+    """
+
+    if isinstance(subject, numbers.Integral):
+        return operator.index(subject) & MASK
+    if isinstance(subject, str):
+        subject = subject.encode("utf-8")
+    return zlib.crc32(subject)
+
+
+def bucket(key, flag_seed):
+    """
+    Return the bucket, from 0 to BUCKETS - 1, of a subject key.
+    """
+
+    h = key ^ flag_seed
+    h = ((h ^ (h >> 30)) * C1) & MASK
+    h = ((h ^ (h >> 27)) * C2) & MASK
+    h ^= h >> 31
+    return ((h >> 32) * BUCKETS) >> 32
+
+
+def _integers(subjects):
+    """
+    Return the subjects as a NumPy integer array, if they are an array (or
+    any object exporting the buffer protocol, such as array.array) of
+    integers. Otherwise, returns None.
+    """
+
+    if isinstance(subjects, numpy.ndarray):
+        array = subjects
+    else:
+        try:
+            array = numpy.asarray(memoryview(subjects))
+        except TypeError:
+            return None
+    return array if array.dtype.kind in "biu" else None
+
+
+def subject_keys(subjects):
+    """
+    Return the 64-bit integer keys for several subjects (see subject_key):
+    a uint64 array with NumPy, or a list otherwise. Integer arrays are
+    converted at once; any other subjects, one by one.
+    """
+
+    if numpy is None:
+        return [subject_key(subject) for subject in subjects]
+
+    array = _integers(subjects)
+    if array is None:
+        return numpy.fromiter(map(subject_key, subjects), numpy.uint64)
+    return array.astype(numpy.uint64)
+
+
+def bucket_many(keys, flag_seed):
+    """
+    Return the buckets of several subject keys (see subject_keys), as an
+    array with NumPy, or a list otherwise. Results match bucket()'s exactly.
+    """
+
+    if numpy is None:
+        return [bucket(key, flag_seed) for key in keys]
+
+    uint64 = numpy.uint64
+    with numpy.errstate(over="ignore"):
+        h = keys ^ uint64(flag_seed)
+        h = (h ^ (h >> uint64(30))) * uint64(C1)
+        h = (h ^ (h >> uint64(27))) * uint64(C2)
+        h ^= h >> uint64(31)
+        return ((h >> uint64(32)) * uint64(BUCKETS)) >> uint64(32)
+
+
+def booleans(values):
+    """
+    Return the given boolean values as an array with NumPy, or a list
+    otherwise.
+    """
+
+    if numpy is None:
+        return list(values)
+    return numpy.fromiter(values, bool)
@@ -39,25 +39,97 @@ class IStorage(Interface):
     Storage Interface.
 
     Any kind of backing storage for flags must implement this interface.
+    Single-flag operations raise KeyError when the flag doesn't exist.
     """
 
     def create(name, type, **kwargs):
         """Create a new flag."""
 
-    def exists(name):
-        """Check if the flag exists in the store."""
+    def create_many(flags, type):
+        """Create several new flags."""
+
+    def exists(name, type=None):
+        """Check if the flag exists in the store (with the given type)."""
+
+    def load(name, type):
+        """Load a value."""
+
+    def load_many(names, type):
+        """Load several values."""
+
+    def store(name, value, type):
+        """Store a value."""
+
+    def store_many(values, type):
+        """Store several values."""
+
+    def used(name):
+        """Get last used date."""
+
+    def activity(name, days):
+        """Get activity indicator."""
+
+    def activity_all(days):
+        """Get all flags' activity indicators."""
+
+    def info(name):
+        """Get flag descriptive information."""
+
+    def all():
+        """Get all flags."""
+
+    def info_all(names=None):
+        """Get all (or the given) flags' full information."""
+
+    def touch(names):
+        """Update several flags' last used date."""
+
+
+class IAsyncStorage(Interface):
+    """
+    Asynchronous Storage Interface.
+
+    Same operations as IStorage, all of them returning awaitables.
+    """
+
+    def create(name, type, **kwargs):
+        """Create a new flag."""
+
+    def create_many(flags, type):
+        """Create several new flags."""
+
+    def exists(name, type=None):
+        """Check if the flag exists in the store (with the given type)."""
 
     def load(name, type):
         """Load a value."""
 
+    def load_many(names, type):
+        """Load several values."""
+
     def store(name, value, type):
         """Store a value."""
 
+    def store_many(values, type):
+        """Store several values."""
+
     def used(name):
         """Get last used date."""
 
+    def activity(name, days):
+        """Get activity indicator."""
+
+    def activity_all(days):
+        """Get all flags' activity indicators."""
+
     def info(name):
         """Get flag descriptive information."""
 
     def all():
         """Get all flags."""
+
+    def info_all(names=None):
+        """Get all (or the given) flags' full information."""
+
+    def touch(names):
+        """Update several flags' last used date."""
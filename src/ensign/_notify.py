@@ -0,0 +1,187 @@
+"""
+Change notification-related classes. Provides channels to broadcast flag
+changes between processes, and a listener to invalidate cached flags when they
+change.
+"""
+
+import queue
+import select
+import threading
+
+import sqlalchemy as sa
+
+
+class LocalChannel:
+    """
+    In-process notification channel. Stand-in for PGChannel in tests and
+    single-process deployments.
+    """
+
+    def __init__(self):
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def notify(self, connection, name):
+        """
+        Broadcast a change to the given flag to all subscribers.
+        """
+        # pylint: disable=unused-argument
+
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.put(name)
+
+    def subscribe(self):
+        """
+        Return a new subscription to this channel.
+        """
+
+        subscription = _LocalSubscription(self)
+        with self.lock:
+            self.subscribers.append(subscription.queue)
+        return subscription
+
+
+class _LocalSubscription:
+    def __init__(self, channel):
+        self.channel = channel
+        self.queue = queue.Queue()
+
+    def get(self, timeout):
+        """
+        Wait up to `timeout` seconds for changes, and return the names of all
+        flags changed.
+        """
+
+        try:
+            names = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                names.append(self.queue.get_nowait())
+            except queue.Empty:
+                return names
+
+    def close(self):
+        """
+        Stop receiving changes.
+        """
+
+        with self.channel.lock:
+            self.channel.subscribers.remove(self.queue)
+
+
+class PGChannel:
+    """
+    Notification channel backed by PostgreSQL's LISTEN/NOTIFY.
+    Notifications are sent on the connection performing the change, so they
+    are only delivered once its transaction commits.
+    """
+
+    def __init__(self, engine, channel="ensign_flags"):
+        self.engine = engine
+        self.channel = channel
+
+    def notify(self, connection, name):
+        """
+        Broadcast a change to the given flag to all listening processes.
+        """
+
+        connection.execute(sa.select([sa.func.pg_notify(self.channel, name)]))
+
+    def subscribe(self):
+        """
+        Return a new subscription to this channel, holding its own dedicated
+        database connection.
+        """
+
+        return _PGSubscription(self.engine.raw_connection(), self.channel)
+
+
+class _PGSubscription:
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.dbapi = connection.connection
+        self.dbapi.set_isolation_level(0)  # Autocommit.
+        quoted = channel.replace('"', '""')
+        cursor = self.dbapi.cursor()
+        cursor.execute(f'LISTEN "{quoted}"')
+        cursor.close()
+
+    def get(self, timeout):
+        """
+        Wait up to `timeout` seconds for changes, and return the names of all
+        flags changed.
+        """
+
+        if select.select([self.dbapi], [], [], timeout) == ([], [], []):
+            return []
+        self.dbapi.poll()
+        names = [notify.payload for notify in self.dbapi.notifies]
+        del self.dbapi.notifies[:]
+        return names
+
+    def close(self):
+        """
+        Stop receiving changes and release the connection.
+        """
+
+        self.connection.invalidate()
+
+
+class InvalidationListener:
+    """
+    Background listener evicting flags from a cache as soon as a change to
+    them is broadcast through the given channel.
+
+    If the subscription fails, the whole cache is dropped (as changes may have
+    been missed) and the listener subscribes again.
+    """
+
+    def __init__(self, channel, cache, interval=1.0):
+        self.channel = channel
+        self.cache = cache
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start listening for changes.
+        """
+
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run,
+            name="ensign-listener",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop listening for changes.
+        """
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                subscription = self.channel.subscribe()
+            except Exception:  # pylint: disable=broad-except
+                self.stopped.wait(self.interval)
+                continue
+
+            try:
+                while not self.stopped.is_set():
+                    for name in subscription.get(self.interval):
+                        self.cache.invalidate(name)
+            except Exception:  # pylint: disable=broad-except
+                self.cache.invalidate()
+            finally:
+                subscription.close()
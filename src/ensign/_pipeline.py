@@ -0,0 +1,163 @@
+"""
+Bulk evaluation-related functions. Provides a pipeline evaluating flags for
+every subject in a large file, over a pool of processes.
+
+Subjects are read as ndjson (a JSON object per line) or CSV (with a header,
+and a record per line), and identified by one of their attributes, the key:
+percentage flags are evaluated for the key, and rule flags against the whole
+record. Attributes can be converted by column (CSV values are always read as
+strings), so rules comparing numbers match. Results are written in the same
+format and order: the subject's key, and whether each flag is active for it.
+"""
+
+import collections
+import csv
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+
+from ensign._filestorage import FileStorage, export_snapshot
+from ensign._flags import FLAG_CLASSES, FlagDoesNotExist, PercentageFlag
+from ensign._storage import DefaultStorage
+
+
+FORMATS = ("ndjson", "csv")
+
+_evaluator = None
+
+
+class _Evaluator:
+    """
+    Evaluates chunks of subject lines, in a worker process, against the flags
+    in a snapshot file.
+    """
+    # pylint: disable=too-few-public-methods,too-many-arguments
+
+    def __init__(self, path, names, fmt, key, types, header):
+        store = FileStorage(path)
+        self.flags = [
+            FLAG_CLASSES[store.info(name).type](name, store=store)
+            for name in names
+        ]
+        self.fields = [key] + list(names)
+        self.fmt = fmt
+        self.key = key
+        self.types = types
+        self.header = header
+
+    def _parse(self, lines):
+        if self.fmt == "csv":
+            records = [
+                dict(zip(self.header, row))
+                for row in csv.reader(lines)
+                if row
+            ]
+        else:
+            records = [json.loads(line) for line in lines if line.strip()]
+
+        for record in records:
+            for column, convert in self.types.items():
+                if column in record:
+                    record[column] = convert(record[column])
+        return records
+
+    def __call__(self, lines):
+        records = self._parse(lines)
+        keys = [record[self.key] for record in records]
+
+        columns = [
+            flag.evaluate_many(
+                keys if isinstance(flag, PercentageFlag) else records,
+            )
+            for flag in self.flags
+        ]
+
+        output = io.StringIO()
+        if self.fmt == "csv":
+            csv.writer(output, lineterminator="\n").writerows(
+                [key] + ["true" if result else "false" for result in results]
+                for key, *results in zip(keys, *columns)
+            )
+        else:
+            for key, *results in zip(keys, *columns):
+                row = dict(zip(self.fields, [key] + list(map(bool, results))))
+                output.write(json.dumps(row, separators=(",", ":")))
+                output.write("\n")
+        return len(records), output.getvalue()
+
+
+def _init_worker(*args):
+    global _evaluator  # pylint: disable=global-statement
+    _evaluator = _Evaluator(*args)
+
+
+def _evaluate_chunk(lines):
+    return _evaluator(lines)
+
+
+def _write(output, pending):
+    count, text = pending.get()
+    output.write(text)
+    return count
+
+
+def evaluate_subjects(source, output, names, store=DefaultStorage,
+                      fmt="ndjson", key="id", key_type=None, processes=None,
+                      chunk_size=10000, max_pending=None, column_types=None):
+    """
+    Evaluate the given flags for every subject read from the `source` text
+    file, writing the results to `output` as they are produced. Returns the
+    number of subjects evaluated. As CSV values are always read as strings,
+    subjects' attributes can be converted: their keys with `key_type` (e.g.,
+    int), and any other attributes with `column_types`, a mapping of
+    attribute names to conversions (e.g., {"age": int}).
+
+    The flags are read from the store with a single query, and shipped to
+    the worker processes as a snapshot file (see FileStorage), so they share
+    it through the page cache. Workers parse and evaluate chunks of
+    `chunk_size` lines, with at most `max_pending` chunks (by default, twice
+    as many as processes) in flight: reading waits for the oldest chunk to be
+    written, so memory use is bounded however large the file is.
+    """
+    # pylint: disable=too-many-arguments,too-many-locals
+
+    if fmt not in FORMATS:
+        raise ValueError(fmt)
+    names = list(names)
+    processes = processes or os.cpu_count()
+    max_pending = max_pending or 2 * processes
+    types = dict(column_types or {})
+    if key_type is not None:
+        types[key] = key_type
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "flags.snapshot")
+        export_snapshot(store, path, names)
+        missing = set(names) - set(FileStorage(path).all())
+        if missing:
+            raise FlagDoesNotExist(", ".join(sorted(missing)))
+
+        header = None
+        if fmt == "csv":
+            header = next(csv.reader([source.readline()]), [])
+            csv.writer(output, lineterminator="\n").writerow([key] + names)
+
+        count = 0
+        pending = collections.deque()
+        initargs = (path, names, fmt, key, types, header)
+        with multiprocessing.Pool(processes, _init_worker, initargs) as pool:
+            chunks = iter(
+                lambda: list(itertools.islice(source, chunk_size)),
+                [],
+            )
+            for chunk in chunks:
+                if len(pending) >= max_pending:
+                    count += _write(output, pending.popleft())
+                pending.append(pool.apply_async(_evaluate_chunk, (chunk,)))
+            while pending:
+                count += _write(output, pending.popleft())
+
+    return count
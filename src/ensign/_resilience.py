@@ -0,0 +1,301 @@
+"""
+Resilience-related classes. Provides a circuit breaker, and a storage layer
+that keeps serving flag evaluations while the wrapped storage is failing.
+"""
+
+import itertools
+import threading
+import time
+
+from zope.interface import implementer
+
+from ensign._interfaces import IStorage
+
+
+class StorageUnavailable(Exception):
+    """
+    Exception raised when the storage is failing, and there is no last known
+    value or default to fall back to.
+    """
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker, opening after `failures` consecutive failed (or slower
+    than `slow` seconds) calls. Once open, calls are rejected for `reset`
+    seconds; then a single trial call is let through, closing the breaker
+    again if it succeeds.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failures=5, slow=None, reset=30.0):
+        self.failures = failures
+        self.slow = slow
+        self.reset = reset
+        self.state = self.CLOSED
+        self.count = 0
+        self.opened = 0.0
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Check whether a call can go through.
+        """
+
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() - self.opened >= self.reset:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self, elapsed):
+        """
+        Record a successful call, which took `elapsed` seconds.
+        """
+
+        if self.slow is not None and elapsed > self.slow:
+            self.failure()
+            return
+
+        with self.lock:
+            self.state = self.CLOSED
+            self.count = 0
+
+    def failure(self):
+        """
+        Record a failed call.
+        """
+
+        with self.lock:
+            self.count += 1
+            if self.state == self.HALF_OPEN or self.count >= self.failures:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened = time.monotonic()
+
+
+@implementer(IStorage)
+class ResilientStorage:
+    """
+    Storage layer guarding another storage with a circuit breaker.
+
+    While the wrapped storage fails (or the breaker is open), flag values are
+    served from the last (non-null) values successfully loaded or, failing
+    that, from the defaults declared when creating the flags (see
+    Flag.create). Writes are never served from memory, and raise
+    StorageUnavailable instead.
+
+    Defaults are learnt from flags created through this storage, and from
+    flag information read through it (see warm()).
+    """
+
+    def __init__(self, backend, breaker=None):
+        self.backend = backend
+        self.breaker = breaker or CircuitBreaker()
+        self.values = {}
+        self.defaults = {}
+        self.fallbacks = 0
+        self.errors = 0
+
+    def stats(self):
+        """
+        Return the storage metrics: breaker trips, failed calls, and values
+        served from memory.
+        """
+
+        return dict(
+            state=self.breaker.state,
+            trips=self.breaker.trips,
+            errors=self.errors,
+            fallbacks=self.fallbacks,
+        )
+
+    def _call(self, method, *args, **kwargs):
+        if not self.breaker.allow():
+            raise StorageUnavailable()
+
+        start = time.monotonic()
+        try:
+            result = method(*args, **kwargs)
+        except KeyError:
+            self.breaker.success(time.monotonic() - start)
+            raise
+        except Exception as exc:
+            self.errors += 1
+            self.breaker.failure()
+            raise StorageUnavailable() from exc
+
+        self.breaker.success(time.monotonic() - start)
+        return result
+
+    def _fallback(self, name, flagtype):
+        for known in (self.values, self.defaults):
+            value = known.get((name, flagtype))
+            if value is not None:
+                self.fallbacks += 1
+                return value
+        raise StorageUnavailable(name)
+
+    def _learn(self, info):
+        keys = info.keys()
+        if "type" not in keys:
+            return
+        field = f"default_{info['type'].value}"
+        if field in keys and info[field] is not None:
+            self.defaults[(info["name"], info["type"])] = info[field]
+
+    def warm(self):
+        """
+        Read all flags' information, to learn their values and defaults.
+        """
+
+        for info in self.info_all():
+            self.values[(info["name"], info["type"])] = \
+                info[f"value_{info['type'].value}"]
+
+    def create(self, name, flagtype, **kwargs):
+        """
+        Create a new flag in the wrapped storage.
+        """
+
+        self._call(self.backend.create, name, flagtype, **kwargs)
+        self._learn(dict(kwargs, name=name, type=flagtype))
+
+    def create_many(self, flags, flagtype):
+        """
+        Create several new flags in the wrapped storage.
+        """
+
+        flags = list(flags)
+        self._call(self.backend.create_many, flags, flagtype)
+        for flag in flags:
+            self._learn(dict(flag, type=flagtype))
+
+    def exists(self, name, flagtype=None):
+        """
+        Check if the flag exists (with the given type), assuming it does if
+        its value is known.
+        """
+
+        try:
+            return self._call(self.backend.exists, name, flagtype)
+        except StorageUnavailable:
+            known = itertools.chain(self.values, self.defaults)
+            if any(key[0] == name and flagtype in (None, key[1])
+                   for key in known):
+                self.fallbacks += 1
+                return True
+            raise
+
+    def load(self, name, flagtype):
+        """
+        Load a flag's value, falling back to its last known value or default.
+        """
+
+        try:
+            value = self._call(self.backend.load, name, flagtype)
+        except StorageUnavailable:
+            return self._fallback(name, flagtype)
+
+        self.values[(name, flagtype)] = value
+        return value
+
+    def load_many(self, names, flagtype):
+        """
+        Load several flags' values, falling back to their last known values or
+        defaults.
+        """
+
+        names = list(names)
+        try:
+            values = self._call(self.backend.load_many, names, flagtype)
+        except StorageUnavailable:
+            return {name: self._fallback(name, flagtype) for name in names}
+
+        for name, value in values.items():
+            self.values[(name, flagtype)] = value
+        return values
+
+    def store(self, name, value, flagtype):
+        """
+        Store a flag's value in the wrapped storage.
+        """
+
+        self._call(self.backend.store, name, value, flagtype)
+        self.values[(name, flagtype)] = value
+
+    def store_many(self, values, flagtype):
+        """
+        Store several flags' values in the wrapped storage.
+        """
+
+        values = dict(values)
+        self._call(self.backend.store_many, values, flagtype)
+        for name, value in values.items():
+            self.values[(name, flagtype)] = value
+
+    def used(self, name):
+        """
+        Return a flag's last used date.
+        """
+
+        return self._call(self.backend.used, name)
+
+    def activity(self, name, days):
+        """
+        Return a flag's activity indicator.
+        """
+
+        return self._call(self.backend.activity, name, days)
+
+    def activity_all(self, days):
+        """
+        Return all flags' activity indicators.
+        """
+
+        return self._call(self.backend.activity_all, days)
+
+    def info(self, name):
+        """
+        Return a flag's full information.
+        """
+
+        info = self._call(self.backend.info, name)
+        self._learn(info)
+        return info
+
+    def all(self):
+        """
+        Return all flags.
+        """
+
+        return self._call(self.backend.all)
+
+    def info_all(self, names=None):
+        """
+        Return all (or the given) flags' full information.
+        """
+
+        infos = self._call(self.backend.info_all, names)
+        for info in infos:
+            self._learn(info)
+        return infos
+
+    def touch(self, names):
+        """
+        Update several flags' last used date. Skipped while failing, as it's
+        not essential.
+        """
+
+        try:
+            self._call(self.backend.touch, names)
+        except StorageUnavailable:
+            pass
@@ -0,0 +1,175 @@
+"""
+Rule-related functions. Provides the compilation of targeting rules into
+predicates over evaluation contexts.
+
+Rules are stored as JSON: a list of rules, matching when any of them does.
+Each rule maps context attributes to conditions, matching when all of them
+do; each condition maps an operator to its operand:
+
+    [
+        {"country": {"in": ["ES", "PT"]}, "version": {"version_gte": "2.1"}},
+        {"account": {"in": [1, 2, 3]}}
+    ]
+
+Operators:
+ - in, not_in: Membership in a list of values.
+ - eq, ne, lt, lte, gt, gte: Comparison with a value.
+ - version_eq, version_ne, version_lt, version_lte, version_gt, version_gte:
+   Comparison of dotted version numbers ("2.10" > "2.9").
+A condition on an attribute missing from the context (or not comparable to
+the operand) doesn't match, but for ne and not_in.
+"""
+
+import functools
+import json
+import operator
+
+
+_COMPARISONS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+}
+
+
+class RuleError(ValueError):
+    """
+    Exception raised when rules are not valid.
+    """
+
+
+def _version(value):
+    return tuple(int(part) for part in str(value).split("."))
+
+
+def _membership(attribute, values, negate):
+    try:
+        values = frozenset(values)
+    except TypeError:
+        raise RuleError(f"{attribute}: Values must be a list of scalars")
+
+    if negate:
+        def condition(context):
+            try:
+                return context.get(attribute) not in values
+            except TypeError:
+                return True
+    else:
+        def condition(context):
+            try:
+                return context.get(attribute) in values
+            except TypeError:
+                return False
+
+    return condition
+
+
+def _comparison(attribute, compare, operand):
+    def condition(context):
+        value = context.get(attribute)
+        if value is None:
+            return compare is operator.ne
+        try:
+            return compare(value, operand)
+        except TypeError:
+            return False
+
+    return condition
+
+
+def _version_comparison(attribute, compare, operand):
+    try:
+        operand = _version(operand)
+    except ValueError:
+        raise RuleError(f"{attribute}: Invalid version {operand!r}")
+
+    def condition(context):
+        value = context.get(attribute)
+        if value is None:
+            return compare is operator.ne
+        try:
+            return compare(_version(value), operand)
+        except ValueError:
+            return False
+
+    return condition
+
+
+def _condition(attribute, op, operand):
+    if op in ("in", "not_in"):
+        if not isinstance(operand, list):
+            raise RuleError(f"{attribute}: Values must be a list")
+        return _membership(attribute, operand, op == "not_in")
+    if op in _COMPARISONS:
+        return _comparison(attribute, _COMPARISONS[op], operand)
+    if op.startswith("version_") and op[8:] in _COMPARISONS:
+        return _version_comparison(attribute, _COMPARISONS[op[8:]], operand)
+    raise RuleError(f"{attribute}: Unknown operator {op!r}")
+
+
+def _rule(rule):
+    if not isinstance(rule, dict):
+        raise RuleError("Rules must be objects")
+
+    conditions = []
+    for attribute, condition in rule.items():
+        if not isinstance(condition, dict):
+            raise RuleError(f"{attribute}: Conditions must be objects")
+        for op, operand in condition.items():
+            conditions.append(_condition(attribute, op, operand))
+
+    if not conditions:
+        return lambda context: True
+    if len(conditions) == 1:
+        return conditions[0]
+
+    conditions = tuple(conditions)
+
+    def match(context):
+        for condition in conditions:
+            if not condition(context):
+                return False
+        return True
+
+    return match
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_rules(text):
+    """
+    Compile rules, given as JSON text, into a predicate taking a context
+    mapping. Compiled predicates are cached by text, so every version of a
+    flag's rules is only compiled once.
+    """
+
+    try:
+        rules = json.loads(text)
+    except ValueError:
+        raise RuleError("Rules must be valid JSON")
+    if not isinstance(rules, list):
+        raise RuleError("Rules must be a list")
+
+    rules = tuple(_rule(rule) for rule in rules)
+    if len(rules) == 1:
+        return rules[0]
+
+    def predicate(context):
+        for rule in rules:
+            if rule(context):
+                return True
+        return False
+
+    return predicate
+
+
+def dump_rules(rules):
+    """
+    Return the JSON text for the given rules, making sure they are valid.
+    """
+
+    text = json.dumps(rules, sort_keys=True, separators=(",", ":"))
+    compile_rules(text)
+    return text
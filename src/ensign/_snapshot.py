@@ -0,0 +1,107 @@
+"""
+Snapshot-related classes. Provides consistent, in-memory views of the flags in
+a store, to evaluate many flags with a single query.
+"""
+
+import threading
+
+from ensign._storage import DefaultStorage
+
+
+_local = threading.local()
+
+
+def current_snapshot(store):
+    """
+    Return the innermost snapshot of the given store active in the current
+    thread, if any.
+    """
+
+    snapshots = getattr(_local, "snapshots", None)
+    if not snapshots:
+        return None
+    for snapshot in reversed(snapshots):
+        if snapshot.store is store:
+            return snapshot
+    return None
+
+
+class FlagSnapshot:
+    """
+    Immutable view of all the flags in a store (or only the given ones), taken
+    with a single query.
+
+    Used as a context manager, every flag of the same store evaluated by the
+    current thread within the block is served from the snapshot, so reads are
+    consistent and cost no queries. Flags outside a partial snapshot fall back
+    to the store. The last used dates of all flags evaluated are updated at
+    once when the block finishes. Results of functions decorated with the
+    snapshot evaluation policy are kept in `results` while it lives.
+    """
+
+    def __init__(self, store=DefaultStorage, names=None):
+        self.store = store
+        self.complete = names is None
+        self.rows = {row["name"]: row for row in store.info_all(names)}
+        self.evaluated = set()
+        self.results = {}
+
+    def __enter__(self):
+        if not hasattr(_local, "snapshots"):
+            _local.snapshots = []
+        _local.snapshots.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _local.snapshots.remove(self)
+        if self.evaluated:
+            self.store.touch(self.evaluated)
+            self.evaluated = set()
+
+    def exists(self, name, flagtype=None):
+        """
+        Check if the flag exists in the snapshot (with the given type).
+        """
+
+        row = self.rows.get(name)
+        if row is not None:
+            return flagtype is None or row["type"] == flagtype
+        if self.complete:
+            return False
+        return self.store.exists(name, flagtype)
+
+    def load(self, name, flagtype):
+        """
+        Load a flag's value from the snapshot. Raises KeyError if the flag
+        doesn't exist.
+        """
+
+        row = self.rows.get(name)
+        if row is None:
+            if self.complete:
+                raise KeyError(name)
+            return self.store.load(name, flagtype)
+
+        self.evaluated.add(name)
+        return row[f"value_{flagtype.value}"]
+
+    def load_many(self, names, flagtype):
+        """
+        Load several flags' values from the snapshot. Returns a mapping of
+        names to values, leaving out inexisting flags.
+        """
+
+        field = f"value_{flagtype.value}"
+        values = {}
+        missing = []
+        for name in names:
+            row = self.rows.get(name)
+            if row is None:
+                missing.append(name)
+            else:
+                self.evaluated.add(name)
+                values[name] = row[field]
+
+        if missing and not self.complete:
+            values.update(self.store.load_many(missing, flagtype))
+        return values
@@ -3,13 +3,28 @@ Storage-related classes. Provides a default storage, backed by a SQL database.
 """
 # pylint: disable=invalid-name,no-value-for-parameter
 
+import atexit
+import collections
+import contextlib
+import datetime
 import enum
+import itertools
+import logging
+import numbers
 import os
+import sys
+import threading
 
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
 from zope.interface import implementer
 
 from ensign._interfaces import IStorage
+from ensign._notify import PGChannel
+
+
+logger = logging.getLogger(__name__)
 
 
 class FlagTypes(enum.Enum):
@@ -18,16 +33,410 @@ class FlagTypes(enum.Enum):
     """
 
     BINARY = "binary"
+    PERCENTAGE = "percentage"
+    RULES = "rules"
+
+
+class FlagActive(enum.Enum):
+    """
+    Possible values for a flag activity indicator:
+     - Inactive: Flag has not been used in DAYS_INACTIVE (see Flag class).
+     - Active: Flag has been used recently.
+     - New: Flag has never been used.
+    """
+
+    INACTIVE = 0
+    ACTIVE = 1
+    NEW = 2
+
+    @classmethod
+    def from_used(cls, used, days=7, now=None):
+        """
+        Return the activity indicator matching a last used date, given the
+        number of days without use after which a flag is inactive.
+        """
+
+        if used is None:
+            return cls.NEW
+        if (now or datetime.datetime.now()) - used > \
+                datetime.timedelta(days=days):
+            return cls.INACTIVE
+        return cls.ACTIVE
+
+
+DAYS_INACTIVE = 7
+
+
+def _days_by_type(days):
+    """
+    Return a mapping of every flag type to its inactivity period, given
+    either a period for all types, or a mapping of some types to theirs.
+    """
+
+    if isinstance(days, numbers.Real):
+        return dict.fromkeys(FlagTypes, days)
+    return {
+        flagtype: days.get(flagtype, DAYS_INACTIVE)
+        for flagtype in FlagTypes
+    }
+
+
+class FlagRecord(collections.namedtuple("FlagRecord", [
+        "name", "type", "value_binary", "default_binary",
+        "value_percentage", "default_percentage",
+        "value_rules", "default_rules",
+        "label", "description", "tags", "used", "version",
+])):
+    """
+    Immutable record of a flag's stored information, as returned by storages'
+    info() and info_all(). Fields can also be read by name, like in a mapping
+    (`record["label"]`). Names are interned, so all records and handles of a
+    flag can share a single string.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Build a record from a sequence of values, in the fields' order.
+        """
+
+        return cls(sys.intern(row[0]), *row[1:])
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """
+        Build a record from a mapping, missing fields being None.
+        """
+
+        return cls.from_row([mapping.get(field) for field in cls._fields])
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key not in _RECORD_FIELDS:
+                raise KeyError(key)
+            return getattr(self, key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        """
+        Return a field's value by name, or `default` if there's no such field.
+        """
+
+        return getattr(self, key) if key in _RECORD_FIELDS else default
+
+    def keys(self):
+        """
+        Return the fields' names.
+        """
+
+        return self._fields
+
+
+_RECORD_FIELDS = frozenset(FlagRecord._fields)
+
+
+class UsageBuffer:
+    """
+    Write-behind buffer for flags' last used dates.
+
+    Uses are recorded in memory, coalesced by flag name, and handed over in
+    bulk to the flush callable every `interval` seconds, or as soon as
+    `maxsize` different flags are pending. Uses failing to be flushed are
+    kept pending, to be retried with the next batch.
+    """
+
+    def __init__(self, flush, interval=5.0, maxsize=1024):
+        self.flush_callback = flush
+        self.interval = interval
+        self.maxsize = maxsize
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Start the background flusher.
+        """
+
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run,
+            name="ensign-usage",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background flusher, flushing whatever is still pending.
+        """
+
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def record(self, name, when=None):
+        """
+        Record a use of the given flag.
+        """
+
+        with self.lock:
+            self.pending[name] = when or datetime.datetime.now()
+            full = len(self.pending) >= self.maxsize
+        if full:
+            self.wakeup.set()
+
+    def get(self, name):
+        """
+        Return the pending last used date for a flag, if any.
+        """
+
+        return self.pending.get(name)
+
+    def flush(self):
+        """
+        Hand all pending uses over to the flush callable. If it fails, the
+        uses are put back (unless the flags have been used again since).
+        """
+
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+
+        try:
+            self.flush_callback(pending)
+        except Exception:
+            with self.lock:
+                for name, when in pending.items():
+                    self.pending.setdefault(name, when)
+            raise
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to write flags usage, will retry")
+
+
+_POSTGRESQL = ("postgresql", "postgres")
+_COMPILED_CACHE_SIZE = 256
+
+
+def _split_tags(tags):
+    """
+    Return the distinct tags in a comma-separated list.
+    """
+
+    return sorted({tag.strip() for tag in (tags or "").split(",")} - {""})
+
+
+def _days_params(days):
+    """
+    Return the parameters for the inactivity periods bound by _Queries'
+    activity expression, given `days` as taken by _days_by_type().
+    """
+
+    return {
+        f"b_days_{flagtype.value}": float(period)
+        for flagtype, period in _days_by_type(days).items()
+    }
+
+
+class _DaysAgo(sa.sql.expression.FunctionElement):
+    """
+    SQL expression for the database's current date and time, minus a
+    (possibly fractional) number of days. Being evaluated by the database, it
+    can be built once, and agrees with the last used dates set by touch().
+    """
+    # pylint: disable=too-many-ancestors
+
+    type = sa.DateTime()
+    name = "days_ago"
+    inherit_cache = True
+
+
+@compiles(_DaysAgo)
+def _compile_days_ago(element, compiler, **kwargs):
+    days = compiler.process(element.clauses, **kwargs)
+    return f"CURRENT_TIMESTAMP - ({days}) * INTERVAL '1' DAY"
+
+
+@compiles(_DaysAgo, "sqlite")
+def _compile_days_ago_sqlite(element, compiler, **kwargs):
+    days = compiler.process(element.clauses, **kwargs)
+    return f"datetime('now', '-' || ({days}) || ' days')"
+
+
+def _boolean(value):
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+def _ping(dbapi_connection, connection_record, connection_proxy):
+    """
+    Pool checkout hook, making sure a connection is alive before handing it
+    out. A dead connection is discarded, and the pool retries with a new one.
+    """
+    # pylint: disable=unused-argument
+
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:  # pylint: disable=broad-except
+        raise sa.exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+# Columns making up a flag's definition, as imported and exported: all but its
+# id and its usage data.
+_DEFINITION = ("type",) + tuple(
+    f"{field}_{flagtype.value}"
+    for flagtype in FlagTypes
+    for field in ("value", "default")
+) + ("label", "description", "tags")
+
+
+class _Queries:
+    """
+    Statements for single-flag operations, built once per table with bound
+    parameters, so they can be reused (and their compiled form cached) by
+    every call. Parameters are named `b_*`, as column names are reserved for
+    UPDATE statements.
+    """
+
+    def __init__(self, table):
+        name = table.c.name == sa.bindparam("b_name")
+
+        def by_type(build):
+            return {
+                flagtype: build(table.c.get(f"value_{flagtype.value}"))
+                for flagtype in FlagTypes
+            }
+
+        used = table.c.used
+        period = sa.case([
+            (
+                table.c.type == flagtype,
+                sa.bindparam(f"b_days_{flagtype.value}", type_=sa.Float),
+            )
+            for flagtype in FlagTypes
+        ])
+        self.activity_of = sa.case(
+            [
+                (used.is_(None), FlagActive.NEW.value),
+                (used < _DaysAgo(period), FlagActive.INACTIVE.value),
+            ],
+            else_=FlagActive.ACTIVE.value,
+        )
+
+        self.exists = sa.select([sa.exists().where(name)])
+        self.exists_type = sa.select([sa.exists().where(
+            sa.and_(name, table.c.type == sa.bindparam("b_type")),
+        )])
+        self.load = by_type(lambda field: sa.select([field]).where(name))
+        self.store = by_type(lambda field: table.update().where(name).values(
+            {field: sa.bindparam("b_value"), "version": table.c.version + 1},
+        ))
+        self.replace = table.update().where(name).values(dict(
+            {column: sa.bindparam(f"b_{column}") for column in _DEFINITION},
+            version=table.c.version + 1,
+        ))
+        # Inserts a placeholder (at version 0) for a flag, unless it exists,
+        # for `replace` to fill in.
+        self.reserve = table.insert().from_select(
+            [table.c.name, table.c.type, table.c.version],
+            sa.select([
+                sa.bindparam("b_name", type_=table.c.name.type),
+                sa.bindparam("b_type", type_=table.c.type.type),
+                sa.literal(0),
+            ]).where(~sa.exists().where(name)),
+        )
+        self.touch = table.update().where(name).values(used=sa.func.now())
+        self.used = sa.select([table.c.used]).where(name)
+        record = [table.c.get(field) for field in FlagRecord._fields]
+        self.info = sa.select(record).where(name)
+        self.all = sa.select([table.c.name])
+        self.info_all = sa.select(record).order_by(table.c.name)
+        self.info_activity = sa.select(record + [self.activity_of]).\
+            order_by(table.c.name)
+        self.activity = sa.select([self.activity_of]).where(name)
+        self.activity_all = sa.select([table.c.name, self.activity_of])
+        self.version = sa.select([table.c.version, self.activity_of]).\
+            where(name)
+        self.page = sa.select([
+            table.c.id,
+            table.c.version,
+            self.activity_of.label("activity"),
+        ])
+        self.version_all = self.summary(self.page)
+
+    @staticmethod
+    def summary(query):
+        """
+        Return a statement summarizing the flags selected by a query on their
+        ids, versions and activity indicators (see SQLStorage.version_all).
+        """
+
+        page = query.alias("page")
+
+        def count(indicator):
+            return sa.func.sum(
+                sa.case([(page.c.activity == indicator.value, 1)], else_=0),
+            )
+
+        return sa.select([
+            sa.func.count(),
+            sa.func.sum(page.c.version),
+            sa.func.max(page.c.id),
+            count(FlagActive.NEW),
+            count(FlagActive.INACTIVE),
+            sa.func.sum(sa.case(
+                [(page.c.activity == FlagActive.INACTIVE.value, page.c.id)],
+                else_=0,
+            )),
+        ]).select_from(page)
+
+
+# Sets PostgreSQL's statement timeout for the current transaction only.
+_SET_STATEMENT_TIMEOUT = sa.select([
+    sa.func.set_config("statement_timeout", sa.bindparam("b_timeout"), True),
+])
 
 
 @implementer(IStorage)
 class SQLStorage:
     """
     SQL-backed flag storage.
+
+    Every operation checks a connection out of the engine's pool, unless the
+    current thread is within a session(). Changes made through create() and
+    store() are broadcast through `channel`, if set (see FLAGS_NOTIFY), so
+    other processes can drop cached values.
+
+    Single-flag operations run prebuilt statements (see `queries`), compiled
+    once per engine through its compiled cache. Statements depending on the
+    number of flags involved are still built per call.
+
+    On PostgreSQL, flag evaluation (exists(), load() and load_many()) can be
+    bounded by `statement_timeout` milliseconds, set for its own transaction
+    only: schema changes, bulk writes and listings are never cancelled.
     """
 
     engine = None
-    connection = None
+    usage = None
+    statement_timeout = None
+    channel = None
     metadata = sa.MetaData()
 
     flags = sa.Table(
@@ -37,27 +446,319 @@ class SQLStorage:
         sa.Column("type", sa.Enum(FlagTypes), nullable=False),
 
         sa.Column("value_binary", sa.Boolean),
+        sa.Column("default_binary", sa.Boolean),
+
+        sa.Column("value_percentage", sa.Float),
+        sa.Column("default_percentage", sa.Float),
+
+        sa.Column("value_rules", sa.UnicodeText),
+        sa.Column("default_rules", sa.UnicodeText),
 
         sa.Column("label", sa.Unicode(256)),
         sa.Column("description", sa.UnicodeText),
         sa.Column("tags", sa.UnicodeText),
-        sa.Column("used", sa.DateTime),
+        sa.Column("used", sa.DateTime, index=True),
+        sa.Column(
+            "version",
+            sa.Integer,
+            nullable=False,
+            default=1,
+            server_default="1",
+        ),
+    )
+    flag_tags = sa.Table(
+        "flag_tags", metadata,
+        sa.Column(
+            "flag_id",
+            sa.Integer,
+            sa.ForeignKey("flags.id", ondelete="CASCADE"),
+            primary_key=True,
+        ),
+        sa.Column("tag", sa.Unicode(256), primary_key=True, index=True),
     )
+    queries = _Queries(flags)
 
-    def init_db(self):
+    def __init__(self):
+        self.local = threading.local()
+
+    def init_db(self, settings=None):
         """
-        Initialise the database connection.
-        To be called once per session.
+        Initialise the database connection pool.
+        To be called once per process. The database isn't queried, and its
+        schema must already exist (see create_schema).
+
+        Options are taken from the given (Pyramid) settings, falling back to
+        environment variables:
+         - ensign.db / FLAGS_DB: Database URL.
+         - ensign.db.pool_size / FLAGS_DB_POOL_SIZE: Connections kept open.
+         - ensign.db.max_overflow / FLAGS_DB_MAX_OVERFLOW: Extra connections
+           allowed under load.
+         - ensign.db.pre_ping / FLAGS_DB_PRE_PING: Check connections are
+           alive before handing them out.
+         - ensign.db.recycle / FLAGS_DB_RECYCLE: Seconds after which
+           connections are replaced.
+         - ensign.db.statement_timeout / FLAGS_DB_STATEMENT_TIMEOUT:
+           Milliseconds after which PostgreSQL cancels a flag evaluation.
+         - ensign.notify / FLAGS_NOTIFY: Change notification channel.
+         - ensign.usage.interval / FLAGS_USAGE_INTERVAL: Enables write-behind
+           usage tracking, flushing every given seconds.
+         - ensign.usage.buffer / FLAGS_USAGE_BUFFER: Usage buffer size.
         """
 
+        def option(key, env, default=None, convert=str):
+            value = (settings or {}).get(key, os.environ.get(env))
+            return default if value in (None, "") else convert(value)
+
+        url = sa.engine.url.make_url(option(
+            "ensign.db", "FLAGS_DB", "postgresql+psycopg2cffi:///flags",
+        ))
+        timeout = option(
+            "ensign.db.statement_timeout", "FLAGS_DB_STATEMENT_TIMEOUT",
+            None, int,
+        )
+        if timeout and url.drivername.split("+")[0] in _POSTGRESQL:
+            self.statement_timeout = timeout
+
         self.engine = sa.create_engine(
-            os.environ.get(
-                "FLAGS_DB",
-                "postgresql+psycopg2cffi:///flags",
+            url,
+            poolclass=sa.pool.QueuePool,
+            pool_size=option(
+                "ensign.db.pool_size", "FLAGS_DB_POOL_SIZE", 5, int,
+            ),
+            max_overflow=option(
+                "ensign.db.max_overflow", "FLAGS_DB_MAX_OVERFLOW", 10, int,
+            ),
+            pool_recycle=option(
+                "ensign.db.recycle", "FLAGS_DB_RECYCLE", -1, int,
+            ),
+            execution_options=dict(
+                compiled_cache=sa.util.LRUCache(_COMPILED_CACHE_SIZE),
             ),
         )
-        self.metadata.create_all(self.engine)
-        self.connection = self.engine.connect()
+        if option("ensign.db.pre_ping", "FLAGS_DB_PRE_PING", False, _boolean):
+            sa.event.listen(self.engine.pool, "checkout", _ping)
+
+        channel = option("ensign.notify", "FLAGS_NOTIFY")
+        if channel:
+            self.channel = PGChannel(self.engine, channel)
+
+        interval = option(
+            "ensign.usage.interval", "FLAGS_USAGE_INTERVAL", None, float,
+        )
+        if interval:
+            self.buffer_usage(
+                interval,
+                option("ensign.usage.buffer", "FLAGS_USAGE_BUFFER", 1024, int),
+            )
+
+    def create_schema(self):
+        """
+        Create the flags tables, if missing, or upgrade them to the current
+        schema: columns, indexes and (on PostgreSQL) flag types added since
+        they were created are added, and existing tags are indexed. Existing
+        data is kept.
+        To be run once when deploying (see `ensign initdb`), rather than by
+        every process starting.
+        """
+
+        with self.engine.connect() as connection:
+            existing = set(sa.inspect(connection).get_table_names())
+        if self.flags.name in existing:
+            self._upgrade_types()
+
+        with self.engine.begin() as connection:
+            inspector = sa.inspect(connection)
+            self.metadata.create_all(connection)
+            for table in self.metadata.sorted_tables:
+                if table.name in existing:
+                    self._upgrade_table(connection, inspector, table)
+            self._backfill_tags(connection)
+
+    def _backfill_tags(self, connection):
+        """
+        Index the tags of flags created before tags were indexed (i.e., with
+        tags, but no rows in flag_tags).
+        """
+
+        query = sa.select([self.flags.c.id, self.flags.c.tags]).where(
+            sa.and_(
+                self.flags.c.tags.isnot(None),
+                ~sa.exists().where(
+                    self.flag_tags.c.flag_id == self.flags.c.id,
+                ),
+            ),
+        )
+        rows = [
+            dict(flag_id=row.id, tag=tag)
+            for row in connection.execute(query).fetchall()
+            for tag in _split_tags(row.tags)
+        ]
+        if rows:
+            connection.execute(self.flag_tags.insert(), rows)
+
+    def _upgrade_types(self):
+        """
+        Add any missing values to the PostgreSQL enumerated type for flag
+        types. It can't be done within a transaction, so it's autocommitted.
+        """
+
+        if self.engine.dialect.name != "postgresql":
+            return
+
+        enum = self.flags.c.type.type
+        query = sa.text(
+            "SELECT enumlabel FROM pg_enum "
+            "WHERE enumtypid = to_regtype(:name)",
+        )
+        engine = self.engine.execution_options(isolation_level="AUTOCOMMIT")
+        with engine.connect() as connection:
+            labels = {
+                row[0] for row in connection.execute(query, name=enum.name)
+            }
+            preparer = connection.dialect.identifier_preparer
+            for label in enum.enums:
+                if label not in labels:
+                    connection.execute(sa.DDL(
+                        f"ALTER TYPE {preparer.quote(enum.name)} "
+                        f"ADD VALUE '{label}'",
+                    ))
+
+    @staticmethod
+    def _upgrade_table(connection, inspector, table):
+        """
+        Add the columns and indexes missing from an existing table.
+        """
+
+        preparer = connection.dialect.identifier_preparer
+        columns = {
+            column["name"] for column in inspector.get_columns(table.name)
+        }
+        for column in table.columns:
+            if column.name not in columns:
+                definition = sa.schema.CreateColumn(column).\
+                    compile(dialect=connection.dialect)
+                connection.execute(sa.DDL(
+                    f"ALTER TABLE {preparer.format_table(table)} "
+                    f"ADD COLUMN {definition}",
+                ))
+
+        indexes = {
+            index["name"] for index in inspector.get_indexes(table.name)
+        }
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+
+    @contextlib.contextmanager
+    def session(self, connection=None):
+        """
+        Run all operations made by the current thread within the block on a
+        single connection: either the given one, whose transaction is managed
+        by the caller, or one checked out of the pool and committed when the
+        block finishes.
+        """
+
+        if getattr(self.local, "connection", None) is not None:
+            yield self.local.connection
+            return
+
+        if connection is not None:
+            self.local.connection = connection
+            try:
+                yield connection
+            finally:
+                self.local.connection = None
+            return
+
+        with self.engine.connect() as connection:
+            with connection.begin():
+                self.local.connection = connection
+                try:
+                    yield connection
+                finally:
+                    self.local.connection = None
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            yield connection
+        else:
+            with self.engine.connect() as connection:
+                yield connection
+
+    @contextlib.contextmanager
+    def _begin(self):
+        with self._connect() as connection:
+            if connection.in_transaction():
+                yield connection
+            else:
+                with connection.begin():
+                    yield connection
+
+    @contextlib.contextmanager
+    def _bounded(self, begin=False):
+        """
+        Check out a connection (within a transaction, if `begin`) for flag
+        evaluation, bounded by the statement timeout, if set, through a
+        transaction of its own. Within a session(), the owner's settings are
+        left alone.
+        """
+
+        if self.statement_timeout is None or \
+                getattr(self.local, "connection", None) is not None:
+            with (self._begin if begin else self._connect)() as connection:
+                yield connection
+            return
+
+        with self._begin() as connection:
+            connection.execute(
+                _SET_STATEMENT_TIMEOUT,
+                b_timeout=str(self.statement_timeout),
+            )
+            yield connection
+
+    def buffer_usage(self, interval=5.0, maxsize=1024):
+        """
+        Switch to write-behind usage tracking: loading a flag records its use
+        in memory, and a background thread writes all pending last used dates
+        in a single UPDATE every `interval` seconds (or sooner, when `maxsize`
+        flags are pending). Pending uses are flushed on shutdown. Calling it
+        again replaces the buffer, flushing the previous one first.
+        """
+
+        if self.usage is None:
+            atexit.register(self.close)
+        else:
+            self.usage.stop()
+        self.usage = UsageBuffer(self.flush_usage, interval, maxsize)
+        self.usage.start()
+
+    def flush_usage(self, pending):
+        """
+        Write the last used dates for the given flags (a mapping of names to
+        the times recorded in the usage buffer), in a single statement. As
+        for unbuffered uses, they are set to the database's current time, so
+        all dates come from the clock activity is classified against.
+        """
+
+        query = self.flags.update().\
+            where(self.flags.c.name.in_(list(pending))).\
+            values(used=sa.func.now())
+        with self._begin() as connection:
+            connection.execute(query)
+
+    def close(self):
+        """
+        Flush any pending usage information and release all connections.
+        """
+
+        if self.usage is not None:
+            usage, self.usage = self.usage, None
+            atexit.unregister(self.close)
+            usage.stop()
+        if self.engine is not None:
+            self.engine.dispose()
 
     def create(self, name, flagtype, **kwargs):
         """
@@ -65,76 +766,451 @@ class SQLStorage:
         """
 
         query = self.flags.insert().values(name=name, type=flagtype, **kwargs)
-        self.connection.execute(query)
+        tags = _split_tags(kwargs.get("tags"))
+        with self._begin() as connection:
+            result = connection.execute(query)
+            if tags:
+                flag_id = result.inserted_primary_key[0]
+                connection.execute(self.flag_tags.insert(), [
+                    dict(flag_id=flag_id, tag=tag)
+                    for tag in tags
+                ])
+            self._notify(connection, name)
+
+    def create_many(self, flags, flagtype):
+        """
+        Create several new flags of the given type, in a single multi-row
+        INSERT. Each flag is a mapping with its name and any extra columns.
+        """
+
+        flags = [dict(flag, type=flagtype) for flag in flags]
+        if not flags:
+            return
+
+        columns = set().union(*flags)
+        rows = [dict(dict.fromkeys(columns), **flag) for flag in flags]
+
+        query = self.flags.insert().values(rows)
+        with self._begin() as connection:
+            connection.execute(query)
+            self._tag_many(connection, rows)
+            for row in rows:
+                self._notify(connection, row["name"])
+
+    def upsert_many(self, flags, batch=1000):
+        """
+        Create or replace several flags, in a single transaction. Each flag is
+        a mapping with its name, type and any other definition columns; the
+        rest are cleared. Replaced flags keep their last used date, and get a
+        new version. Returns the number of flags written.
+
+        Flags are written in batches of `batch` flags: on PostgreSQL, with a
+        multi-row INSERT ... ON CONFLICT, in a single round trip; elsewhere,
+        by executing prebuilt statements over the batch (see
+        _upsert_generic), which avoids compiling a statement per batch.
+        """
+
+        count = 0
+        flags = iter(flags)
+        with self._begin() as connection:
+            for rows in iter(lambda: list(itertools.islice(flags, batch)), []):
+                rows = list({
+                    flag["name"]: dict(dict.fromkeys(_DEFINITION), **flag)
+                    for flag in rows
+                }.values())
+                self._upsert(connection, rows)
+                for row in rows:
+                    self._notify(connection, row["name"])
+                count += len(rows)
+        return count
+
+    def _upsert(self, connection, rows):
+        names = [row["name"] for row in rows]
+        if connection.dialect.name == "postgresql":
+            self._upsert_postgresql(connection, rows)
+        else:
+            self._upsert_generic(connection, rows)
+
+        ids = sa.select([self.flags.c.id]).where(self.flags.c.name.in_(names))
+        connection.execute(
+            self.flag_tags.delete().where(self.flag_tags.c.flag_id.in_(ids)),
+        )
+        self._tag_many(connection, rows)
 
-    def exists(self, name):
+    def _upsert_postgresql(self, connection, rows):
+        insert = postgresql.insert(self.flags).values(rows)
+        excluded = insert.excluded
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=[self.flags.c.name],
+            set_=dict(
+                {column: excluded[column] for column in _DEFINITION},
+                version=self.flags.c.version + 1,
+            ),
+        ))
+
+    def _upsert_generic(self, connection, rows):
+        """
+        Create or replace flags with standard statements only. Both work on
+        every flag, so there's no window between reading which flags exist
+        and writing them: placeholders are inserted for missing flags (a
+        concurrent insert of the same name fails on the unique constraint),
+        then all flags are replaced, taking placeholders to version 1.
+        """
+
+        params = [
+            {f"b_{column}": row[column] for column in row}
+            for row in rows
+        ]
+        connection.execute(self.queries.reserve, params)
+        connection.execute(self.queries.replace, params)
+
+    def _tag_many(self, connection, rows):
+        tags = {row["name"]: _split_tags(row.get("tags")) for row in rows}
+        tags = {name: split for name, split in tags.items() if split}
+        if not tags:
+            return
+
+        query = sa.select([self.flags.c.id, self.flags.c.name]).\
+            where(self.flags.c.name.in_(list(tags)))
+        connection.execute(self.flag_tags.insert(), [
+            dict(flag_id=row.id, tag=tag)
+            for row in connection.execute(query).fetchall()
+            for tag in tags[row.name]
+        ])
+
+    def exists(self, name, flagtype=None):
         """
-        Given a flags name, check if it exists in the store.
+        Given a flags name, check if it exists in the store, and is of the
+        given type if any.
         """
 
-        query = sa.select([sa.exists().where(self.flags.c.name == name)])
-        res = self.connection.execute(query).fetchone()
-        return res[0]
+        with self._bounded() as connection:
+            if flagtype is None:
+                res = connection.execute(self.queries.exists, b_name=name)
+            else:
+                res = connection.execute(
+                    self.queries.exists_type, b_name=name, b_type=flagtype,
+                )
+            return res.scalar()
 
     def load(self, name, flagtype):
         """
-        Load a flag's value given its name. Updates the last used date.
+        Load a flag's value given its name. Updates the last used date, either
+        right away or through the usage buffer.
+        """
+
+        query = self.queries.load[flagtype]
+
+        if self.usage is not None:
+            with self._bounded() as connection:
+                data = connection.execute(query, b_name=name).first()
+            if data is None:
+                raise KeyError(name)
+            self.usage.record(name)
+            return data[0]
+
+        with self._bounded(begin=True) as connection:
+            data = connection.execute(query, b_name=name).first()
+            if data is None:
+                raise KeyError(name)
+            connection.execute(self.queries.touch, b_name=name)
+            return data[0]
+
+    def load_many(self, names, flagtype):
+        """
+        Load several flags' values given their names, in a single query.
+        Returns a mapping of names to values, leaving out inexisting flags.
+        Updates the last used dates.
         """
 
         field = f"value_{flagtype.value}"
+        names = list(names)
+        if not names:
+            return {}
+
+        query = sa.select([self.flags.c.name, self.flags.c.get(field)]).\
+            where(self.flags.c.name.in_(names))
+
+        if self.usage is not None:
+            with self._bounded() as connection:
+                data = connection.execute(query).fetchall()
+            for row in data:
+                self.usage.record(row.name)
+            return {row.name: row[field] for row in data}
 
-        with self.connection.begin():
-            query = sa.select([self.flags.c.get(field)]).\
-                where(self.flags.c.name == name)
-            data = self.connection.execute(query).fetchone()
+        with self._bounded(begin=True) as connection:
+            data = connection.execute(query).fetchall()
 
             query = self.flags.update().\
-                where(self.flags.c.name == name).\
+                where(self.flags.c.name.in_(names)).\
                 values(used=sa.func.now())
-            self.connection.execute(query)
+            connection.execute(query)
 
-            return data[field]
+            return {row.name: row[field] for row in data}
 
     def store(self, name, value, flagtype):
         """
         Store a new value for a flag, given its name.
         """
 
+        query = self.queries.store[flagtype]
+        with self._begin() as connection:
+            result = connection.execute(query, b_name=name, b_value=value)
+            if not result.rowcount:
+                raise KeyError(name)
+            self._notify(connection, name)
+
+    def store_many(self, values, flagtype):
+        """
+        Store new values for several flags, given a mapping of names to
+        values, in a single UPDATE.
+        """
+
         field = f"value_{flagtype.value}"
+        values = dict(values)
+        if not values:
+            return
 
         query = self.flags.update().\
-            where(self.flags.c.name == name).\
-            values(**{field: value})
-        self.connection.execute(query)
+            where(self.flags.c.name.in_(list(values))).\
+            values(**{
+                field: sa.case(values, value=self.flags.c.name),
+                "version": self.flags.c.version + 1,
+            })
+        with self._begin() as connection:
+            connection.execute(query)
+            for name in values:
+                self._notify(connection, name)
+
+    def _notify(self, connection, name):
+        if self.channel is not None:
+            self.channel.notify(connection, name)
 
     def used(self, name):
         """
-        Return a flag's last used date.
+        Return a flag's last used date. Uses still waiting in the usage buffer
+        take precedence over the stored date.
+        """
+
+        if self.usage is not None:
+            pending = self.usage.get(name)
+            if pending is not None:
+                return pending
+
+        with self._connect() as connection:
+            data = connection.execute(self.queries.used, b_name=name).\
+                first()
+        if data is None:
+            raise KeyError(name)
+        return data["used"]
+
+    def activity(self, name, days=DAYS_INACTIVE):
+        """
+        Return a flag's activity indicator, given the number of days without
+        use after which it's inactive. Uses still waiting in the usage buffer
+        count as recent.
+        """
+
+        if self.usage is not None and self.usage.get(name) is not None:
+            return FlagActive.ACTIVE
+
+        with self._connect() as connection:
+            data = connection.execute(
+                self.queries.activity, b_name=name, **_days_params(days),
+            ).first()
+        if data is None:
+            raise KeyError(name)
+        return FlagActive(data[0])
+
+    def activity_all(self, days=DAYS_INACTIVE):
+        """
+        Return all flags' activity indicators, as a mapping of names to
+        FlagActive, classified in a single query. `days` is the inactivity
+        period, either for all flags or as a mapping of flag types to days.
+        """
+
+        query = self.queries.activity_all
+        with self._connect() as connection:
+            activity = {
+                row[0]: FlagActive(row[1])
+                for row in connection.execute(query, **_days_params(days)).
+                fetchall()
+            }
+
+        if self.usage is not None:
+            for name in activity:
+                if self.usage.get(name) is not None:
+                    activity[name] = FlagActive.ACTIVE
+        return activity
+
+    def version(self, name, days=DAYS_INACTIVE):
+        """
+        Return a flag's version, increased by every change to it, and its
+        activity indicator (see activity()), in a single query. Together, they
+        identify the current state of the flag.
         """
 
-        query = sa.select([self.flags.c.used]).\
-            where(self.flags.c.name == name)
-        return self.connection.execute(query).fetchone()["used"]
+        with self._connect() as connection:
+            data = connection.execute(
+                self.queries.version, b_name=name, **_days_params(days),
+            ).first()
+        if data is None:
+            raise KeyError(name)
+        return data[0], FlagActive(data[1])
+
+    def version_all(self, after=None, limit=None, days=DAYS_INACTIVE,
+                    **filters):
+        """
+        Return a summary identifying the current state of the flags listed by
+        iter_info() with the same arguments, in a single query: the number of
+        flags, the sum of their versions, the highest id, how many are new
+        and inactive, and the sum of the inactive flags' ids (so flags
+        swapping activity change it too).
+        """
+
+        if after is None and limit is None and not any(filters.values()):
+            query = self.queries.version_all
+        else:
+            query = self.filter(self.queries.page, **filters)
+            if after is not None:
+                query = query.where(self.flags.c.name > after)
+            if limit is not None:
+                query = query.order_by(self.flags.c.name).limit(limit)
+            query = self.queries.summary(query)
+        with self._connect() as connection:
+            data = connection.execute(query, **_days_params(days)).first()
+        return tuple(value or 0 for value in data)
 
     def info(self, name):
         """
-        Return a flag's full information.
+        Return a flag's full information, as a FlagRecord.
         """
 
-        query = sa.select([self.flags]).\
-            where(self.flags.c.name == name)
-        return self.connection.execute(query).fetchone()
+        with self._connect() as connection:
+            data = connection.execute(self.queries.info, b_name=name).\
+                first()
+        if data is None:
+            raise KeyError(name)
+        return FlagRecord.from_row(data)
 
     def all(self):
         """
         Return all flags.
         """
 
-        query = sa.select([self.flags.c.name])
-        return [
-            row.name
-            for row in self.connection.execute(query).fetchall()
-        ]
+        with self._connect() as connection:
+            return [
+                row.name
+                for row in connection.execute(self.queries.all).fetchall()
+            ]
+
+    def info_all(self, names=None):
+        """
+        Return all flags' full information (or only the given flags'), in a
+        single query, as FlagRecords. Doesn't update the last used dates.
+        """
+
+        query = self.queries.info_all
+        if names is not None:
+            names = list(names)
+            if not names:
+                return []
+            query = query.where(self.flags.c.name.in_(names))
+        with self._connect() as connection:
+            return [
+                FlagRecord.from_row(row)
+                for row in connection.execute(query).fetchall()
+            ]
+
+    def iter_info(self, after=None, limit=None, batch=500, activity=False,
+                  days=DAYS_INACTIVE, **filters):
+        """
+        Yield flags' full information as FlagRecords, ordered by name,
+        starting after the given name and stopping after `limit` flags, if
+        given. Rows are fetched `batch` at a time from a server-side cursor
+        (where the driver supports it), so memory use doesn't depend on the
+        number of flags. With `activity`, yields (FlagRecord, FlagActive)
+        pairs instead, classified in the same query.
+
+        Flags can be filtered by (see filter()):
+         - tags: Tags that flags must all have.
+         - flagtype: Flag type.
+         - active: Activity indicator (see FlagActive).
+        `days` is the inactivity period, either for all flags or as a mapping
+        of flag types to days (see activity_all()).
+        """
+        # pylint: disable=too-many-arguments
+
+        query = self.queries.info_activity if activity else \
+            self.queries.info_all
+        query = self.filter(query, **filters)
+        if after is not None:
+            query = query.where(self.flags.c.name > after)
+        if limit is not None:
+            query = query.limit(limit)
+
+        with self._connect() as connection:
+            result = connection.execution_options(stream_results=True).\
+                execute(query, **_days_params(days))
+            try:
+                rows = result.fetchmany(batch)
+                while rows:
+                    for row in rows:
+                        if activity:
+                            yield (
+                                FlagRecord.from_row(row[:-1]),
+                                FlagActive(row[-1]),
+                            )
+                        else:
+                            yield FlagRecord.from_row(row)
+                    rows = result.fetchmany(batch)
+            finally:
+                result.close()
+
+    def filter(self, query, tags=None, flagtype=None, active=None):
+        """
+        Restrict a query on the flags table to the flags with all the given
+        tags, of the given type, and with the given activity indicator. The
+        activity is classified with the inactivity periods bound when the
+        query is executed (see _days_params()). The tags and new flags are
+        served by indexes.
+        """
+
+        for tag in tags or ():
+            tagged = sa.select([self.flag_tags.c.flag_id]).\
+                where(self.flag_tags.c.tag == tag)
+            query = query.where(self.flags.c.id.in_(tagged))
+
+        if flagtype is not None:
+            query = query.where(self.flags.c.type == flagtype)
+
+        if active == FlagActive.NEW:
+            query = query.where(self.flags.c.used.is_(None))
+        elif active is not None:
+            query = query.where(self.queries.activity_of == active.value)
+
+        return query
+
+    def touch(self, names):
+        """
+        Update several flags' last used date, in a single UPDATE or through
+        the usage buffer.
+        """
+
+        names = list(names)
+        if not names:
+            return
+
+        if self.usage is not None:
+            for name in names:
+                self.usage.record(name)
+            return
+
+        query = self.flags.update().\
+            where(self.flags.c.name.in_(names)).\
+            values(used=sa.func.now())
+        with self._begin() as connection:
+            connection.execute(query)
 
 
 DefaultStorage = SQLStorage()
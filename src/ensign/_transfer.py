@@ -0,0 +1,119 @@
+"""
+Transfer-related functions. Provides the export and import of flag
+definitions as ndjson, to move flags between environments.
+
+Every line is a JSON object with a flag's name, type, value and default (as
+stored for its type), label, description and tags. Usage data (last used
+dates and versions) is left behind.
+"""
+
+import json
+import numbers
+
+from ensign._rules import compile_rules
+from ensign._storage import FlagTypes
+
+
+FIELDS = ("name", "type", "value", "default", "label", "description", "tags")
+
+
+def dump_definition(info):
+    """
+    Return the ndjson line for a flag, given its information (e.g., a
+    FlagRecord).
+    """
+
+    flagtype = info["type"].value
+    return json.dumps(
+        dict(
+            name=info["name"],
+            type=flagtype,
+            value=info.get(f"value_{flagtype}"),
+            default=info.get(f"default_{flagtype}"),
+            label=info.get("label"),
+            description=info.get("description"),
+            tags=info.get("tags"),
+        ),
+        separators=(",", ":"),
+    ) + "\n"
+
+
+def _check_value(flagtype, value):
+    if value is None:
+        return
+    if flagtype == FlagTypes.BINARY:
+        valid = isinstance(value, bool)
+    elif flagtype == FlagTypes.PERCENTAGE:
+        valid = isinstance(value, numbers.Real) and \
+            not isinstance(value, bool) and 0 <= value <= 100
+    else:
+        valid = isinstance(value, str)
+        if valid:
+            compile_rules(value)
+    if not valid:
+        raise ValueError(f"invalid {flagtype.value} value: {value!r}")
+
+
+def load_definition(line):
+    """
+    Return the storage columns (as taken by SQLStorage.upsert_many) for an
+    ndjson line. Raises ValueError if it's not a valid flag definition.
+    """
+
+    data = json.loads(line)
+    if not isinstance(data, dict) or not set(data) <= set(FIELDS):
+        raise ValueError(f"not a flag definition: {line!r}")
+    name = data.get("name")
+    if not isinstance(name, str) or not name:
+        raise ValueError(f"invalid name: {name!r}")
+    flagtype = FlagTypes(data.get("type"))
+    for field in ("value", "default"):
+        _check_value(flagtype, data.get(field))
+    for field in ("label", "description", "tags"):
+        if not isinstance(data.get(field, ""), (str, type(None))):
+            raise ValueError(f"invalid {field}: {data[field]!r}")
+
+    return {
+        "name": name,
+        "type": flagtype,
+        f"value_{flagtype.value}": data.get("value"),
+        f"default_{flagtype.value}": data.get("default"),
+        "label": data.get("label"),
+        "description": data.get("description"),
+        "tags": data.get("tags"),
+    }
+
+
+def export_flags(store, output):
+    """
+    Write all the flags in the store to `output`, as ndjson, ordered by name.
+    Flags are streamed from storages supporting it (see SQLStorage.iter_info).
+    Returns the number of flags written.
+    """
+
+    count = 0
+    for info in getattr(store, "iter_info", store.info_all)():
+        output.write(dump_definition(info))
+        count += 1
+    return count
+
+
+def import_flags(store, lines, batch=1000):
+    """
+    Create or replace the flags defined by the given ndjson lines, in
+    multi-row statements of `batch` flags (see SQLStorage.upsert_many), and
+    in a single transaction: if any line is not valid, raises ValueError and
+    no flag is written (unless within a session, whose transaction is left
+    to its owner). Returns the number of flags written.
+    """
+
+    def definitions():
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                yield load_definition(line)
+            except ValueError as exc:
+                raise ValueError(f"line {number}: {exc}") from exc
+
+    return store.upsert_many(definitions(), batch)
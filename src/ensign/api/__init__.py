@@ -6,7 +6,7 @@ from ensign import DefaultStorage
 
 def main(global_config, **settings):
     if not global_config.get("testing"):  # pragma: no cover
-        DefaultStorage.init_db()
+        DefaultStorage.init_db(settings)
 
     config = Configurator(settings=settings)
     config.include("cornice")
@@ -2,30 +2,148 @@
 Resources and auxiliary objects to represent flags.
 """
 
+import json
+
+from cornice import Service
 from cornice.resource import resource
 from pyramid.httpexceptions import (
     HTTPCreated,  # 201
     HTTPNoContent,  # 204
+    HTTPNotModified,  # 304
     HTTPBadRequest,  # 400
     HTTPNotFound,  # 404
 )
+from pyramid.response import Response
+from pyramid.settings import asbool
+
+from ensign import (
+    BinaryFlag,
+    DefaultStorage,
+    FlagDoesNotExist,
+    RuleFlag,
+    import_flags,
+)
+from ensign._flags import FLAG_CLASSES
+from ensign._storage import FlagActive, FlagTypes
+
+
+# Inactivity period of every flag type, as its class declares.
+_DAYS_INACTIVE = {
+    flagtype: flagclass.DAYS_INACTIVE
+    for flagtype, flagclass in FLAG_CLASSES.items()
+}
+
+
+class FlagSchema(dict):
+    """
+    Class representing a flag, to be used by the Flag resource. It's the
+    mapping rendered as is in responses.
+    """
+    # pylint: disable=too-few-public-methods,too-many-arguments
+
+    __slots__ = ()
+
+    def __init__(self, name, value, active, label, description, tags):
+        super().__init__(
+            name=name,
+            value=value,
+            active=active.name,
+            label=label,
+            description=description,
+            tags=tags,
+        )
+
+    @classmethod
+    def from_info(cls, info, active):
+        """
+        Build the schema straight from a flag's stored information and
+        activity indicator, without any further queries.
+        """
+
+        return cls(
+            info["name"],
+            info[f"value_{info['type'].value}"],
+            active,
+            info["label"] or "",
+            info["description"] or "",
+            info["tags"] or "",
+        )
+
+
+def _stream(infos):
+    """
+    Yield the JSON array for the given flags' information and activity, one
+    flag at a time.
+    """
+
+    separator = b"["
+    for info, active in infos:
+        yield separator + json.dumps(FlagSchema.from_info(info, active)).\
+            encode()
+        separator = b","
+    yield b"]" if separator == b"," else b"[]"
+
+
+def _limit(params):
+    limit = params.get("limit")
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise HTTPBadRequest()
+    if limit < 1:
+        raise HTTPBadRequest()
+    return limit
+
 
-from ensign import BinaryFlag, FlagDoesNotExist
+def _etag(*state):
+    return "-".join(str(part) for part in state)
 
 
-class FlagSchema:
+def _info(name):
     """
-    Class representing a flag, to be used by the Flag resource.
+    Return a flag's stored information, or abort if it doesn't exist.
     """
-    # pylint: disable=too-few-public-methods
 
-    def __init__(self, flag):
-        self.name = flag.name
-        self.value = flag.value
-        self.active = flag.active.name
-        self.label = flag.info.get("label")
-        self.description = flag.info.get("description")
-        self.tags = flag.info.get("tags")
+    try:
+        return DefaultStorage.info(name)
+    except KeyError:
+        raise HTTPNotFound()
+
+
+def _set(flag, value):
+    """
+    Set a flag's value through its class' set() (or unset(), for binary
+    flags), so it's validated for its type. Rules are given as their JSON
+    text, as they are listed and imported.
+    """
+
+    if isinstance(flag, BinaryFlag):
+        if not isinstance(value, bool):
+            raise ValueError(value)
+        if value:
+            flag.set()
+        else:
+            flag.unset()
+    elif isinstance(flag, RuleFlag):
+        if not isinstance(value, str):
+            raise ValueError(value)
+        flag.set(json.loads(value))
+    else:
+        flag.set(value)
+
+
+def _filters(params):
+    filters = dict(tags=params.getall("tag"), days=_DAYS_INACTIVE)
+    try:
+        if "type" in params:
+            filters["flagtype"] = FlagTypes(params["type"])
+        if "active" in params:
+            filters["active"] = FlagActive[params["active"]]
+    except (KeyError, ValueError):
+        raise HTTPBadRequest()
+    return filters
 
 
 @resource(path="/flags/{name}", collection_path="/flags")
@@ -45,25 +163,72 @@ class Flag:
     def get(self):
         """
         Get the full information for a given flag.
+        The response's ETag changes with the flag's version and activity, so
+        conditional requests (`If-None-Match`) can be answered with a 304
+        after a single query. Otherwise, the flag is read with another, and
+        marked as used.
         """
 
         name = self.request.matchdict["name"]
         try:
-            flag = BinaryFlag(name)
-        except FlagDoesNotExist:
+            version, active = DefaultStorage.version(name, _DAYS_INACTIVE)
+        except KeyError:
             raise HTTPNotFound()
-        return FlagSchema(flag).__dict__
+        etag = _etag(version, active.name)
+        if etag in self.request.if_none_match:
+            raise HTTPNotModified(etag=etag)
+
+        info = _info(name)
+        DefaultStorage.touch([name])
+        # Reading the flag marks it as used, which makes it active.
+        flag = FlagSchema.from_info(info, FlagActive.ACTIVE)
+        self.request.response.etag = _etag(version, flag["active"])
+        return flag
 
     def collection_get(self):
         """
-        Get all flags in the system.
+        Get all flags in the system, ordered by name.
+        Supports filtering them (`?tag=name&type=binary&active=INACTIVE`, tags
+        can be repeated), keyset pagination (`?after=name&limit=N`), with a
+        link to the next page in the `Link` header, and streaming the response
+        as it's read from the database (`?stream=true`).
+        Conditional requests (`If-None-Match`) are supported, as for a single
+        flag.
         """
-        # pylint: disable=no-self-use
 
-        return [
-            FlagSchema(flag).__dict__
-            for flag in BinaryFlag.all()
-        ]
+        params = self.request.params
+        after = params.get("after")
+        limit = _limit(params)
+        filters = _filters(params)
+
+        etag = _etag(*DefaultStorage.version_all(after, limit, **filters))
+        if etag in self.request.if_none_match:
+            raise HTTPNotModified(etag=etag)
+        self.request.response.etag = etag
+
+        infos = DefaultStorage.iter_info(
+            after, limit, activity=True, **filters
+        )
+        if asbool(params.get("stream")):
+            return Response(
+                app_iter=_stream(infos),
+                content_type="application/json",
+                etag=etag,
+            )
+
+        flags = [FlagSchema.from_info(info, active) for info, active in infos]
+        if limit is not None and len(flags) == limit:
+            query = [
+                (key, value)
+                for key, value in params.items()
+                if key not in ("after", "limit")
+            ]
+            url = self.request.current_route_url(_query=query + [
+                ("after", flags[-1]["name"]),
+                ("limit", limit),
+            ])
+            self.request.response.headers["Link"] = f'<{url}>; rel="next"'
+        return flags
 
     def collection_post(self):
         """
@@ -80,8 +245,9 @@ class Flag:
 
     def patch(self):
         """
-        Change a flag's value.
-        If any other property is provided, abort.
+        Change a flag's value, validated for the flag's type (rules are given
+        as their JSON text, as in responses and batches).
+        If any other property is provided, or the value is not valid, abort.
         """
 
         data = self.request.json_body
@@ -91,10 +257,36 @@ class Flag:
         name = self.request.matchdict["name"]
         value = data.pop("value")
 
+        flag = FLAG_CLASSES[_info(name).type](name, lazy=True)
         try:
-            flag = BinaryFlag(name)
-            flag.value = value
+            _set(flag, value)
         except FlagDoesNotExist:
             raise HTTPNotFound()
+        except ValueError:
+            raise HTTPBadRequest()
 
         return HTTPNoContent()
+
+
+# Pyramid reads ":name" as a placeholder in patterns without any "{name}", so
+# the colon is matched by a regular expression placeholder instead.
+batch = Service(
+    name="flags_batch",
+    path=r"/flags{action::batch}",
+    description="Bulk operations over flags.",
+)
+
+
+@batch.post()
+def batch_post(request):
+    """
+    Create or replace all the flags defined in the request body, as ndjson
+    (see `ensign export`), with multi-row statements and in a single
+    transaction: if any flag is not valid, none are written.
+    """
+
+    try:
+        count = import_flags(DefaultStorage, request.body_file)
+    except ValueError as exc:
+        raise HTTPBadRequest(str(exc))
+    return dict(flags=count)
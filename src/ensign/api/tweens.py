@@ -0,0 +1,38 @@
+"""
+Pyramid tweens for applications evaluating flags.
+
+To evaluate all flags in a request from a single snapshot, include this module
+in the application's configuration:
+
+    config.include("ensign.api.tweens")
+
+By default, all flags are loaded at the start of every request. To load only a
+subset, list their names in the `ensign.snapshot.flags` setting.
+"""
+
+from pyramid.settings import aslist
+
+from ensign import DefaultStorage, FlagSnapshot
+
+
+def snapshot_tween_factory(handler, registry):
+    """
+    Tween serving every flag evaluation in a request from a FlagSnapshot taken
+    when the request starts.
+    """
+
+    names = aslist(registry.settings.get("ensign.snapshot.flags", "")) or None
+
+    def snapshot_tween(request):
+        with FlagSnapshot(DefaultStorage, names):
+            return handler(request)
+
+    return snapshot_tween
+
+
+def includeme(config):
+    """
+    Register the snapshot tween.
+    """
+
+    config.add_tween("ensign.api.tweens.snapshot_tween_factory")
@@ -0,0 +1,190 @@
+"""
+Command line interface, to manage flags and their storage.
+"""
+
+import argparse
+
+from ensign._filestorage import export_snapshot
+from ensign._pipeline import FORMATS, evaluate_subjects
+from ensign._storage import DefaultStorage
+from ensign._transfer import export_flags, import_flags
+
+
+KEY_TYPES = {"int": int, "str": str}
+COLUMN_TYPES = dict(KEY_TYPES, float=float)
+
+
+def _column_type(text):
+    """
+    Parse a `--column-type` argument, as `name:type`.
+    """
+
+    name, _, typename = text.rpartition(":")
+    if not name or typename not in COLUMN_TYPES:
+        types = ", ".join(sorted(COLUMN_TYPES))
+        raise argparse.ArgumentTypeError(f"expected name:type ({types})")
+    return name, COLUMN_TYPES[typename]
+
+
+def initdb(args, store=DefaultStorage):  # pylint: disable=unused-argument
+    """
+    Create the database schema, or upgrade an existing one.
+    """
+
+    store.create_schema()
+
+
+def snapshot(args, store=DefaultStorage):
+    """
+    Export all flags to a snapshot file, to be read with FileStorage.
+    """
+
+    export_snapshot(store, args.path)
+
+
+def evaluate(args, store=DefaultStorage):
+    """
+    Evaluate flags for every subject in a CSV or ndjson file.
+    """
+
+    evaluate_subjects(
+        args.input,
+        args.output,
+        args.flags,
+        store,
+        fmt=args.format,
+        key=args.key,
+        key_type=KEY_TYPES.get(args.key_type),
+        processes=args.processes,
+        chunk_size=args.chunk_size,
+        column_types=dict(args.column_type),
+    )
+    args.output.flush()
+
+
+def export(args, store=DefaultStorage):
+    """
+    Export all flag definitions, as ndjson.
+    """
+
+    export_flags(store, args.output)
+    args.output.flush()
+
+
+def import_(args, store=DefaultStorage):
+    """
+    Import flag definitions from ndjson, creating or replacing flags.
+    """
+
+    import_flags(store, args.input, args.batch)
+
+
+def parser():
+    """
+    Build the command line parser.
+    """
+
+    main_parser = argparse.ArgumentParser(
+        prog="ensign",
+        description="Feature flag management.",
+    )
+    commands = main_parser.add_subparsers(dest="command")
+    commands.required = True
+
+    command = commands.add_parser("initdb", help=initdb.__doc__.strip())
+    command.set_defaults(func=initdb)
+
+    command = commands.add_parser("snapshot", help=snapshot.__doc__.strip())
+    command.add_argument("path", help="Snapshot file to write.")
+    command.set_defaults(func=snapshot)
+
+    command = commands.add_parser("evaluate", help=evaluate.__doc__.strip())
+    command.add_argument("flags", nargs="+", help="Flags to evaluate.")
+    command.add_argument(
+        "-i", "--input",
+        type=argparse.FileType("r"),
+        default="-",
+        help="Subjects file to read (default: standard input).",
+    )
+    command.add_argument(
+        "-o", "--output",
+        type=argparse.FileType("w"),
+        default="-",
+        help="Results file to write (default: standard output).",
+    )
+    command.add_argument(
+        "-f", "--format",
+        choices=FORMATS,
+        default=FORMATS[0],
+        help="Format of both files (default: %(default)s).",
+    )
+    command.add_argument(
+        "-k", "--key",
+        default="id",
+        help="Subject attribute to evaluate flags for (default: %(default)s).",
+    )
+    command.add_argument(
+        "--key-type",
+        choices=sorted(KEY_TYPES),
+        help="Type to convert subject keys to (default: as read).",
+    )
+    command.add_argument(
+        "-t", "--column-type",
+        type=_column_type,
+        action="append",
+        default=[],
+        metavar="NAME:TYPE",
+        help="Type to convert a subject attribute to (can be repeated).",
+    )
+    command.add_argument(
+        "-p", "--processes",
+        type=int,
+        help="Number of worker processes (default: one per CPU).",
+    )
+    command.add_argument(
+        "--chunk-size",
+        type=int,
+        default=10000,
+        help="Subjects per chunk sent to workers (default: %(default)s).",
+    )
+    command.set_defaults(func=evaluate)
+
+    command = commands.add_parser("export", help=export.__doc__.strip())
+    command.add_argument(
+        "-o", "--output",
+        type=argparse.FileType("w"),
+        default="-",
+        help="File to write (default: standard output).",
+    )
+    command.set_defaults(func=export)
+
+    command = commands.add_parser("import", help=import_.__doc__.strip())
+    command.add_argument(
+        "-i", "--input",
+        type=argparse.FileType("r"),
+        default="-",
+        help="File to read (default: standard input).",
+    )
+    command.add_argument(
+        "--batch",
+        type=int,
+        default=1000,
+        help="Flags written per statement (default: %(default)s).",
+    )
+    command.set_defaults(func=import_)
+
+    return main_parser
+
+
+def main(argv=None):
+    """
+    Command line entry point. The database is configured through the usual
+    environment variables (see SQLStorage.init_db).
+    """
+
+    args = parser().parse_args(argv)
+    DefaultStorage.init_db()
+    try:
+        args.func(args)
+    finally:
+        DefaultStorage.close()
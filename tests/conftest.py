@@ -4,6 +4,7 @@ Test fixtures and test utilities.
 
 # pylint: disable=invalid-name,no-self-use,redefined-outer-name
 
+import datetime
 import os
 
 import pytest
@@ -15,7 +16,7 @@ from zope.interface.verify import verifyObject
 
 from ensign import BinaryFlag
 from ensign._interfaces import IStorage
-from ensign._storage import DefaultStorage
+from ensign._storage import DefaultStorage, FlagActive
 
 from ensign.api import main
 
@@ -36,18 +37,27 @@ class FakeStorage:
         """
 
         self.STORE[name] = dict(
+            {f"value_{flagtype.value}": None},
             name=name,
             type=flagtype,
-            value_binary=None,
             **kwargs,
         )
 
-    def exists(self, name):
+    def create_many(self, flags, flagtype):
         """
-        Check if a flag exists.
+        Create several new flags.
         """
 
-        return name in self.STORE
+        for flag in flags:
+            self.create(flagtype=flagtype, **flag)
+
+    def exists(self, name, flagtype=None):
+        """
+        Check if a flag exists (with the given type).
+        """
+
+        return name in self.STORE and \
+            flagtype in (None, self.STORE[name]["type"])
 
     def load(self, name, flagtype):
         """
@@ -56,6 +66,17 @@ class FakeStorage:
 
         return self.STORE[name][f"value_{flagtype.value}"]
 
+    def load_many(self, names, flagtype):
+        """
+        Load several flags' values from the store, given their names.
+        """
+
+        return {
+            name: self.load(name, flagtype)
+            for name in names
+            if name in self.STORE
+        }
+
     def store(self, name, value, flagtype):
         """
         Store a flag's value to the store, given its name.
@@ -63,6 +84,15 @@ class FakeStorage:
 
         self.STORE[name][f"value_{flagtype.value}"] = value
 
+    def store_many(self, values, flagtype):
+        """
+        Store several flags' values to the store, given a mapping of names to
+        values.
+        """
+
+        for name, value in values.items():
+            self.store(name, value, flagtype)
+
     def used(self, name):
         """
         Get a flag's last used datetime, given its name.
@@ -70,6 +100,23 @@ class FakeStorage:
 
         return self.STORE[name].get("used")
 
+    def activity(self, name, days):
+        """
+        Get a flag's activity indicator, given its name.
+        """
+
+        return FlagActive.from_used(self.used(name), days)
+
+    def activity_all(self, days):
+        """
+        Get all flags' activity indicators.
+        """
+
+        return {
+            name: self.activity(name, days)
+            for name in self.STORE
+        }
+
     def info(self, name):
         """
         Return a flag's descriptive information.
@@ -90,6 +137,28 @@ class FakeStorage:
 
         return self.STORE.keys()
 
+    def info_all(self, names=None):
+        """
+        Return all (or the given) flags' full information.
+        """
+
+        return [
+            dict(
+                dict.fromkeys(["label", "description", "tags", "used"]),
+                **info,
+            )
+            for name, info in self.STORE.items()
+            if names is None or name in names
+        ]
+
+    def touch(self, names):
+        """
+        Update several flags' last used datetime.
+        """
+
+        for name in names:
+            self.STORE[name]["used"] = datetime.datetime.now()
+
 
 @pytest.fixture(scope="function")
 def fakestore():
@@ -124,9 +193,9 @@ def _pre_db():
     conn.execute("commit")
     conn.execute("create database flags_test")
     DefaultStorage.init_db()
+    DefaultStorage.create_schema()
     yield
-    DefaultStorage.connection.close()
-    DefaultStorage.engine.dispose()
+    DefaultStorage.close()
     conn.execute("commit")
     conn.execute("drop database flags_test")
     conn.close()
@@ -140,10 +209,12 @@ def db(_pre_db):
     Transactions are rolled back for every test.
     """
 
-    conn = DefaultStorage.connection
+    conn = DefaultStorage.engine.connect()
     trans = conn.begin()
-    yield
+    with DefaultStorage.session(conn):
+        yield
     trans.rollback()
+    conn.close()
 
 
 @pytest.fixture(scope="session")
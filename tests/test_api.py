@@ -1,8 +1,15 @@
 # pylint: disable=invalid-name,missing-docstring,no-self-use
 
+import datetime
+import json
+
 import pytest
+import sqlalchemy as sa
+
+from pyramid.testing import DummyRequest, testConfig
 
-from ensign import BinaryFlag
+from ensign import BinaryFlag, DefaultStorage, PercentageFlag, RuleFlag
+from ensign.api.tweens import snapshot_tween_factory
 
 
 @pytest.mark.component
@@ -19,6 +26,33 @@ class TestFlagsAPI:
 
         assert response.json["name"] == "flag0"
 
+    def test_get_statements(self, api):
+        PercentageFlag.create("flag0", label="Flag 0").set(25)
+        statements = []
+
+        def count(*args):  # pylint: disable=unused-argument
+            statements.append(args[2])
+
+        sa.event.listen(DefaultStorage.engine, "before_cursor_execute", count)
+        try:
+            response = api.get("/flags/flag0", status=200)
+        finally:
+            sa.event.remove(
+                DefaultStorage.engine, "before_cursor_execute", count,
+            )
+
+        # Version, information and last used date.
+        assert len(statements) == 3
+        assert response.json == dict(
+            name="flag0",
+            value=25,
+            active="ACTIVE",
+            label="Flag 0",
+            description="",
+            tags="",
+        )
+        assert DefaultStorage.used("flag0") is not None
+
     def test_collection_get(self, api):
         names = ["flag0", "flag1", "flag42"]
         for name in names:
@@ -29,6 +63,157 @@ class TestFlagsAPI:
         for item in response.json:
             assert item["name"] in names
 
+    def test_collection_get_full(self, api):
+        flag = BinaryFlag.create(
+            "flag0",
+            label="Fake flag",
+            description="Flag for testing purposes",
+            tags="test,fake",
+        )
+        flag.set()
+        response = api.get("/flags", status=200)
+
+        assert response.json == [{
+            "name": "flag0",
+            "value": True,
+            "active": "NEW",
+            "label": "Fake flag",
+            "description": "Flag for testing purposes",
+            "tags": "test,fake",
+        }]
+
+    def test_collection_get_pages(self, api):
+        for name in ["flag0", "flag1", "flag2"]:
+            BinaryFlag.create(name)
+
+        response = api.get("/flags", {"limit": 2}, status=200)
+        assert [item["name"] for item in response.json] == ["flag0", "flag1"]
+        assert response.headers["Link"] == \
+            '<http://localhost/flags?after=flag1&limit=2>; rel="next"'
+
+        response = api.get("/flags", {"after": "flag1", "limit": 2})
+        assert [item["name"] for item in response.json] == ["flag2"]
+        assert "Link" not in response.headers
+
+    @pytest.mark.parametrize("limit", ["0", "-1", "many"])
+    def test_collection_get_bad_limit(self, api, limit):
+        api.get("/flags", {"limit": limit}, status=400)
+
+    @pytest.mark.parametrize("count", [0, 1, 3])
+    def test_collection_get_stream(self, api, count):
+        for i in range(count):
+            BinaryFlag.create(f"flag{i}")
+
+        response = api.get("/flags", {"stream": "true"}, status=200)
+        assert response.content_type == "application/json"
+        assert response.json == api.get("/flags").json
+        assert len(response.json) == count
+
+    def test_collection_get_stream_page(self, api):
+        for name in ["flag0", "flag1", "flag2"]:
+            BinaryFlag.create(name)
+
+        response = api.get(
+            "/flags",
+            {"stream": "true", "after": "flag0", "limit": 1},
+        )
+        assert [item["name"] for item in response.json] == ["flag1"]
+
+    def test_collection_get_filters(self, api):
+        BinaryFlag.create("flag0", tags="test,fake")
+        BinaryFlag.create("flag1", tags="test")
+        BinaryFlag.create("flag2", tags="test,fake")
+        BinaryFlag("flag1").set()
+        bool(BinaryFlag("flag1"))
+        bool(BinaryFlag("flag2"))
+
+        def names(*params):
+            response = api.get("/flags", list(params), status=200)
+            return [item["name"] for item in response.json]
+
+        assert names(("tag", "test")) == ["flag0", "flag1", "flag2"]
+        assert names(("tag", "test"), ("tag", "fake")) == ["flag0", "flag2"]
+        assert names(("tag", "fake"), ("active", "NEW")) == ["flag0"]
+        assert names(("active", "ACTIVE"), ("type", "binary")) == \
+            ["flag1", "flag2"]
+        assert names(("active", "INACTIVE")) == []
+
+    def test_collection_get_inactive(self, api):
+        BinaryFlag.create("flag0")
+        BinaryFlag.create("flag1")
+        with DefaultStorage.session() as connection:
+            connection.execute(
+                DefaultStorage.flags.update().
+                where(DefaultStorage.flags.c.name == "flag0").
+                values(used=datetime.datetime.now() - datetime.timedelta(8))
+            )
+
+        response = api.get("/flags", {"active": "INACTIVE"}, status=200)
+        assert [(f["name"], f["active"]) for f in response.json] == \
+            [("flag0", "INACTIVE")]
+        response = api.get("/flags", {"stream": "true"}, status=200)
+        assert [f["active"] for f in response.json] == ["INACTIVE", "NEW"]
+
+    def test_collection_get_filters_pages(self, api):
+        for name in ["flag0", "flag1", "flag2"]:
+            BinaryFlag.create(name, tags="test")
+
+        response = api.get("/flags", [("tag", "test"), ("limit", 1)])
+        assert response.headers["Link"] == (
+            '<http://localhost/flags?tag=test&after=flag0&limit=1>; '
+            'rel="next"'
+        )
+
+    @pytest.mark.parametrize("params", [
+        {"active": "SOMETIMES"},
+        {"type": "ternary"},
+    ])
+    def test_collection_get_bad_filters(self, api, params):
+        api.get("/flags", params, status=400)
+
+    def test_get_not_modified(self, api):
+        BinaryFlag.create("flag0")
+        etag = api.get("/flags/flag0", status=200).headers["ETag"]
+        assert api.get("/flags/flag0").headers["ETag"] == etag
+
+        response = api.get(
+            "/flags/flag0",
+            headers={"If-None-Match": etag},
+            status=304,
+        )
+        assert response.headers["ETag"] == etag
+        assert not response.body
+
+        api.patch_json("/flags/flag0", {"value": True}, status=204)
+        response = api.get(
+            "/flags/flag0",
+            headers={"If-None-Match": etag},
+            status=200,
+        )
+        assert response.json["value"] is True
+        assert response.headers["ETag"] != etag
+
+    def test_get_not_found(self, api):
+        api.get("/flags/flag42", status=404)
+
+    def test_collection_get_not_modified(self, api):
+        BinaryFlag.create("flag0")
+        etag = api.get("/flags", status=200).headers["ETag"]
+        assert api.get("/flags", {"stream": "true"}).headers["ETag"] == etag
+        api.get("/flags", headers={"If-None-Match": etag}, status=304)
+
+        BinaryFlag.create("flag1")
+        api.get("/flags", headers={"If-None-Match": etag}, status=200)
+
+        etag = api.get("/flags", {"limit": 1}).headers["ETag"]
+        BinaryFlag("flag1").set()
+        api.get(
+            "/flags",
+            {"limit": 1},
+            headers={"If-None-Match": etag},
+            status=304,
+        )
+
     def test_post(self, api):
         payload = {
             "name": "test_flag",
@@ -50,6 +235,20 @@ class TestFlagsAPI:
 
         assert flag
 
+    def test_patch_typed(self, api):
+        PercentageFlag.create("flag0")
+        RuleFlag.create("flag1")
+        api.patch_json("/flags/flag0", {"value": 25}, status=204)
+        rules = '[{"country": {"in": ["ES"]}}]'
+        api.patch_json("/flags/flag1", {"value": rules}, status=204)
+
+        assert api.get("/flags/flag0").json["value"] == 25
+        assert api.get("/flags/flag1").json["value"] == \
+            '[{"country":{"in":["ES"]}}]'
+        assert api.get("/flags", {"type": "rules"}).json[0]["value"] == \
+            '[{"country":{"in":["ES"]}}]'
+        assert RuleFlag("flag1").check({"country": "ES"})
+
     def test_flag_flow(self, api):
         response = api.post_json(
             "/flags",
@@ -69,6 +268,54 @@ class TestFlagsAPI:
         response = api.get("/flags/flag_flow", status=200)
         assert response.json["value"]
 
+    def test_batch(self, api):
+        BinaryFlag.create("flag0", label="Old")
+        body = "".join(
+            json.dumps(dict(name=f"flag{k}", type="binary", value=True)) + "\n"
+            for k in range(3)
+        )
+        response = api.post(
+            "/flags:batch",
+            body,
+            content_type="application/x-ndjson",
+            status=200,
+        )
+        assert response.json == {"flags": 3}
+
+        response = api.get("/flags", status=200)
+        assert [(f["name"], f["value"], f["label"]) for f in response.json] \
+            == [(f"flag{k}", True, "") for k in range(3)]
+
+
+@pytest.mark.component
+@pytest.mark.usefixtures("db")
+class TestSnapshotTween:
+    def test_snapshot(self):
+        flag = BinaryFlag.create("flag0")
+        flag.set()
+
+        def handler(request):
+            flag.unset()
+            return bool(flag)
+
+        with testConfig() as config:
+            tween = snapshot_tween_factory(handler, config.registry)
+            assert tween(DummyRequest())
+        assert not flag
+
+    def test_snapshot_subset(self):
+        flag0 = BinaryFlag.create("flag0")
+        flag1 = BinaryFlag.create("flag1")
+
+        def handler(request):
+            flag0.set()
+            flag1.set()
+            return (bool(flag0), bool(flag1))
+
+        with testConfig(settings={"ensign.snapshot.flags": "flag0"}) as config:
+            tween = snapshot_tween_factory(handler, config.registry)
+            assert tween(DummyRequest()) == (False, True)
+
 
 @pytest.mark.component
 @pytest.mark.usefixtures("db")
@@ -96,6 +343,33 @@ class TestFlagsAPIErrors:
             "label": "Label",
         }, status=400)
 
+    @pytest.mark.parametrize("flagclass, value", [
+        (BinaryFlag, 1),
+        (BinaryFlag, None),
+        (PercentageFlag, 101),
+        (PercentageFlag, True),
+        (PercentageFlag, "50"),
+        (RuleFlag, '[{"country": {"like": "ES"}}]'),
+        (RuleFlag, [{"country": {"in": ["ES"]}}]),
+        (RuleFlag, "ES"),
+    ])
+    def test_patch_400_badvalue(self, api, flagclass, value):
+        flagclass.create("flag0")
+        api.patch_json("/flags/flag0", {"value": value}, status=400)
+        assert DefaultStorage.info("flag0").version == 1
+
+    def test_batch_400(self, api):
+        api.post(
+            "/flags:batch",
+            '{"name": "flag0", "type": "binary", "value": "yes"}\n',
+            content_type="application/x-ndjson",
+            status=400,
+        )
+
+    def test_batch_route(self, api):
+        api.post("/flagsbatch", "", status=404)
+        api.post("/flags:other", "", status=404)
+
     def test_patch_404(self, api):
         api.patch_json("/flags/flag0", {
             "value": True,
@@ -0,0 +1,127 @@
+# pylint: disable=invalid-name,missing-docstring,no-self-use
+
+import asyncio
+
+import pytest
+
+from zope.interface.verify import verifyObject
+
+from ensign import AsyncBinaryFlag, AsyncSQLStorage, FlagDoesNotExist
+from ensign._interfaces import IAsyncStorage
+from ensign._storage import FlagTypes
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.fixture(scope="function")
+def asyncstore(fakestore):
+    """
+    Fixture providing an asynchronous storage, backed by a fake storage.
+    """
+
+    return AsyncSQLStorage(fakestore)
+
+
+@pytest.mark.unit
+class TestAsyncStorage:
+    def test_implements_iasyncstorage(self, asyncstore):
+        assert verifyObject(IAsyncStorage, asyncstore)
+
+    def test_concurrent_loads_batched(self, asyncstore, fakestore):
+        batches = []
+        load_many = fakestore.load_many
+
+        def counting_load_many(names, flagtype):
+            batches.append(sorted(names))
+            return load_many(names, flagtype)
+
+        fakestore.load_many = counting_load_many
+
+        async def scenario():
+            flags = [
+                await AsyncBinaryFlag.create(f"flag{k}", store=asyncstore)
+                for k in range(3)
+            ]
+            await flags[1].set()
+            return await asyncio.gather(*[flag.check() for flag in flags])
+
+        assert run(scenario()) == [False, True, False]
+        assert batches == [["flag0", "flag1", "flag2"]]
+
+
+@pytest.mark.unit
+class TestAsyncFlag:
+    def test_create_check(self, asyncstore):
+        async def scenario():
+            flag = await AsyncBinaryFlag.create("flag0", store=asyncstore)
+            before = await flag.check()
+            await flag.set()
+            return before, await flag.check()
+
+        assert run(scenario()) == (False, True)
+
+    def test_get_raises_if_inexistent(self, asyncstore):
+        with pytest.raises(FlagDoesNotExist):
+            run(AsyncBinaryFlag.get("flag42", store=asyncstore))
+
+    def test_check_raises_if_inexistent(self, asyncstore):
+        flag = AsyncBinaryFlag("flag42", store=asyncstore)
+        with pytest.raises(FlagDoesNotExist):
+            run(flag.check())
+
+    def test_set_raises_if_inexistent(self, asyncstore):
+        flag = AsyncBinaryFlag("flag42", store=asyncstore)
+        with pytest.raises(FlagDoesNotExist):
+            run(flag.set())
+
+    def test_no_sync_evaluation(self, asyncstore):
+        with pytest.raises(TypeError):
+            bool(AsyncBinaryFlag("flag0", store=asyncstore))
+
+    def test_all(self, asyncstore):
+        async def scenario():
+            for name in ["flag0", "flag1"]:
+                await AsyncBinaryFlag.create(name, store=asyncstore)
+            return await AsyncBinaryFlag.all(store=asyncstore)
+
+        assert {flag.name for flag in run(scenario())} == {"flag0", "flag1"}
+
+    def test_all_typed(self, asyncstore):
+        async def scenario():
+            await AsyncBinaryFlag.create("flag0", store=asyncstore)
+            await asyncstore.create("flag1", FlagTypes.PERCENTAGE)
+            return await AsyncBinaryFlag.all(store=asyncstore)
+
+        assert [flag.name for flag in run(scenario())] == ["flag0"]
+
+    def test_load_many(self, asyncstore):
+        async def scenario():
+            flag = await AsyncBinaryFlag.create("flag0", store=asyncstore)
+            await flag.set()
+            await AsyncBinaryFlag.create("flag1", store=asyncstore)
+            return await AsyncBinaryFlag.load_many(
+                ["flag0", "flag1"],
+                store=asyncstore,
+            )
+
+        assert run(scenario()) == {"flag0": True, "flag1": False}
+
+    def test_decorator(self, asyncstore):
+        async def scenario():
+            flag = await AsyncBinaryFlag.create("flag0", store=asyncstore)
+
+            @flag
+            async def testfun():
+                return "executed"
+
+            skipped = await testfun()
+            await flag.set()
+            return skipped, await testfun()
+
+        assert run(scenario()) == (None, "executed")
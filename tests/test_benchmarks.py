@@ -1,10 +1,32 @@
 # pylint: skip-file
 
+import array
+import io
+import itertools
+import json
+import os
+import tracemalloc
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
+import sqlalchemy as sa
 
-from ensign import BinaryFlag, DefaultStorage
+from ensign import (
+    BinaryFlag,
+    CachedStorage,
+    DefaultStorage,
+    EvalPolicy,
+    FileStorage,
+    PercentageFlag,
+    RuleFlag,
+    evaluate_subjects,
+    export_snapshot,
+)
+from ensign._hashing import bucket, seed
+from ensign._storage import FlagTypes, SQLStorage
+from ensign.api import main
 
 
 @pytest.mark.benchmark
@@ -30,6 +52,49 @@ def test_benchmark_load(benchmark, db):
     assert result
 
 
+@pytest.mark.benchmark
+@pytest.mark.parametrize("threads", [1, 4, 16])
+def test_benchmark_load_concurrent(benchmark, _pre_db, threads):
+    # Loads from other threads need committed data, outside the db fixture.
+    name = str(uuid.uuid4())
+    BinaryFlag.create(name).set()
+    flag = BinaryFlag(name)
+
+    def load_flags(executor):
+        return all(executor.map(lambda _: flag.value, range(threads * 10)))
+
+    try:
+        with ThreadPoolExecutor(threads) as executor:
+            result = benchmark(load_flags, executor)
+    finally:
+        DefaultStorage.engine.execute(
+            DefaultStorage.flags.delete().
+            where(DefaultStorage.flags.c.name == name)
+        )
+    assert result
+
+
+@pytest.mark.benchmark
+def test_benchmark_plain_call(benchmark):
+    def testfun():
+        return "executed"
+
+    assert benchmark(testfun) == "executed"
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("policy", list(EvalPolicy))
+def test_benchmark_decorator(benchmark, db, policy):
+    flag = BinaryFlag.create("flag0")
+    flag.set()
+
+    @flag(policy=policy, ttl=60)
+    def testfun():
+        return "executed"
+
+    assert benchmark(testfun) == "executed"
+
+
 @pytest.mark.benchmark
 def test_benchmark_store(benchmark, db):
     flag = BinaryFlag.create("flag0")
@@ -81,6 +146,18 @@ def test_benchmark_api_get(benchmark, db, api):
     benchmark(api.get, "/flags/flag0", status=200)
 
 
+@pytest.mark.benchmark
+def test_benchmark_api_get_not_modified(benchmark, db, api):
+    BinaryFlag.create("flag0")
+    etag = api.get("/flags/flag0").headers["ETag"]
+    benchmark(
+        api.get,
+        "/flags/flag0",
+        headers={"If-None-Match": etag},
+        status=304,
+    )
+
+
 @pytest.mark.benchmark
 def test_benchmark_api_get_all(benchmark, db, api):
     for k in range(100):
@@ -88,7 +165,263 @@ def test_benchmark_api_get_all(benchmark, db, api):
     benchmark(api.get, "/flags", status=200)
 
 
+@pytest.mark.benchmark
+def test_benchmark_api_get_all_1000(benchmark, db, api):
+    for k in range(1000):
+        BinaryFlag.create(f"flag{k}")
+    benchmark(api.get, "/flags", status=200)
+
+
+@pytest.mark.benchmark
+def test_benchmark_api_get_all_1000_stream(benchmark, db, api):
+    DefaultStorage.create_many(
+        [dict(name=f"flag{k}") for k in range(1000)],
+        FlagTypes.BINARY,
+    )
+    benchmark(api.get, "/flags", {"stream": "true"}, status=200)
+
+
+@pytest.mark.benchmark
+def test_benchmark_activity_all_1000(benchmark, db):
+    DefaultStorage.create_many(
+        [dict(name=f"flag{k}") for k in range(1000)],
+        FlagTypes.BINARY,
+    )
+    result = benchmark(DefaultStorage.activity_all, BinaryFlag.DAYS_INACTIVE)
+    assert len(result) == 1000
+
+
 @pytest.mark.benchmark
 def test_benchmark_patch(benchmark, db, api):
     BinaryFlag.create("flag0")
     benchmark(api.patch_json, "/flags/flag0", {"value": True}, status=204)
+
+
+@pytest.mark.benchmark
+def test_benchmark_filestorage_cold_start(benchmark, fakestore, tmpdir):
+    fakestore.create_many(
+        [dict(name=f"flag{i}") for i in range(1000)],
+        FlagTypes.BINARY,
+    )
+    path = str(tmpdir.join("flags.snapshot"))
+    export_snapshot(fakestore, path)
+
+    def cold_start():
+        return bool(BinaryFlag("flag500", store=FileStorage(path)))
+
+    benchmark(cold_start)
+
+
+@pytest.mark.benchmark
+def test_benchmark_api_startup(benchmark, monkeypatch):
+    # Startup shouldn't touch the database: use a store of its own, as the
+    # default one is shared by the other tests.
+    store = SQLStorage()
+    monkeypatch.setattr("ensign.api.DefaultStorage", store)
+
+    def startup():
+        app = main({}, **{"ensign.db": os.environ.get("FLAGS_DB")})
+        store.close()
+        return app
+
+    assert benchmark(startup) is not None
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("prebuilt", [False, True], ids=["adhoc", "prebuilt"])
+def test_benchmark_statement_overhead(benchmark, tmpdir, prebuilt):
+    # Against a local SQLite file, the database time is small and the same
+    # for both statements, leaving the Python-side overhead to compare.
+    store = SQLStorage()
+    store.init_db({"ensign.db": f"sqlite:///{tmpdir.join('flags.db')}"})
+    store.create_schema()
+    store.create("flag0", FlagTypes.BINARY, value_binary=True)
+
+    def adhoc(connection):
+        query = sa.select([store.flags.c.value_binary]).\
+            where(store.flags.c.name == "flag0")
+        return connection.execute(query).fetchone()[0]
+
+    def cached(connection):
+        query = store.queries.load[FlagTypes.BINARY]
+        return connection.execute(query, b_name="flag0").fetchone()[0]
+
+    try:
+        with store.engine.connect() as connection:
+            assert benchmark(cached if prebuilt else adhoc, connection)
+    finally:
+        store.close()
+
+
+def _traced(function, *args):
+    """
+    Run the function under tracemalloc, returning the memory it retained and
+    its peak usage, in bytes.
+    """
+
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.benchmark
+def test_benchmark_cached_evaluation_memory(benchmark, fakestore):
+    cache = CachedStorage(fakestore, ttl=3600)
+    flag = BinaryFlag.create("flag0", store=cache)
+    flag.set()
+
+    def evaluate(count):
+        for _ in itertools.repeat(None, count):
+            bool(flag)
+
+    evaluate(1000)
+    retained, peak = _traced(evaluate, 100)
+    retained_many, peak_many = _traced(evaluate, 100000)
+    benchmark.extra_info.update(retained=retained_many, peak=peak_many)
+    # Evaluations served from the cache shouldn't allocate any memory, other
+    # than reusing the cache's counters.
+    assert retained_many <= retained
+    assert peak_many <= peak
+
+    benchmark(evaluate, 1000)
+
+
+@pytest.mark.benchmark
+def test_benchmark_flag_handles_memory(benchmark, fakestore):
+    fakestore.create_many(
+        [dict(name=f"flag{i}") for i in range(10000)],
+        FlagTypes.BINARY,
+    )
+
+    retained, _ = _traced(BinaryFlag.all, fakestore)
+    benchmark.extra_info.update(per_flag=retained / 10000)
+
+    benchmark(BinaryFlag.all, fakestore)
+
+
+@pytest.mark.benchmark
+def test_benchmark_percentage_check(benchmark, fakestore):
+    flag = PercentageFlag.create("flag0", store=CachedStorage(fakestore))
+    flag.set(50)
+    subjects = range(10000)
+
+    def check_all():
+        return sum(map(flag.check, subjects))
+
+    result = benchmark(check_all)
+    assert 4000 < result < 6000
+
+
+@pytest.mark.benchmark
+def test_benchmark_percentage_bucket(benchmark):
+    flag_seed = seed("flag0")
+    keys = range(10000)
+
+    def bucket_all():
+        return [bucket(key, flag_seed) for key in keys]
+
+    assert len(benchmark(bucket_all)) == len(keys)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("count", [1, 10, 100])
+def test_benchmark_rule_check(benchmark, fakestore, count):
+    # The context only matches the last rule, so all of them are evaluated.
+    flag = RuleFlag.create("flag0", store=CachedStorage(fakestore))
+    flag.set([
+        {"country": {"in": ["ES", "PT"]}, "account": {"in": [rule]}}
+        for rule in range(count)
+    ])
+    context = {"country": "ES", "account": count - 1}
+
+    assert benchmark(flag.check, context)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("subjects", ["loop", "list", "array"])
+def test_benchmark_percentage_evaluate_many(benchmark, fakestore, subjects):
+    flag = PercentageFlag.create("flag0", store=CachedStorage(fakestore))
+    flag.set(50)
+    ids = array.array("q", range(100000))
+
+    if subjects == "loop":
+        def evaluate():
+            return [flag.check(subject) for subject in ids]
+    elif subjects == "list":
+        def evaluate():
+            return flag.evaluate_many(ids.tolist())
+    else:
+        def evaluate():
+            return flag.evaluate_many(ids)
+
+    assert 45000 < sum(benchmark(evaluate)) < 55000
+
+
+@pytest.fixture(scope="module")
+def subjects_file(tmpdir_factory):
+    path = tmpdir_factory.mktemp("pipeline").join("subjects.ndjson")
+    countries = ["ES", "PT", "FR", "DE"]
+    with path.open("w") as output:
+        for subject in range(200000):
+            output.write(
+                f'{{"id":{subject},"country":"{countries[subject % 4]}"}}\n'
+            )
+    return path
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("processes", [1, 2, 4])
+def test_benchmark_evaluate_subjects(benchmark, fakestore, subjects_file,
+                                     processes):
+    # Scales with the number of processes up to the number of cores.
+    PercentageFlag.create("percentage", store=fakestore).set(50)
+    RuleFlag.create("rules", store=fakestore).set(
+        [{"country": {"in": ["ES", "PT"]}}],
+    )
+
+    def evaluate():
+        with subjects_file.open() as source:
+            return evaluate_subjects(
+                source,
+                io.StringIO(),
+                ["percentage", "rules"],
+                fakestore,
+                processes=processes,
+            )
+
+    assert benchmark.pedantic(evaluate, rounds=3) == 200000
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("path", ["loop", "batch"])
+def test_benchmark_api_import_10000(benchmark, db, api, path):
+    def definitions():
+        prefix = uuid.uuid4().hex
+        return [
+            dict(name=f"{prefix}{k}", label="Imported", tags="a,b")
+            for k in range(10000)
+        ]
+
+    def post_each(flags):
+        for flag in flags:
+            api.post_json("/flags", flag, status=201)
+
+    def post_batch(flags):
+        body = "".join(
+            json.dumps(dict(flag, type="binary")) + "\n" for flag in flags
+        )
+        api.post(
+            "/flags:batch",
+            body,
+            content_type="application/x-ndjson",
+            status=200,
+        )
+
+    benchmark.pedantic(
+        post_each if path == "loop" else post_batch,
+        setup=lambda: ((definitions(),), {}),
+        rounds=3,
+    )
@@ -0,0 +1,120 @@
+# pylint: disable=invalid-name,missing-docstring,no-self-use
+
+import argparse
+import datetime
+import os
+
+import pytest
+
+from zope.interface.verify import verifyObject
+
+from ensign import BinaryFlag, FileStorage, export_snapshot
+from ensign._filestorage import ReadOnlyStorage
+from ensign._flags import FlagDoesNotExist
+from ensign._interfaces import IStorage
+from ensign._storage import DefaultStorage, FlagActive, FlagTypes
+from ensign import cli
+
+
+@pytest.fixture(scope="function")
+def snapshot_path(tmpdir):
+    return str(tmpdir.join("flags.snapshot"))
+
+
+@pytest.fixture(scope="function")
+def filestore(fakestore, snapshot_path):
+    BinaryFlag.create("flag0", store=fakestore).set()
+    BinaryFlag.create("flag1", store=fakestore, label="Flag 1").unset()
+    BinaryFlag.create("flag2", store=fakestore)
+    fakestore.STORE["flag1"]["used"] = datetime.datetime(2018, 1, 2, 3, 4, 5)
+    export_snapshot(fakestore, snapshot_path)
+    return FileStorage(snapshot_path)
+
+
+@pytest.mark.unit
+class TestFileStorage:
+    def test_implements_istorage(self, filestore):
+        assert verifyObject(IStorage, filestore)
+
+    def test_evaluate(self, filestore):
+        assert BinaryFlag("flag0", store=filestore)
+        assert not BinaryFlag("flag1", store=filestore)
+        assert not BinaryFlag("flag2", store=filestore)
+
+    def test_missing(self, filestore):
+        assert not filestore.exists("flag")
+        assert not filestore.exists("flag3")
+        with pytest.raises(FlagDoesNotExist):
+            BinaryFlag("flag3", store=filestore)
+        with pytest.raises(KeyError):
+            filestore.load("flag00", FlagTypes.BINARY)
+
+    def test_load_many(self, filestore):
+        assert filestore.load_many(
+            ["flag0", "flag1", "flag3"],
+            FlagTypes.BINARY,
+        ) == {"flag0": True, "flag1": False}
+
+    def test_info(self, filestore):
+        info = filestore.info("flag1")
+        assert info["label"] == "Flag 1"
+        assert info["type"] == FlagTypes.BINARY
+        assert filestore.used("flag1") == \
+            datetime.datetime(2018, 1, 2, 3, 4, 5)
+        assert filestore.used("flag0") is None
+
+    def test_activity(self, filestore):
+        assert filestore.activity("flag0", 7) == FlagActive.NEW
+        assert filestore.activity_all(7) == {
+            "flag0": FlagActive.NEW,
+            "flag1": FlagActive.INACTIVE,
+            "flag2": FlagActive.NEW,
+        }
+
+    def test_all(self, filestore):
+        assert filestore.all() == ["flag0", "flag1", "flag2"]
+        assert [i["name"] for i in filestore.info_all(["flag2", "flag3"])] == \
+            ["flag2"]
+
+    def test_read_only(self, filestore):
+        with pytest.raises(ReadOnlyStorage):
+            filestore.create("flag3", FlagTypes.BINARY)
+        with pytest.raises(ReadOnlyStorage):
+            BinaryFlag("flag0", store=filestore).unset()
+
+    def test_reload(self, fakestore, filestore, snapshot_path):
+        assert not filestore.reload()
+        BinaryFlag("flag2", store=fakestore).set()
+        BinaryFlag.create("flag3", store=fakestore).set()
+        export_snapshot(fakestore, snapshot_path)
+        assert filestore.reload()
+        assert BinaryFlag("flag2", store=filestore)
+        assert BinaryFlag("flag3", store=filestore)
+
+    def test_empty(self, fakestore, snapshot_path):
+        export_snapshot(fakestore, snapshot_path)
+        filestore = FileStorage(snapshot_path)
+        assert filestore.all() == []
+        assert not filestore.exists("flag0")
+
+    def test_not_a_snapshot(self, snapshot_path):
+        with open(snapshot_path, "wb") as output:
+            output.write(b"\0" * 64)
+        with pytest.raises(ValueError):
+            FileStorage(snapshot_path)
+
+    def test_no_leftovers(self, filestore, snapshot_path):
+        assert os.listdir(os.path.dirname(snapshot_path)) == \
+            [os.path.basename(snapshot_path)]
+
+
+@pytest.mark.integration
+class TestSnapshotCommand:
+    def test_snapshot(self, db, snapshot_path):
+        BinaryFlag.create("flag0").set()
+        BinaryFlag.create("flag1", label="Flag 1")
+        cli.snapshot(argparse.Namespace(path=snapshot_path), DefaultStorage)
+        filestore = FileStorage(snapshot_path)
+        assert BinaryFlag("flag0", store=filestore)
+        assert not BinaryFlag("flag1", store=filestore)
+        assert filestore.info("flag1")["label"] == "Flag 1"
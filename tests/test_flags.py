@@ -1,15 +1,35 @@
 # pylint: disable=invalid-name,missing-docstring,no-self-use
 
+import argparse
+import atexit
 import datetime
+import threading
+import time
 
 import pytest
+import sqlalchemy as sa
 
-from zope.interface.verify import verifyClass
+from zope.interface.verify import verifyClass, verifyObject
 
-from ensign import BinaryFlag
-from ensign._flags import FlagActive, FlagDoesNotExist
+from ensign import (
+    BinaryFlag,
+    CachedStorage,
+    EvalPolicy,
+    FlagSnapshot,
+    PercentageFlag,
+    RuleFlag,
+)
+from ensign import cli
+from ensign._flags import FlagActive, FlagDoesNotExist, FlagExpr
 from ensign._interfaces import IFlag, IStorage
-from ensign._storage import DefaultStorage, SQLStorage, FlagTypes
+from ensign._notify import InvalidationListener, LocalChannel
+from ensign._storage import (
+    DefaultStorage,
+    FlagRecord,
+    FlagTypes,
+    SQLStorage,
+    UsageBuffer,
+)
 
 
 @pytest.mark.unit
@@ -21,8 +41,40 @@ class TestInterfaces:
         assert verifyClass(IStorage, SQLStorage)
 
 
+@pytest.mark.unit
+class TestFlagRecord:
+    def test_fields(self):
+        record = FlagRecord.from_mapping(
+            {"name": "flag0", "type": FlagTypes.BINARY, "label": "Flag"},
+        )
+        assert record.label == record["label"] == record.get("label")
+        assert record["value_binary"] is None
+        assert record.get("value_unknown", 42) == 42
+        assert record[0] == "flag0"
+        assert dict(zip(record.keys(), record))["type"] == FlagTypes.BINARY
+        with pytest.raises(KeyError):
+            record["count"]  # pylint: disable=pointless-statement
+
+    def test_immutable(self):
+        record = FlagRecord.from_mapping({"name": "flag0"})
+        with pytest.raises(AttributeError):
+            record.label = "Flag"
+        with pytest.raises(AttributeError):
+            record.extra = 42
+
+    def test_interned_name(self):
+        name = "".join(["flag", "0"])
+        row = [name] + [None] * (len(FlagRecord._fields) - 1)
+        assert FlagRecord.from_row(row).name is \
+            FlagRecord.from_mapping({"name": "flag0"}).name
+
+
 @pytest.mark.unit
 class TestFlagBasics:
+    def test_slotted(self, fakestore):
+        flag = BinaryFlag.create("flag0", store=fakestore)
+        assert not hasattr(flag, "__dict__")
+
     def test_flag_create(self, fakestore):
         flag = BinaryFlag.create(
             "flag0",
@@ -41,6 +93,27 @@ class TestFlagBasics:
         with pytest.raises(FlagDoesNotExist):
             BinaryFlag("flag42", store=fakestore)
 
+    def test_lazy_flag_raises_on_access(self, fakestore):
+        flag = BinaryFlag("flag42", store=fakestore, lazy=True)
+        with pytest.raises(FlagDoesNotExist):
+            bool(flag)
+        with pytest.raises(FlagDoesNotExist):
+            flag.set()
+        with pytest.raises(FlagDoesNotExist):
+            flag.info  # pylint: disable=pointless-statement
+        with pytest.raises(FlagDoesNotExist):
+            flag.active  # pylint: disable=pointless-statement
+
+    def test_lazy_construction_skips_exists(self, fakestore):
+        def exists(name):
+            raise AssertionError(f"Unexpected exists({name})")
+
+        fakestore.exists = exists
+        BinaryFlag.create("flag0", store=fakestore).set()
+        assert [bool(flag) for flag in BinaryFlag.all(store=fakestore)] == [
+            True,
+        ]
+
     def test_get_all_flags(self, fakestore):
         names = ["flag0", "flag1", "flag2"]
         for name in names:
@@ -50,6 +123,33 @@ class TestFlagBasics:
         for flag in allflags:
             assert flag.name in names
 
+    def test_get_all_flags_of_type(self, fakestore):
+        BinaryFlag.create("flag0", store=fakestore)
+        PercentageFlag.create("flag1", store=fakestore)
+        assert [f.name for f in BinaryFlag.all(store=fakestore)] == ["flag0"]
+        assert [f.name for f in PercentageFlag.all(store=fakestore)] == \
+            ["flag1"]
+
+    def test_construction_checks_type(self, fakestore):
+        PercentageFlag.create("flag0", store=fakestore)
+        with pytest.raises(FlagDoesNotExist):
+            BinaryFlag("flag0", store=fakestore)
+        assert PercentageFlag("flag0", store=fakestore).name == "flag0"
+
+    def test_load_many(self, fakestore):
+        BinaryFlag.create("flag0", store=fakestore).set()
+        BinaryFlag.create("flag1", store=fakestore).unset()
+        BinaryFlag.create("flag2", store=fakestore)
+        assert BinaryFlag.load_many(
+            ["flag0", "flag1", "flag2"],
+            store=fakestore,
+        ) == {"flag0": True, "flag1": False, "flag2": False}
+
+    def test_load_many_raises_if_inexistent(self, fakestore):
+        BinaryFlag.create("flag0", store=fakestore)
+        with pytest.raises(FlagDoesNotExist):
+            BinaryFlag.load_many(["flag0", "flag42"], store=fakestore)
+
 
 @pytest.mark.unit
 class TestBinaryFlagAliases:
@@ -104,6 +204,66 @@ class TestFlagOperations:
         assert not ~flag1
 
 
+@pytest.mark.unit
+class TestFlagExpr:
+    @pytest.fixture
+    def flags(self, fakestore):
+        flag0 = BinaryFlag.create("flag0", store=fakestore)
+        flag0.unset()
+        flag1 = BinaryFlag.create("flag1", store=fakestore)
+        flag1.set()
+        return flag0, flag1
+
+    def test_composition(self, flags):
+        flag0, flag1 = flags
+        assert isinstance(flag0 & flag1, FlagExpr)
+        assert str(~flag0 & flag1 | flag0) == (
+            "((~<Flag(flag0=False)> & <Flag(flag1=True)>) | "
+            "<Flag(flag0=False)>)"
+        )
+        assert ~flag0 & flag1
+        assert not (flag0 | flag1) & flag0
+        assert (flag0 ^ flag1) & ~(flag0 & flag1)
+
+    def test_short_circuit(self, flags, fakestore):
+        flag0, flag1 = flags
+        loaded = []
+        load = fakestore.load
+
+        def counting_load(name, flagtype):
+            loaded.append(name)
+            return load(name, flagtype)
+
+        fakestore.load = counting_load
+        assert not flag0 & flag1
+        assert loaded == ["flag0"]
+        assert flag1 | flag0
+        assert loaded == ["flag0", "flag1"]
+
+    def test_batch(self, flags, fakestore):
+        flag0, flag1 = flags
+        batches = []
+        load_many = fakestore.load_many
+
+        def counting_load_many(names, flagtype):
+            batches.append(sorted(names))
+            return load_many(names, flagtype)
+
+        fakestore.load_many = counting_load_many
+        expr = (flag0 | flag1) & ~flag0 & flag1
+        assert expr.evaluate(batch=True)
+        assert batches == [["flag0", "flag1"]]
+
+    def test_decorator(self, flags):
+        flag0, flag1 = flags
+
+        def testfun():
+            return "executed"
+
+        assert (flag0 | flag1)(testfun)() == "executed"
+        assert (flag0 & flag1)(testfun)() is None
+
+
 @pytest.mark.unit
 class TestFlagCall:
     def test_flag_wrapper(self, fakeflag):
@@ -126,6 +286,173 @@ class TestFlagCall:
         assert testfun() is None
 
 
+@pytest.mark.unit
+class TestFlagCallPolicies:
+    @pytest.fixture
+    def loads(self, fakestore):
+        loaded = []
+        load = fakestore.load
+
+        def counting_load(name, flagtype):
+            loaded.append(name)
+            return load(name, flagtype)
+
+        fakestore.load = counting_load
+        return loaded
+
+    def test_call(self, fakeflag, loads):
+        @fakeflag(policy=EvalPolicy.CALL)
+        def testfun():
+            return "executed"
+
+        fakeflag.set()
+        assert testfun() == "executed"
+        fakeflag.unset()
+        assert testfun() is None
+        assert len(loads) == 2
+
+    def test_cached(self, fakeflag, loads):
+        @fakeflag(policy=EvalPolicy.CACHED, ttl=60)
+        def testfun():
+            return "executed"
+
+        fakeflag.set()
+        assert testfun() == "executed"
+        fakeflag.unset()
+        assert testfun() == "executed"
+        assert len(loads) == 1
+
+    def test_cached_expires(self, fakeflag):
+        @fakeflag(policy=EvalPolicy.CACHED, ttl=0)
+        def testfun():
+            return "executed"
+
+        fakeflag.set()
+        assert testfun() == "executed"
+        fakeflag.unset()
+        assert testfun() is None
+
+    def test_cached_stale_on_failure(self, fakeflag, fakestore):
+        @fakeflag(policy=EvalPolicy.CACHED, ttl=0)
+        def testfun():
+            return "executed"
+
+        fakeflag.set()
+        assert testfun() == "executed"
+
+        def fail(name, flagtype):
+            raise ConnectionError()
+
+        fakestore.load = fail
+        assert testfun() == "executed"
+
+    def test_snapshot(self, fakeflag, fakestore, loads):
+        @fakeflag(policy=EvalPolicy.SNAPSHOT)
+        def testfun():
+            return "executed"
+
+        fakeflag.set()
+        with FlagSnapshot(fakestore):
+            assert testfun() == "executed"
+            fakeflag.unset()
+            assert testfun() == "executed"
+        with FlagSnapshot(fakestore):
+            assert testfun() is None
+        assert testfun() is None
+        assert len(loads) == 1
+
+    def test_snapshot_threads(self, fakeflag, fakestore, loads):
+        @fakeflag(policy=EvalPolicy.SNAPSHOT)
+        def testfun():
+            return "executed"
+
+        # Two requests, in their own threads and snapshots, take turns.
+        turns = [threading.Event() for _ in range(4)]
+        results = {}
+
+        def request(name, value, mine):
+            if value:
+                fakeflag.set()
+            else:
+                fakeflag.unset()
+            with FlagSnapshot(fakestore) as snapshot:
+                turns[mine[0]].set()
+                for turn in mine[1:]:
+                    turns[turn - 1].wait(timeout=5)
+                    results.setdefault(name, []).append(testfun())
+                    turns[turn].set()
+                results[name + "_cached"] = list(snapshot.results.values())
+
+        first = threading.Thread(target=request, args=("a", True, [0, 1, 3]))
+        second = threading.Thread(target=request, args=("b", False, [0, 2]))
+        first.start()
+        turns[0].wait(timeout=5)
+        second.start()
+        first.join()
+        second.join()
+
+        assert results["a"] == ["executed", "executed"]
+        assert results["b"] == [None]
+        assert results["a_cached"] == [True]
+        assert results["b_cached"] == [False]
+
+    def test_import(self, fakeflag, loads):
+        fakeflag.set()
+
+        @fakeflag(policy=EvalPolicy.IMPORT)
+        def testfun():
+            return "executed"
+
+        fakeflag.unset()
+        assert testfun() == "executed"
+        assert len(loads) == 1
+
+    def test_fallback(self, fakeflag, fakestore):
+        def fail(name, flagtype):
+            raise ConnectionError()
+
+        fakestore.load = fail
+
+        @fakeflag(fallback=True)
+        def testfun():
+            return "executed"
+
+        @fakeflag
+        def otherfun():
+            return "executed"
+
+        assert testfun() == "executed"
+        with pytest.raises(ConnectionError):
+            otherfun()
+
+    def test_fallback_inexistent(self, fakestore):
+        flag = BinaryFlag("flag42", store=fakestore, lazy=True)
+
+        @flag(fallback=True)
+        def testfun():
+            return "executed"
+
+        with pytest.raises(FlagDoesNotExist):
+            testfun()
+
+    def test_expr(self, fakestore, loads):
+        flag0 = BinaryFlag.create("flag0", store=fakestore)
+        flag1 = BinaryFlag.create("flag1", store=fakestore)
+        flag0.set()
+        flag1.set()
+
+        both = flag0 & flag1
+
+        @both(policy=EvalPolicy.CACHED, ttl=60)
+        def testfun():
+            return "executed"
+
+        assert testfun() == "executed"
+        flag1.unset()
+        assert testfun() == "executed"
+        assert loads == ["flag0", "flag1"]
+
+
 @pytest.mark.unit
 class TestFlagActive:
     def test_flag_new(self, fakestore):
@@ -148,6 +475,455 @@ class TestFlagActive:
         )
         assert flag0.active == FlagActive.INACTIVE
 
+    def test_days_inactive(self, fakestore):
+        class SlowFlag(BinaryFlag):
+            __slots__ = ()
+            DAYS_INACTIVE = 30
+
+        used = datetime.datetime.now() - datetime.timedelta(days=8)
+        BinaryFlag.create("flag0", store=fakestore, used=used)
+        assert SlowFlag("flag0", store=fakestore).active == FlagActive.ACTIVE
+        assert SlowFlag.activity(used) == FlagActive.ACTIVE
+        assert BinaryFlag.activity(used) == FlagActive.INACTIVE
+
+    def test_from_used(self):
+        now = datetime.datetime(2018, 1, 10)
+        assert FlagActive.from_used(None, 7, now) == FlagActive.NEW
+        assert FlagActive.from_used(datetime.datetime(2018, 1, 3), 7, now) \
+            == FlagActive.ACTIVE
+        assert FlagActive.from_used(datetime.datetime(2018, 1, 2), 7, now) \
+            == FlagActive.INACTIVE
+
+
+@pytest.mark.unit
+class TestUsageBuffer:
+    def test_record_coalesces(self):
+        flushed = []
+        usage = UsageBuffer(flushed.append)
+        first = datetime.datetime(2017, 9, 1)
+        last = datetime.datetime(2017, 9, 2)
+        usage.record("flag0", first)
+        usage.record("flag0", last)
+        assert usage.get("flag0") == last
+        usage.flush()
+        assert flushed == [{"flag0": last}]
+        assert usage.get("flag0") is None
+
+    def test_flush_empty(self):
+        flushed = []
+        UsageBuffer(flushed.append).flush()
+        assert not flushed
+
+    def test_flush_when_full(self):
+        flushed = []
+        done = threading.Event()
+
+        def flush(pending):
+            flushed.append(pending)
+            done.set()
+
+        usage = UsageBuffer(flush, interval=60, maxsize=2)
+        usage.start()
+        usage.record("flag0")
+        usage.record("flag1")
+        assert done.wait(timeout=5)
+        usage.stop()
+        assert set(flushed[0]) == {"flag0", "flag1"}
+
+    def test_flush_on_stop(self):
+        flushed = []
+        usage = UsageBuffer(flushed.append, interval=60)
+        usage.start()
+        usage.record("flag0")
+        usage.stop()
+        assert list(flushed[0]) == ["flag0"]
+
+    def test_flush_failure(self, caplog):
+        flushed = []
+        failures = [ConnectionError()]
+        done = threading.Event()
+
+        def flush(pending):
+            if failures:
+                raise failures.pop()
+            flushed.append(pending)
+            done.set()
+
+        first = datetime.datetime(2017, 9, 1)
+        usage = UsageBuffer(flush, interval=0.01)
+        usage.record("flag0", first)
+        usage.start()
+        assert done.wait(timeout=5)
+        usage.stop()
+        assert flushed == [{"flag0": first}]
+        assert "Failed to write flags usage" in caplog.text
+
+    def test_failure_keeps_newer_uses(self):
+        usage = UsageBuffer(lambda pending: 1 / 0)
+        usage.record("flag0", datetime.datetime(2017, 9, 1))
+        usage.record("flag1", datetime.datetime(2017, 9, 1))
+        with pytest.raises(ZeroDivisionError):
+            usage.flush()
+        assert usage.get("flag0") == datetime.datetime(2017, 9, 1)
+
+        original = usage.flush_callback
+
+        def use_again(pending):
+            usage.record("flag0", datetime.datetime(2017, 9, 2))
+            original(pending)
+
+        usage.flush_callback = use_again
+        with pytest.raises(ZeroDivisionError):
+            usage.flush()
+        assert usage.get("flag0") == datetime.datetime(2017, 9, 2)
+        assert usage.get("flag1") == datetime.datetime(2017, 9, 1)
+
+    def test_buffer_usage_again(self, monkeypatch):
+        registered = []
+        monkeypatch.setattr(atexit, "register", registered.append)
+        monkeypatch.setattr(atexit, "unregister", registered.remove)
+        flushed = []
+        store = SQLStorage()
+        store.flush_usage = flushed.append
+
+        store.buffer_usage(interval=60)
+        first = store.usage
+        first.record("flag0")
+        store.buffer_usage(interval=60)
+        assert first.thread is None
+        assert [list(pending) for pending in flushed] == [["flag0"]]
+        assert registered == [store.close]
+
+        store.close()
+        assert store.usage is None
+        assert not registered
+
+
+@pytest.mark.unit
+class TestCachedStorage:
+    def test_implements_istorage(self, fakestore):
+        assert verifyObject(IStorage, CachedStorage(fakestore))
+
+    def test_steady_state_hits(self, fakestore):
+        cache = CachedStorage(fakestore)
+        flag0 = BinaryFlag.create("flag0", store=cache)
+        flag0.set()
+        assert flag0
+        misses = cache.misses
+        for _ in range(10):
+            assert flag0
+        assert cache.misses == misses
+        assert cache.hits >= 10
+
+    def test_invalidate_on_store(self, fakestore):
+        cache = CachedStorage(fakestore)
+        flag0 = BinaryFlag.create("flag0", store=cache)
+        flag0.set()
+        assert flag0
+        flag0.unset()
+        assert not flag0
+
+    @pytest.mark.parametrize("method", ["load", "load_many"])
+    def test_store_during_fetch(self, fakestore, method):
+        cache = CachedStorage(fakestore, ttl=60)
+        BinaryFlag.create("flag0", store=cache).unset()
+        fetched, resume = threading.Event(), threading.Event()
+        fetch = getattr(fakestore, method)
+
+        def slow_fetch(*args):
+            value = fetch(*args)
+            fetched.set()
+            resume.wait(5)
+            return value
+
+        setattr(fakestore, method, slow_fetch)
+        if method == "load":
+            target = cache.load
+            args = ("flag0", FlagTypes.BINARY)
+        else:
+            target = cache.load_many
+            args = (["flag0"], FlagTypes.BINARY)
+        thread = threading.Thread(target=target, args=args)
+        thread.start()
+        assert fetched.wait(5)
+        cache.store("flag0", True, FlagTypes.BINARY)
+        resume.set()
+        thread.join()
+
+        assert cache.load("flag0", FlagTypes.BINARY) is True
+        assert cache.load_many(["flag0"], FlagTypes.BINARY) == {"flag0": True}
+
+    def test_warm(self, fakestore):
+        BinaryFlag.create("flag0", store=fakestore).set()
+        BinaryFlag.create("flag1", store=fakestore)
+        cache = CachedStorage(fakestore)
+        cache.warm()
+        assert BinaryFlag("flag0", store=cache)
+        assert not BinaryFlag("flag1", store=cache)
+        assert cache.misses == 0
+
+    def test_invalidate_on_create(self, fakestore):
+        cache = CachedStorage(fakestore)
+        assert not cache.exists("flag0")
+        BinaryFlag.create("flag0", store=cache)
+        assert cache.exists("flag0")
+
+    def test_ttl(self, fakestore):
+        cache = CachedStorage(fakestore, ttls={"flag0": 0})
+        flag0 = BinaryFlag.create("flag0", store=cache)
+        fakestore.store("flag0", True, FlagTypes.BINARY)
+        assert flag0
+        fakestore.store("flag0", False, FlagTypes.BINARY)
+        assert not flag0
+
+    def test_lru_eviction(self, fakestore):
+        cache = CachedStorage(fakestore, maxsize=2)
+        for name in ["flag0", "flag1", "flag2"]:
+            assert not BinaryFlag.create(name, store=cache)
+        assert list(cache.entries) == ["flag1", "flag2"]
+
+    def test_load_many(self, fakestore):
+        cache = CachedStorage(fakestore)
+        BinaryFlag.create("flag0", store=cache).set()
+        BinaryFlag.create("flag1", store=cache)
+        assert cache.load("flag0", FlagTypes.BINARY)
+        misses = cache.misses
+        assert cache.load_many(["flag0", "flag1"], FlagTypes.BINARY) == {
+            "flag0": True,
+            "flag1": None,
+        }
+        assert cache.misses == misses + 1
+        assert cache.load("flag1", FlagTypes.BINARY) is None
+        assert cache.misses == misses + 1
+
+    def test_many_invalidate(self, fakestore):
+        cache = CachedStorage(fakestore)
+        cache.create_many([{"name": "flag0"}], FlagTypes.BINARY)
+        assert cache.load("flag0", FlagTypes.BINARY) is None
+        cache.store_many({"flag0": True}, FlagTypes.BINARY)
+        assert cache.load("flag0", FlagTypes.BINARY) is True
+
+    def test_info(self, fakestore):
+        cache = CachedStorage(fakestore)
+        flag0 = BinaryFlag.create("flag0", store=cache, label="Flag")
+        assert flag0.info["label"] == "Flag"
+        assert flag0.info["label"] == "Flag"
+        assert cache.hits == 1
+
+
+@pytest.mark.unit
+class TestInvalidation:
+    def test_local_channel(self):
+        channel = LocalChannel()
+        subscription = channel.subscribe()
+        channel.notify(None, "flag0")
+        channel.notify(None, "flag1")
+        assert subscription.get(timeout=1) == ["flag0", "flag1"]
+        assert subscription.get(timeout=0) == []
+        subscription.close()
+        assert not channel.subscribers
+
+    def test_listener_invalidates(self, fakestore):
+        channel = LocalChannel()
+        cache = CachedStorage(fakestore)
+        flag0 = BinaryFlag.create("flag0", store=cache)
+        flag0.unset()
+        assert not flag0
+
+        invalidated = threading.Event()
+
+        class Cache:
+            def invalidate(self, name=None):
+                cache.invalidate(name)
+                invalidated.set()
+
+        listener = InvalidationListener(channel, Cache(), interval=0.01)
+        listener.start()
+        try:
+            while not channel.subscribers:
+                time.sleep(0.01)
+            fakestore.store("flag0", True, FlagTypes.BINARY)
+            channel.notify(None, "flag0")
+            assert invalidated.wait(timeout=5)
+        finally:
+            listener.stop()
+        assert flag0
+
+
+@pytest.mark.unit
+class TestFlagSnapshot:
+    def test_consistent_reads(self, fakestore):
+        flag0 = BinaryFlag.create("flag0", store=fakestore)
+        flag0.set()
+        with FlagSnapshot(fakestore):
+            fakestore.store("flag0", False, FlagTypes.BINARY)
+            assert flag0
+            assert BinaryFlag("flag0", store=fakestore)
+        assert not flag0
+
+    def test_single_query(self, fakestore):
+        for name in ["flag0", "flag1"]:
+            BinaryFlag.create(name, store=fakestore)
+
+        def fail(*args):
+            raise AssertionError(f"Unexpected query {args}")
+
+        with FlagSnapshot(fakestore):
+            fakestore.exists = fakestore.load = fail
+            assert not BinaryFlag("flag0", store=fakestore)
+            assert not BinaryFlag("flag1", store=fakestore)
+            with pytest.raises(FlagDoesNotExist):
+                BinaryFlag("flag42", store=fakestore)
+
+    def test_touch_on_exit(self, fakestore):
+        for name in ["flag0", "flag1"]:
+            BinaryFlag.create(name, store=fakestore)
+        with FlagSnapshot(fakestore):
+            assert not BinaryFlag("flag0", store=fakestore)
+            assert fakestore.used("flag0") is None
+        assert fakestore.used("flag0") is not None
+        assert fakestore.used("flag1") is None
+
+    def test_partial(self, fakestore):
+        BinaryFlag.create("flag0", store=fakestore)
+        BinaryFlag.create("flag1", store=fakestore).set()
+        with FlagSnapshot(fakestore, ["flag0"]) as snapshot:
+            assert list(snapshot.rows) == ["flag0"]
+            assert BinaryFlag("flag1", store=fakestore)
+            with pytest.raises(FlagDoesNotExist):
+                BinaryFlag("flag42", store=fakestore)
+
+    def test_other_store(self, fakestore):
+        other = type(fakestore)()
+        flag0 = BinaryFlag.create("flag0", store=other)
+        with FlagSnapshot(fakestore):
+            flag0.set()
+            assert flag0
+
+
+@pytest.mark.unit
+class TestSQLStorageSettings:
+    def test_pool_settings(self):
+        store = SQLStorage()
+        store.init_db({
+            "ensign.db": "sqlite://",
+            "ensign.db.pool_size": "2",
+            "ensign.db.max_overflow": "3",
+            "ensign.db.pre_ping": "true",
+        })
+        store.create_schema()
+        try:
+            assert store.engine.pool.size() == 2
+            assert store.engine.pool._max_overflow == 3
+            assert store.exists("flag0") is False
+        finally:
+            store.close()
+
+    def test_statement_timeout_setting(self):
+        store = SQLStorage()
+        store.init_db({
+            "ensign.db": "sqlite://",
+            "ensign.db.statement_timeout": "50",
+        })
+        try:
+            # Only supported on PostgreSQL.
+            assert store.statement_timeout is None
+        finally:
+            store.close()
+
+    def test_schema_created_explicitly(self, tmpdir):
+        store = SQLStorage()
+        store.init_db({"ensign.db": f"sqlite:///{tmpdir.join('flags.db')}"})
+        try:
+            assert "flags" not in sa.inspect(store.engine).get_table_names()
+            cli.initdb(argparse.Namespace(), store)
+            assert "flags" in sa.inspect(store.engine).get_table_names()
+        finally:
+            store.close()
+
+
+@pytest.fixture(scope="function")
+def legacy_store(_pre_db, tmpdir):
+    """
+    Fixture providing a store whose database has the flags table as first
+    released, with a binary flag.
+    """
+
+    url = DefaultStorage.engine.url
+    if url.get_backend_name() == "postgresql":
+        with DefaultStorage.engine.connect() as connection:
+            connection.execute("CREATE SCHEMA legacy")
+        engine = sa.create_engine(
+            url,
+            connect_args={"options": "-csearch_path=legacy"},
+        )
+    else:
+        engine = sa.create_engine(f"sqlite:///{tmpdir.join('legacy.db')}")
+
+    metadata = sa.MetaData()
+    flags = sa.Table(
+        "flags", metadata,
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("name", sa.Unicode(64), nullable=False, unique=True),
+        sa.Column("type", sa.Enum("BINARY", name="flagtypes"), nullable=False),
+        sa.Column("value_binary", sa.Boolean),
+        sa.Column("label", sa.Unicode(256)),
+        sa.Column("description", sa.UnicodeText),
+        sa.Column("tags", sa.UnicodeText),
+        sa.Column("used", sa.DateTime),
+    )
+    metadata.create_all(engine)
+    engine.execute(flags.insert().values(
+        name="legacy",
+        type="BINARY",
+        value_binary=True,
+        tags="a, b",
+    ))
+
+    store = SQLStorage()
+    store.engine = engine
+    yield store
+    store.close()
+    if url.get_backend_name() == "postgresql":
+        with DefaultStorage.engine.connect() as connection:
+            connection.execute("DROP SCHEMA legacy CASCADE")
+
+
+@pytest.mark.integration
+class TestSchemaUpgrade:
+    def test_upgrade(self, legacy_store):
+        legacy_store.create_schema()
+
+        inspector = sa.inspect(legacy_store.engine)
+        assert {c["name"] for c in inspector.get_columns("flags")} == \
+            set(SQLStorage.flags.c.keys())
+        assert "flag_tags" in inspector.get_table_names()
+        assert "ix_flags_used" in \
+            {index["name"] for index in inspector.get_indexes("flags")}
+
+        legacy = BinaryFlag("legacy", store=legacy_store)
+        assert legacy
+        legacy.unset()
+        assert legacy_store.info("legacy").version == 2
+        PercentageFlag.create("percentage", store=legacy_store).set(50)
+        RuleFlag.create("rules", store=legacy_store).set([{}])
+        assert RuleFlag("rules", store=legacy_store)
+        assert legacy_store.version_all()[0] == 3
+
+    def test_backfill_tags(self, legacy_store):
+        legacy_store.create_schema()
+        assert [info.name for info in legacy_store.iter_info(tags=["b"])] \
+            == ["legacy"]
+        BinaryFlag.create("new", store=legacy_store, tags="b")
+        legacy_store.create_schema()
+        assert [info.name for info in legacy_store.iter_info(tags=["b"])] \
+            == ["legacy", "new"]
+
+    def test_upgrade_again(self, legacy_store):
+        legacy_store.create_schema()
+        legacy_store.create_schema()
+        assert BinaryFlag("legacy", store=legacy_store)
+
 
 @pytest.mark.unit
 class TestFlagInfo:
@@ -195,6 +971,17 @@ class TestSQLBackedFlags:
         with pytest.raises(FlagDoesNotExist):
             BinaryFlag("flag0")
 
+    def test_lazy_flag_raises_on_access(self):
+        flag = BinaryFlag("flag0", lazy=True)
+        with pytest.raises(FlagDoesNotExist):
+            bool(flag)
+        with pytest.raises(FlagDoesNotExist):
+            flag.set()
+        with pytest.raises(FlagDoesNotExist):
+            flag.info  # pylint: disable=pointless-statement
+        with pytest.raises(FlagDoesNotExist):
+            flag.active  # pylint: disable=pointless-statement
+
     def test_get_set_flags(self):
         flag0 = BinaryFlag.create("flag0")
         assert flag0.value is None
@@ -247,6 +1034,29 @@ class TestSQLStorage:
         DefaultStorage.create("flag0", FlagTypes.BINARY)
         assert DefaultStorage.exists("flag0")
         assert not DefaultStorage.exists("flag1")
+        assert DefaultStorage.exists("flag0", FlagTypes.BINARY)
+        assert not DefaultStorage.exists("flag0", FlagTypes.RULES)
+        with FlagSnapshot(DefaultStorage) as snapshot:
+            assert snapshot.exists("flag0", FlagTypes.BINARY)
+            assert not snapshot.exists("flag0", FlagTypes.RULES)
+
+    def test_statement_timeout(self, monkeypatch):
+        if DefaultStorage.engine.dialect.name != "postgresql":
+            pytest.skip("Statement timeouts are only set on PostgreSQL")
+        # The timeout is left alone within sessions, as the test's.
+        monkeypatch.setattr(DefaultStorage.local, "connection", None)
+        monkeypatch.setattr(DefaultStorage, "statement_timeout", 50)
+        slow = sa.select([sa.func.pg_sleep(0.2)]).\
+            where(sa.bindparam("b_name") == "flag0")
+        monkeypatch.setitem(
+            DefaultStorage.queries.load, FlagTypes.BINARY, slow,
+        )
+
+        with pytest.raises(sa.exc.OperationalError):
+            DefaultStorage.load("flag0", FlagTypes.BINARY)
+        # Other statements, even on the same pooled connection, aren't.
+        with DefaultStorage.engine.connect() as connection:
+            connection.execute(sa.select([sa.func.pg_sleep(0.2)]))
 
     def test_load_store(self):
         DefaultStorage.create("flag0", FlagTypes.BINARY)
@@ -255,11 +1065,73 @@ class TestSQLStorage:
         DefaultStorage.store("flag0", False, FlagTypes.BINARY)
         assert DefaultStorage.load("flag0", FlagTypes.BINARY) is False
 
+    def test_create_many(self):
+        DefaultStorage.create_many([
+            {"name": "flag0"},
+            {"name": "flag1", "label": "Flag 1", "value_binary": True},
+        ], FlagTypes.BINARY)
+        assert DefaultStorage.exists("flag0")
+        assert isinstance(DefaultStorage.info("flag1"), FlagRecord)
+        assert DefaultStorage.info("flag1")["label"] == "Flag 1"
+        assert DefaultStorage.load("flag1", FlagTypes.BINARY) is True
+
+    def test_load_store_many(self):
+        names = ["flag0", "flag1", "flag2"]
+        for name in names:
+            DefaultStorage.create(name, FlagTypes.BINARY)
+        DefaultStorage.store_many(
+            {"flag0": True, "flag1": False},
+            FlagTypes.BINARY,
+        )
+        assert DefaultStorage.load_many(
+            names + ["flag42"],
+            FlagTypes.BINARY,
+        ) == {"flag0": True, "flag1": False, "flag2": None}
+        assert DefaultStorage.used("flag2") is not None
+
     def test_used(self):
         used = datetime.datetime.now()
         DefaultStorage.create("flag0", FlagTypes.BINARY, used=used)
         assert DefaultStorage.used("flag0") == used
 
+    def test_flush_usage(self):
+        DefaultStorage.create("flag0", FlagTypes.BINARY)
+        DefaultStorage.create("flag1", FlagTypes.BINARY)
+        DefaultStorage.flush_usage({"flag0": datetime.datetime(2000, 1, 1)})
+        assert DefaultStorage.activity_all(7) == {
+            "flag0": FlagActive.ACTIVE,
+            "flag1": FlagActive.NEW,
+        }
+
+    def test_used_buffered(self):
+        flushed = []
+        DefaultStorage.create("flag0", FlagTypes.BINARY)
+        DefaultStorage.usage = UsageBuffer(flushed.append)
+        try:
+            DefaultStorage.load("flag0", FlagTypes.BINARY)
+            assert DefaultStorage.used("flag0") is not None
+            assert BinaryFlag("flag0").active == FlagActive.ACTIVE
+        finally:
+            DefaultStorage.usage = None
+        assert DefaultStorage.used("flag0") is None
+
+    def test_session(self):
+        with DefaultStorage.session() as connection:
+            DefaultStorage.create("flag0", FlagTypes.BINARY)
+            with DefaultStorage.session() as inner:
+                assert inner is connection
+            assert DefaultStorage.exists("flag0")
+
+    def test_notify(self):
+        DefaultStorage.channel = LocalChannel()
+        try:
+            subscription = DefaultStorage.channel.subscribe()
+            DefaultStorage.create("flag0", FlagTypes.BINARY)
+            DefaultStorage.store("flag0", True, FlagTypes.BINARY)
+            assert subscription.get(timeout=1) == ["flag0", "flag0"]
+        finally:
+            DefaultStorage.channel = None
+
     def test_get_all(self):
         names = ["flag0", "flag1", "flag2"]
         for name in names:
@@ -268,3 +1140,176 @@ class TestSQLStorage:
         assert len(allitems) == len(names)
         for flag in allitems:
             assert flag in names
+
+    def test_info_all(self):
+        names = ["flag0", "flag1", "flag2"]
+        for name in names:
+            DefaultStorage.create(name, FlagTypes.BINARY, label=name)
+        DefaultStorage.store("flag1", True, FlagTypes.BINARY)
+        allinfo = DefaultStorage.info_all()
+        assert [info["name"] for info in allinfo] == names
+        assert [info["label"] for info in allinfo] == names
+        assert [info["value_binary"] for info in allinfo] == [
+            None, True, None,
+        ]
+        assert all(info["used"] is None for info in allinfo)
+
+        someinfo = DefaultStorage.info_all(["flag2", "flag0", "flag42"])
+        assert [info["name"] for info in someinfo] == ["flag0", "flag2"]
+
+    def test_iter_info(self):
+        names = [f"flag{i}" for i in range(5)]
+        DefaultStorage.create_many(
+            [dict(name=name) for name in names],
+            FlagTypes.BINARY,
+        )
+        assert list(DefaultStorage.iter_info(batch=2)) == \
+            DefaultStorage.info_all()
+        assert [info.name for info in DefaultStorage.iter_info("flag1", 2)] \
+            == ["flag2", "flag3"]
+
+    def test_filter_tags(self):
+        DefaultStorage.create("flag0", FlagTypes.BINARY, tags="a, b")
+        DefaultStorage.create_many([
+            {"name": "flag1", "tags": "b,c"},
+            {"name": "flag2"},
+            {"name": "flag3", "tags": "a,,a"},
+        ], FlagTypes.BINARY)
+
+        def names(**filters):
+            return [info.name for info in DefaultStorage.iter_info(**filters)]
+
+        assert names(tags=["a"]) == ["flag0", "flag3"]
+        assert names(tags=["b"]) == ["flag0", "flag1"]
+        assert names(tags=["a", "b"]) == ["flag0"]
+        assert names(tags=["d"]) == []
+        assert names(flagtype=FlagTypes.BINARY, tags=[]) == \
+            ["flag0", "flag1", "flag2", "flag3"]
+
+    def test_filter_active(self):
+        for name in ["flag0", "flag1", "flag2"]:
+            DefaultStorage.create(name, FlagTypes.BINARY)
+        DefaultStorage.load("flag1", FlagTypes.BINARY)
+        with DefaultStorage.session() as connection:
+            connection.execute(
+                DefaultStorage.flags.update().
+                where(DefaultStorage.flags.c.name == "flag2").
+                values(used=datetime.datetime(2000, 1, 1))
+            )
+
+        def names(active):
+            return [
+                info.name
+                for info in DefaultStorage.iter_info(active=active)
+            ]
+
+        assert names(FlagActive.NEW) == ["flag0"]
+        assert names(FlagActive.ACTIVE) == ["flag1"]
+        assert names(FlagActive.INACTIVE) == ["flag2"]
+
+        assert [
+            (info.name, active)
+            for info, active in DefaultStorage.iter_info(
+                activity=True,
+                days={FlagTypes.BINARY: 10 ** 5},
+            )
+        ] == [
+            ("flag0", FlagActive.NEW),
+            ("flag1", FlagActive.ACTIVE),
+            ("flag2", FlagActive.ACTIVE),
+        ]
+        assert [
+            info.name
+            for info in DefaultStorage.iter_info(
+                active=FlagActive.INACTIVE,
+                days={FlagTypes.BINARY: 10 ** 5},
+            )
+        ] == []
+
+    def test_activity(self):
+        old = datetime.datetime.now() - datetime.timedelta(days=8)
+        DefaultStorage.create_many([
+            {"name": "flag0"},
+            {"name": "flag1", "used": datetime.datetime.now()},
+            {"name": "flag2", "used": old},
+        ], FlagTypes.BINARY)
+
+        assert DefaultStorage.activity("flag0", 7) == FlagActive.NEW
+        assert DefaultStorage.activity("flag1", 7) == FlagActive.ACTIVE
+        assert DefaultStorage.activity("flag2", 7) == FlagActive.INACTIVE
+        assert DefaultStorage.activity("flag2", 30) == FlagActive.ACTIVE
+        with pytest.raises(KeyError):
+            DefaultStorage.activity("flag42", 7)
+
+        assert DefaultStorage.activity_all(7) == {
+            "flag0": FlagActive.NEW,
+            "flag1": FlagActive.ACTIVE,
+            "flag2": FlagActive.INACTIVE,
+        }
+        assert DefaultStorage.activity_all({FlagTypes.BINARY: 30})["flag2"] \
+            == FlagActive.ACTIVE
+        assert DefaultStorage.activity("flag2", 7.5) == FlagActive.INACTIVE
+        assert DefaultStorage.activity_all(8.5)["flag2"] == FlagActive.ACTIVE
+        assert DefaultStorage.version("flag2", 8.5) == (1, FlagActive.ACTIVE)
+        assert DefaultStorage.version_all(days=8.5)[3:5] == (1, 0)
+        assert BinaryFlag("flag2").active == FlagActive.INACTIVE
+
+    def test_version(self):
+        DefaultStorage.create("flag0", FlagTypes.BINARY)
+        DefaultStorage.create_many([{"name": "flag1"}], FlagTypes.BINARY)
+        assert DefaultStorage.version("flag0") == (1, FlagActive.NEW)
+        assert DefaultStorage.version("flag1") == (1, FlagActive.NEW)
+
+        DefaultStorage.store("flag0", True, FlagTypes.BINARY)
+        DefaultStorage.store_many({"flag0": False}, FlagTypes.BINARY)
+        assert DefaultStorage.version("flag0") == (3, FlagActive.NEW)
+        assert DefaultStorage.info("flag0").version == 3
+
+        DefaultStorage.load("flag0", FlagTypes.BINARY)
+        assert DefaultStorage.version("flag0") == (3, FlagActive.ACTIVE)
+        with pytest.raises(KeyError):
+            DefaultStorage.version("flag42")
+
+    def test_version_all(self):
+        assert DefaultStorage.version_all() == (0, 0, 0, 0, 0, 0)
+        DefaultStorage.create("flag0", FlagTypes.BINARY, tags="a")
+        DefaultStorage.create("flag1", FlagTypes.BINARY)
+        state = DefaultStorage.version_all()
+        assert state[:2] == (2, 2)
+        assert state[3:] == (2, 0, 0)
+
+        DefaultStorage.store("flag1", True, FlagTypes.BINARY)
+        assert DefaultStorage.version_all()[:2] == (2, 3)
+        assert DefaultStorage.version_all(tags=["a"])[:2] == (1, 1)
+        assert DefaultStorage.version_all(after="flag0")[:2] == (1, 2)
+        assert DefaultStorage.version_all(limit=1)[:2] == (1, 1)
+
+        DefaultStorage.load("flag0", FlagTypes.BINARY)
+        assert DefaultStorage.version_all()[3:] == (1, 0, 0)
+
+    def test_version_all_swap(self):
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(days=8)
+        DefaultStorage.create_many([
+            {"name": "flag0", "used": now},
+            {"name": "flag1", "used": old},
+        ], FlagTypes.BINARY)
+        state = DefaultStorage.version_all()
+        assert state[3:5] == (0, 1)
+
+        with DefaultStorage.session() as connection:
+            for name, used in [("flag0", old), ("flag1", now)]:
+                connection.execute(
+                    DefaultStorage.flags.update().
+                    where(DefaultStorage.flags.c.name == name).
+                    values(used=used)
+                )
+        assert DefaultStorage.version_all()[:5] == state[:5]
+        assert DefaultStorage.version_all() != state
+
+    def test_touch(self):
+        for name in ["flag0", "flag1"]:
+            DefaultStorage.create(name, FlagTypes.BINARY)
+        DefaultStorage.touch(["flag0"])
+        assert DefaultStorage.used("flag0") is not None
+        assert DefaultStorage.used("flag1") is None
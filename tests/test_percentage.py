@@ -0,0 +1,248 @@
+# pylint: disable=invalid-name,missing-docstring,no-self-use
+
+import array
+
+import pytest
+
+from hypothesis import HealthCheck, given, settings, strategies as st
+from zope.interface.verify import verifyClass
+
+from ensign import CachedStorage, PercentageFlag, _hashing
+from ensign._hashing import BUCKETS, bucket, seed, subject_key
+from ensign._interfaces import IFlag
+from ensign._storage import DefaultStorage, FlagTypes
+
+
+@pytest.mark.unit
+class TestHashing:
+    def test_stable(self):
+        # Changing the hash would move subjects in and out of every rollout.
+        flag_seed = seed("flag0")
+        assert flag_seed == 3838857616
+        assert [bucket(key, flag_seed) for key in range(5)] == \
+            [8776, 540, 9584, 8935, 1182]
+        assert bucket(subject_key("alice"), flag_seed) == 5616
+
+    def test_subject_keys(self):
+        assert subject_key(42) == 42
+        assert subject_key(-1) == 0xFFFFFFFFFFFFFFFF
+        assert subject_key("alice") == subject_key(b"alice")
+        assert subject_key("alice") != subject_key("bob")
+        numpy = pytest.importorskip("numpy")
+        assert subject_key(numpy.int64(-1)) == subject_key(-1)
+        assert subject_key(numpy.uint32(42)) == 42
+
+    @pytest.mark.parametrize("keys", [
+        range(100000),
+        range(10 ** 12, 10 ** 12 + 100000 * 7919, 7919),
+        [subject_key(f"user{i}") for i in range(100000)],
+    ], ids=["sequential", "strided", "strings"])
+    def test_uniform(self, keys):
+        flag_seed = seed("flag0")
+        counts = [0] * 100
+        for key in keys:
+            counts[bucket(key, flag_seed) * 100 // BUCKETS] += 1
+
+        # Chi-squared test over 100 cells (99 degrees of freedom): fails for
+        # a uniform distribution with a probability below 0.01%.
+        expected = len(keys) / 100
+        chi2 = sum((count - expected) ** 2 / expected for count in counts)
+        assert chi2 < 160
+
+    def test_independent_flags(self):
+        seed0, seed1 = seed("flag0"), seed("flag1")
+        both = sum(
+            bucket(key, seed0) < BUCKETS // 2 and
+            bucket(key, seed1) < BUCKETS // 2
+            for key in range(100000)
+        )
+        assert abs(both - 25000) < 1000
+
+
+@pytest.mark.unit
+class TestPercentageFlag:
+    def test_implements_iflag(self):
+        assert verifyClass(IFlag, PercentageFlag)
+
+    def test_slotted(self, fakestore):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        assert not hasattr(flag, "__dict__")
+
+    def test_new_flag(self, fakestore):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        assert not flag.check(42)
+        assert not flag
+
+    @pytest.mark.parametrize("percentage", [0, 0.5, 10, 50, 99])
+    def test_rollout(self, fakestore, percentage):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        flag.set(percentage)
+        active = sum(flag.check(subject) for subject in range(100000))
+        assert abs(active - percentage * 1000) < 1000
+        assert not flag
+
+    def test_full_rollout(self, fakestore):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        flag.set(100)
+        assert all(flag.check(subject) for subject in range(1000))
+        assert flag
+        flag.unset()
+        assert not any(flag.check(subject) for subject in range(1000))
+
+    def test_monotonic(self, fakestore):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        flag.set(10)
+        before = {s for s in range(10000) if flag.check(s)}
+        flag.set(20)
+        after = {s for s in range(10000) if flag.check(s)}
+        assert before < after
+
+    def test_deterministic(self, fakestore):
+        PercentageFlag.create("flag0", store=fakestore).set(50)
+        flag = PercentageFlag("flag0", store=fakestore)
+        results = [flag.check(f"user{i}") for i in range(100)]
+        assert results == [
+            PercentageFlag("flag0", store=fakestore).check(f"user{i}")
+            for i in range(100)
+        ]
+
+    @pytest.mark.parametrize("percentage", [-1, 101])
+    def test_out_of_range(self, fakestore, percentage):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        with pytest.raises(ValueError):
+            flag.set(percentage)
+
+    def test_cached(self, fakestore):
+        cache = CachedStorage(fakestore)
+        flag = PercentageFlag.create("flag0", store=cache)
+        flag.set(50)
+        flag.check(0)
+        misses = cache.misses
+        for subject in range(100):
+            flag.check(subject)
+        assert cache.misses == misses
+
+    def test_default(self, fakestore):
+        PercentageFlag.create("flag0", store=fakestore, default=25)
+        assert fakestore.STORE["flag0"]["default_percentage"] == 25
+
+
+@pytest.fixture(scope="function", params=["numpy", "python"])
+def backend(request, monkeypatch):
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(_hashing, "numpy", None)
+    return request.param
+
+
+int64s = st.integers(min_value=-2 ** 63, max_value=2 ** 63 - 1)
+percentages = st.one_of(
+    st.integers(min_value=0, max_value=100),
+    st.floats(min_value=0, max_value=100),
+)
+function_scoped = settings(
+    suppress_health_check=[HealthCheck.function_scoped_fixture],
+)
+
+
+def numpy_integers(bits):
+    # NumPy integer scalars, as (dtype name, value) pairs: NumPy is optional,
+    # so they are only built by the tests using them.
+    return st.one_of(
+        st.tuples(
+            st.just(f"int{bits}"),
+            st.integers(-2 ** (bits - 1), 2 ** (bits - 1) - 1),
+        ),
+        st.tuples(st.just(f"uint{bits}"), st.integers(0, 2 ** bits - 1)),
+    )
+
+
+@pytest.mark.unit
+class TestEvaluateMany:
+    @function_scoped
+    @given(
+        percentage=percentages,
+        subjects=st.lists(int64s),
+    )
+    def test_int64_array(self, fakestore, backend, percentage, subjects):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        flag.set(percentage)
+        results = flag.evaluate_many(array.array("q", subjects))
+        assert list(results) == [flag.check(s) for s in subjects]
+
+    @function_scoped
+    @given(
+        percentage=percentages,
+        subjects=st.lists(st.integers(min_value=0, max_value=2 ** 64 - 1)),
+    )
+    def test_uint64_array(self, fakestore, backend, percentage, subjects):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        flag.set(percentage)
+        results = flag.evaluate_many(array.array("Q", subjects))
+        assert list(results) == [flag.check(s) for s in subjects]
+
+    @function_scoped
+    @given(
+        percentage=percentages,
+        subjects=st.lists(st.one_of(st.integers(), st.text(), st.binary())),
+    )
+    def test_mixed_subjects(self, fakestore, backend, percentage, subjects):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        flag.set(percentage)
+        results = flag.evaluate_many(subjects)
+        assert list(results) == [flag.check(s) for s in subjects]
+
+    @function_scoped
+    @given(
+        percentage=percentages,
+        subjects=st.lists(st.sampled_from([8, 16, 32, 64]).
+                          flatmap(numpy_integers)),
+    )
+    def test_numpy_scalars(self, fakestore, backend, percentage, subjects):
+        numpy = pytest.importorskip("numpy")
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        flag.set(percentage)
+        scalars = [getattr(numpy, dtype)(value) for dtype, value in subjects]
+        results = flag.evaluate_many(scalars)
+        expected = [flag.check(value) for _, value in subjects]
+        assert list(results) == expected
+        assert [flag.check(scalar) for scalar in scalars] == expected
+
+    def test_numpy_array(self, fakestore):
+        numpy = pytest.importorskip("numpy")
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        flag.set(50)
+        subjects = numpy.arange(-5000, 5000).reshape(100, 100)
+        results = flag.evaluate_many(subjects)
+        assert results.dtype == bool
+        assert results.shape == (100, 100)
+        assert results.tolist() == [
+            [flag.check(int(s)) for s in row] for row in subjects
+        ]
+
+    def test_unset(self, fakestore, backend):
+        flag = PercentageFlag.create("flag0", store=fakestore)
+        assert not any(flag.evaluate_many(range(1000)))
+        flag.set(100)
+        assert all(flag.evaluate_many(range(1000)))
+
+    def test_single_load(self, fakestore):
+        cache = CachedStorage(fakestore)
+        flag = PercentageFlag.create("flag0", store=cache)
+        flag.set(50)
+        flag.evaluate_many(range(1000))
+        assert cache.misses == 1
+
+
+@pytest.mark.integration
+@pytest.mark.usefixtures("db")
+class TestSQLBackedPercentageFlag:
+    def test_rollout(self):
+        flag = PercentageFlag.create("flag0")
+        assert not flag.check(1)
+        flag.set(50)
+        assert PercentageFlag("flag0").value == 50
+        active = sum(flag.check(subject) for subject in range(1000))
+        assert 400 < active < 600
+        assert DefaultStorage.info("flag0").type == FlagTypes.PERCENTAGE
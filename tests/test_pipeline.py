@@ -0,0 +1,214 @@
+# pylint: disable=invalid-name,missing-docstring,no-self-use
+
+import io
+import json
+
+import pytest
+
+from ensign import (
+    BinaryFlag,
+    DefaultStorage,
+    FlagDoesNotExist,
+    PercentageFlag,
+    RuleFlag,
+    evaluate_subjects,
+)
+from ensign import cli
+
+
+@pytest.fixture(scope="function")
+def flags(fakestore):
+    BinaryFlag.create("binary", store=fakestore).set()
+    PercentageFlag.create("percentage", store=fakestore).set(50)
+    RuleFlag.create("rules", store=fakestore).set(
+        [{"country": {"in": ["ES"]}}],
+    )
+    return fakestore
+
+
+def subjects(count):
+    countries = ["ES", "PT", "FR"]
+    return [
+        dict(id=subject, country=countries[subject % 3])
+        for subject in range(count)
+    ]
+
+
+def expected(store, records):
+    percentage = PercentageFlag("percentage", store=store)
+    rules = RuleFlag("rules", store=store)
+    return [
+        dict(
+            id=record["id"],
+            binary=True,
+            percentage=percentage.check(record["id"]),
+            rules=rules.check(record),
+        )
+        for record in records
+    ]
+
+
+def ndjson(records):
+    lines = (json.dumps(record) + "\n" for record in records)
+    return io.StringIO("".join(lines))
+
+
+@pytest.mark.unit
+class TestEvaluateSubjects:
+    @pytest.mark.parametrize("chunk_size, max_pending", [
+        (10000, None),
+        (7, 1),
+        (1, 3),
+    ])
+    def test_ndjson(self, flags, chunk_size, max_pending):
+        records = subjects(100)
+        output = io.StringIO()
+        count = evaluate_subjects(
+            ndjson(records),
+            output,
+            ["binary", "percentage", "rules"],
+            flags,
+            processes=2,
+            chunk_size=chunk_size,
+            max_pending=max_pending,
+        )
+        assert count == 100
+        results = [json.loads(line) for line in output.getvalue().split()]
+        assert results == expected(flags, records)
+
+    def test_csv(self, flags):
+        records = subjects(20)
+        source = io.StringIO(
+            "id,country\n" +
+            "".join(f"{r['id']},{r['country']}\n" for r in records) +
+            "\n"
+        )
+        output = io.StringIO()
+        count = evaluate_subjects(
+            source,
+            output,
+            ["percentage", "rules"],
+            flags,
+            fmt="csv",
+            key_type=int,
+            processes=1,
+            chunk_size=6,
+        )
+        assert count == 20
+        lines = output.getvalue().splitlines()
+        assert lines[0] == "id,percentage,rules"
+        assert lines[1:] == [
+            ",".join([
+                str(result["id"]),
+                "true" if result["percentage"] else "false",
+                "true" if result["rules"] else "false",
+            ])
+            for result in expected(flags, records)
+        ]
+
+    def test_csv_column_types(self, flags):
+        RuleFlag.create("adults", store=flags).set([{"age": {"gte": 18}}])
+        source = io.StringIO("id,age\n1,17\n2,18\n3,40\n")
+        output = io.StringIO()
+        evaluate_subjects(
+            source,
+            output,
+            ["adults"],
+            flags,
+            fmt="csv",
+            key_type=int,
+            processes=1,
+            column_types={"age": int},
+        )
+        assert output.getvalue().splitlines() == [
+            "id,adults",
+            "1,false",
+            "2,true",
+            "3,true",
+        ]
+
+    def test_key(self, flags):
+        output = io.StringIO()
+        evaluate_subjects(
+            ndjson([{"user": "alice"}]),
+            output,
+            ["percentage"],
+            flags,
+            key="user",
+            processes=1,
+        )
+        assert json.loads(output.getvalue()) == dict(
+            user="alice",
+            percentage=PercentageFlag("percentage", store=flags)
+            .check("alice"),
+        )
+
+    def test_empty(self, flags):
+        output = io.StringIO()
+        assert evaluate_subjects(
+            io.StringIO(""),
+            output,
+            ["binary"],
+            flags,
+            processes=1,
+        ) == 0
+        assert output.getvalue() == ""
+
+    @pytest.mark.parametrize("fmt", ["ndjson", "csv"])
+    def test_missing_flags(self, flags, fmt):
+        output = io.StringIO()
+        with pytest.raises(FlagDoesNotExist):
+            evaluate_subjects(
+                io.StringIO("id\n1\n"),
+                output,
+                ["binary", "flag42"],
+                flags,
+                fmt=fmt,
+                processes=1,
+            )
+        assert output.getvalue() == ""
+
+    def test_bad_format(self, flags):
+        with pytest.raises(ValueError):
+            evaluate_subjects(
+                io.StringIO(),
+                io.StringIO(),
+                ["binary"],
+                flags,
+                fmt="xml",
+            )
+
+
+@pytest.mark.integration
+class TestEvaluateCommand:
+    def test_evaluate(self, db, tmpdir):
+        BinaryFlag.create("binary").set()
+        PercentageFlag.create("percentage").set(50)
+        source = tmpdir.join("subjects.csv")
+        source.write("id\n" + "".join(f"{i}\n" for i in range(100)))
+        output = tmpdir.join("results.csv")
+
+        args = cli.parser().parse_args([
+            "evaluate", "binary", "percentage",
+            "--input", str(source),
+            "--output", str(output),
+            "--format", "csv",
+            "--key-type", "int",
+            "--processes", "2",
+        ])
+        args.func(args, DefaultStorage)
+        args.output.close()
+
+        flag = PercentageFlag("percentage")
+        assert output.read().splitlines()[1:] == [
+            f"{i},true," + ("true" if flag.check(i) else "false")
+            for i in range(100)
+        ]
+
+    def test_column_types(self):
+        args = cli.parser().parse_args([
+            "evaluate", "flag0", "-t", "age:int", "-t", "score:float",
+        ])
+        assert args.column_type == [("age", int), ("score", float)]
+        with pytest.raises(SystemExit):
+            cli.parser().parse_args(["evaluate", "flag0", "-t", "age"])
@@ -0,0 +1,148 @@
+# pylint: disable=invalid-name,missing-docstring,no-self-use
+
+import pytest
+
+from zope.interface.verify import verifyObject
+
+from ensign import BinaryFlag, ResilientStorage, StorageUnavailable
+from ensign._interfaces import IStorage
+from ensign._resilience import CircuitBreaker
+from ensign._storage import FlagTypes
+
+
+class Outage:
+    """
+    Make the methods of a storage fail on demand.
+    """
+
+    def __init__(self, store, *methods):
+        self.down = False
+        self.calls = 0
+        for method in methods:
+            setattr(store, method, self.wrap(getattr(store, method)))
+
+    def wrap(self, method):
+        def wrapper(*args, **kwargs):
+            self.calls += 1
+            if self.down:
+                raise ConnectionError()
+            return method(*args, **kwargs)
+        return wrapper
+
+
+@pytest.fixture(scope="function")
+def outage(fakestore):
+    return Outage(fakestore, "exists", "load", "load_many", "store")
+
+
+@pytest.fixture(scope="function")
+def resilient(fakestore):
+    return ResilientStorage(fakestore, CircuitBreaker(failures=2, reset=60))
+
+
+@pytest.mark.unit
+class TestCircuitBreaker:
+    def test_opens_after_failures(self):
+        breaker = CircuitBreaker(failures=2, reset=60)
+        breaker.failure()
+        assert breaker.allow()
+        breaker.failure()
+        assert not breaker.allow()
+        assert breaker.trips == 1
+
+    def test_success_resets(self):
+        breaker = CircuitBreaker(failures=2)
+        breaker.failure()
+        breaker.success(0)
+        breaker.failure()
+        assert breaker.allow()
+
+    def test_slow_calls_fail(self):
+        breaker = CircuitBreaker(failures=1, slow=0.1, reset=60)
+        breaker.success(0.01)
+        assert breaker.allow()
+        breaker.success(1)
+        assert not breaker.allow()
+
+    def test_half_open(self):
+        breaker = CircuitBreaker(failures=1, reset=0)
+        breaker.failure()
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert not breaker.allow()
+        breaker.success(0)
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    def test_half_open_failure(self):
+        breaker = CircuitBreaker(failures=5, reset=0)
+        for _ in range(5):
+            breaker.failure()
+        assert breaker.allow()
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.trips == 2
+
+
+@pytest.mark.unit
+class TestResilientStorage:
+    def test_implements_istorage(self, resilient):
+        assert verifyObject(IStorage, resilient)
+
+    def test_last_known_value(self, resilient, outage):
+        flag = BinaryFlag.create("flag0", store=resilient)
+        flag.set()
+        assert flag
+        outage.down = True
+        assert flag
+        assert resilient.stats() == dict(
+            state=CircuitBreaker.CLOSED,
+            trips=0,
+            errors=1,
+            fallbacks=1,
+        )
+
+    def test_default(self, resilient, outage):
+        flag = BinaryFlag.create("flag0", store=resilient, default=True)
+        outage.down = True
+        assert flag
+
+    def test_unavailable(self, resilient, outage):
+        flag = BinaryFlag.create("flag0", store=resilient)
+        outage.down = True
+        with pytest.raises(StorageUnavailable):
+            bool(flag)
+        with pytest.raises(StorageUnavailable):
+            flag.set()
+
+    def test_breaker_skips_calls(self, resilient, outage):
+        flag = BinaryFlag.create("flag0", store=resilient, default=True)
+        outage.down = True
+        for _ in range(10):
+            assert flag
+        assert outage.calls == 2
+        assert resilient.stats()["state"] == CircuitBreaker.OPEN
+        assert resilient.stats()["trips"] == 1
+        assert resilient.stats()["fallbacks"] == 10
+
+    def test_exists_fallback(self, resilient, outage):
+        BinaryFlag.create("flag0", store=resilient, default=False)
+        outage.down = True
+        assert not BinaryFlag("flag0", store=resilient)
+        with pytest.raises(StorageUnavailable):
+            BinaryFlag("flag42", store=resilient)
+
+    def test_missing_flag_is_not_a_failure(self, resilient):
+        with pytest.raises(KeyError):
+            resilient.load("flag42", FlagTypes.BINARY)
+        assert resilient.stats()["errors"] == 0
+
+    def test_warm(self, fakestore, outage):
+        BinaryFlag.create("flag0", store=fakestore).set()
+        BinaryFlag.create("flag1", store=fakestore, default=True)
+        resilient = ResilientStorage(fakestore)
+        resilient.warm()
+        outage.down = True
+        assert resilient.load_many(["flag0", "flag1"], FlagTypes.BINARY) == {
+            "flag0": True,
+            "flag1": True,
+        }
@@ -0,0 +1,149 @@
+# pylint: disable=invalid-name,missing-docstring,no-self-use
+
+import pytest
+
+from zope.interface.verify import verifyClass
+
+from ensign import CachedStorage, RuleError, RuleFlag
+from ensign._interfaces import IFlag
+from ensign._rules import compile_rules, dump_rules
+from ensign._storage import DefaultStorage, FlagTypes
+
+
+def matches(rules, context):
+    return compile_rules(dump_rules(rules))(context)
+
+
+@pytest.mark.unit
+class TestRules:
+    def test_membership(self):
+        rules = [{"country": {"in": ["ES", "PT"]}}]
+        assert matches(rules, {"country": "ES"})
+        assert not matches(rules, {"country": "FR"})
+        assert not matches(rules, {})
+        assert not matches(rules, {"country": ["ES"]})
+
+        rules = [{"country": {"not_in": ["ES", "PT"]}}]
+        assert not matches(rules, {"country": "ES"})
+        assert matches(rules, {"country": "FR"})
+        assert matches(rules, {})
+
+    @pytest.mark.parametrize("op, value, expected", [
+        ("eq", 10, True),
+        ("ne", 10, False),
+        ("lt", 11, True),
+        ("lte", 10, True),
+        ("gt", 10, False),
+        ("gte", 9, True),
+    ])
+    def test_comparisons(self, op, value, expected):
+        assert matches([{"age": {op: value}}], {"age": 10}) is expected
+
+    def test_comparison_missing_or_invalid(self):
+        assert not matches([{"age": {"gte": 18}}], {})
+        assert not matches([{"age": {"gte": 18}}], {"age": "old"})
+        assert matches([{"age": {"ne": 18}}], {})
+
+    @pytest.mark.parametrize("version, expected", [
+        ("2.9", False),
+        ("2.10", True),
+        ("2.10.1", True),
+        ("10", True),
+        ("beta", False),
+        (None, False),
+    ])
+    def test_versions(self, version, expected):
+        rules = [{"version": {"version_gte": "2.10"}}]
+        assert matches(rules, {"version": version}) is expected
+
+    def test_all_conditions(self):
+        rules = [{"country": {"in": ["ES"]}, "age": {"gte": 18, "lt": 65}}]
+        assert matches(rules, {"country": "ES", "age": 30})
+        assert not matches(rules, {"country": "ES", "age": 70})
+        assert not matches(rules, {"country": "PT", "age": 30})
+
+    def test_any_rule(self):
+        rules = [{"country": {"in": ["ES"]}}, {"account": {"in": [1, 2]}}]
+        assert matches(rules, {"country": "ES"})
+        assert matches(rules, {"account": 2})
+        assert not matches(rules, {"country": "PT", "account": 3})
+
+    def test_empty(self):
+        assert not matches([], {"country": "ES"})
+        assert matches([{}], {})
+
+    @pytest.mark.parametrize("rules", [
+        "not json",
+        "{}",
+        "[1]",
+        '[{"country": "ES"}]',
+        '[{"country": {"in": "ES"}}]',
+        '[{"country": {"in": [["ES"]]}}]',
+        '[{"country": {"like": "E%"}}]',
+        '[{"version": {"version_gte": "two"}}]',
+    ])
+    def test_invalid(self, rules):
+        with pytest.raises(RuleError):
+            compile_rules(rules)
+
+    def test_compiled_once(self):
+        text = dump_rules([{"account": {"in": list(range(1000))}}])
+        assert compile_rules(text) is compile_rules(text)
+
+
+@pytest.mark.unit
+class TestRuleFlag:
+    def test_implements_iflag(self):
+        assert verifyClass(IFlag, RuleFlag)
+
+    def test_check(self, fakestore):
+        flag = RuleFlag.create("flag0", store=fakestore)
+        assert not flag.check({"country": "ES"})
+        flag.set([{"country": {"in": ["ES"]}}])
+        assert flag.check({"country": "ES"})
+        assert not flag.check({"country": "PT"})
+        assert not flag
+        flag.unset()
+        assert not flag.check({"country": "ES"})
+
+    def test_no_context(self, fakestore):
+        flag = RuleFlag.create("flag0", store=fakestore)
+        flag.set([{}])
+        assert flag
+        assert RuleFlag.load_many(["flag0"], store=fakestore) == \
+            {"flag0": True}
+
+    def test_invalid(self, fakestore):
+        flag = RuleFlag.create("flag0", store=fakestore)
+        with pytest.raises(RuleError):
+            flag.set([{"country": {"like": "E%"}}])
+        assert flag.value is None
+
+    def test_evaluate_many(self, fakestore):
+        flag = RuleFlag.create("flag0", store=fakestore)
+        contexts = [{"country": country} for country in ["ES", "PT", "FR"]]
+        assert list(flag.evaluate_many(contexts)) == [False] * 3
+        flag.set([{"country": {"in": ["ES", "PT"]}}])
+        assert list(flag.evaluate_many(contexts)) == [True, True, False]
+
+    def test_cached(self, fakestore):
+        cache = CachedStorage(fakestore)
+        flag = RuleFlag.create("flag0", store=cache)
+        flag.set([{"country": {"in": ["ES"]}}])
+        flag.check({})
+        misses = cache.misses
+        for country in ["ES", "PT"] * 50:
+            flag.check({"country": country})
+        assert cache.misses == misses
+
+
+@pytest.mark.integration
+@pytest.mark.usefixtures("db")
+class TestSQLBackedRuleFlag:
+    def test_rules(self):
+        flag = RuleFlag.create("flag0")
+        flag.set([{"version": {"version_gte": "2.1"}}])
+        assert RuleFlag("flag0").check({"version": "2.10"})
+        assert not RuleFlag("flag0").check({"version": "1.9"})
+        assert DefaultStorage.info("flag0").type == FlagTypes.RULES
+        assert DefaultStorage.info("flag0").version == 2
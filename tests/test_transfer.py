@@ -0,0 +1,175 @@
+# pylint: disable=invalid-name,missing-docstring,no-self-use
+
+import io
+import json
+
+import pytest
+
+from ensign import (
+    BinaryFlag,
+    DefaultStorage,
+    PercentageFlag,
+    RuleFlag,
+    export_flags,
+    import_flags,
+)
+from ensign._storage import FlagTypes, SQLStorage
+from ensign._transfer import dump_definition, load_definition
+from ensign import cli
+
+
+def line(**data):
+    return json.dumps(dict({"type": "binary"}, **data)) + "\n"
+
+
+@pytest.fixture(scope="function", params=["native", "generic"])
+def upsert(request, monkeypatch):
+    # The generic statements work on any database, so they're tested on
+    # PostgreSQL too.
+    if request.param == "generic":
+        monkeypatch.setattr(
+            SQLStorage,
+            "_upsert_postgresql",
+            SQLStorage._upsert_generic,  # pylint: disable=protected-access
+        )
+    return request.param
+
+
+@pytest.mark.unit
+class TestDefinitions:
+    def test_round_trip(self, fakestore):
+        RuleFlag.create("flag0", store=fakestore, label="Flag 0", tags="a,b")
+        RuleFlag("flag0", store=fakestore).set([{"country": {"in": ["ES"]}}])
+        dumped = dump_definition(fakestore.info_all(["flag0"])[0])
+        assert json.loads(dumped) == dict(
+            name="flag0",
+            type="rules",
+            value='[{"country":{"in":["ES"]}}]',
+            default=None,
+            label="Flag 0",
+            description=None,
+            tags="a,b",
+        )
+        assert load_definition(dumped) == {
+            "name": "flag0",
+            "type": FlagTypes.RULES,
+            "value_rules": '[{"country":{"in":["ES"]}}]',
+            "default_rules": None,
+            "label": "Flag 0",
+            "description": None,
+            "tags": "a,b",
+        }
+
+    def test_minimal(self):
+        assert load_definition(line(name="flag0")) == {
+            "name": "flag0",
+            "type": FlagTypes.BINARY,
+            "value_binary": None,
+            "default_binary": None,
+            "label": None,
+            "description": None,
+            "tags": None,
+        }
+
+    @pytest.mark.parametrize("text", [
+        "not json",
+        "[]",
+        line(),
+        line(name=""),
+        line(name="flag0", type="unknown"),
+        line(name="flag0", value=1),
+        line(name="flag0", default="yes"),
+        line(name="flag0", type="percentage", value=101),
+        line(name="flag0", type="percentage", value=True),
+        line(name="flag0", type="rules", value=[]),
+        line(name="flag0", type="rules", value='[{"a": {"like": "b"}}]'),
+        line(name="flag0", label=1),
+        line(name="flag0", unknown=1),
+    ])
+    def test_invalid(self, text):
+        with pytest.raises(ValueError):
+            load_definition(text)
+
+    def test_export(self, fakestore):
+        BinaryFlag.create("flag0", store=fakestore).set()
+        PercentageFlag.create("flag1", store=fakestore, default=10).set(50)
+        output = io.StringIO()
+        assert export_flags(fakestore, output) == 2
+        flags = [json.loads(text) for text in output.getvalue().splitlines()]
+        assert [(f["name"], f["value"], f["default"]) for f in flags] == [
+            ("flag0", True, None),
+            ("flag1", 50, 10),
+        ]
+
+
+@pytest.mark.integration
+@pytest.mark.usefixtures("db", "upsert")
+class TestImport:
+    def test_create(self):
+        lines = [line(name=f"flag{k}", value=True, tags="x") for k in range(5)]
+        assert import_flags(DefaultStorage, lines, batch=2) == 5
+        assert DefaultStorage.all() == [f"flag{k}" for k in range(5)]
+        assert all(BinaryFlag.load_many(DefaultStorage.all()).values())
+        assert len(list(DefaultStorage.iter_info(tags=["x"]))) == 5
+
+    def test_replace(self):
+        BinaryFlag.create("flag0", label="Old", tags="old").set()
+        BinaryFlag("flag0")
+        used = DefaultStorage.used("flag0")
+        import_flags(DefaultStorage, [
+            line(name="flag0", type="percentage", value=25, tags="new"),
+            line(name="flag1"),
+        ])
+
+        info = DefaultStorage.info("flag0")
+        assert info.type == FlagTypes.PERCENTAGE
+        assert info.value_percentage == 25
+        assert info.value_binary is None
+        assert info.label is None
+        assert info.used == used
+        assert info.version == 3
+        assert [i.name for i in DefaultStorage.iter_info(tags=["old"])] == []
+        assert [i.name for i in DefaultStorage.iter_info(tags=["new"])] == \
+            ["flag0"]
+        assert DefaultStorage.info("flag1").version == 1
+
+    def test_duplicates(self):
+        assert import_flags(DefaultStorage, [
+            line(name="flag0", value=False),
+            line(name="flag0", value=True),
+        ]) == 1
+        assert BinaryFlag("flag0")
+
+    def test_invalid_line(self):
+        BinaryFlag.create("flag0")
+        with pytest.raises(ValueError) as error:
+            import_flags(DefaultStorage, [
+                line(name="flag0", value=True),
+                "\n",
+                line(name="flag1", value="yes"),
+            ], batch=1)
+        assert str(error.value).startswith("line 3:")
+        assert DefaultStorage.all() == ["flag0"]
+
+    def test_commands(self, tmpdir):
+        BinaryFlag.create("flag0", description="Flag 0").set()
+        PercentageFlag.create("flag1", tags="a").set(30)
+        RuleFlag.create("flag2").set([{}])
+        path = str(tmpdir.join("flags.ndjson"))
+
+        args = cli.parser().parse_args(["export", "--output", path])
+        args.func(args, DefaultStorage)
+        args.output.close()
+        exported = DefaultStorage.info_all()
+
+        DefaultStorage.store_many({"flag0": False}, FlagTypes.BINARY)
+        PercentageFlag("flag1").set(0)
+        args = cli.parser().parse_args(["import", "--input", path])
+        args.func(args, DefaultStorage)
+
+        def definition(info):
+            return [info[field] for field in info.keys()
+                    if field not in ("used", "version")]
+
+        assert list(map(definition, DefaultStorage.info_all())) == \
+            list(map(definition, exported))